@@ -4,7 +4,41 @@ import json
 import logging
 import requests
 
-from phdi_building_blocks import fhir
+from phdi_building_blocks import export_jobs, export_state, fhir
+
+
+def get_export_jobs() -> export_jobs.ExportJobs:
+    """Get the records of export jobs, kept at FHIR_EXPORT_JOBS_LOCATION"""
+    return export_jobs.ExportJobs(
+        export_state.get_state_store(
+            config.get_required_config("FHIR_EXPORT_JOBS_LOCATION")
+        ),
+        retention=float(
+            config.get_required_config(
+                "FHIR_EXPORT_JOB_RETENTION", export_jobs.JOB_RETENTION
+            )
+        ),
+    )
+
+
+def get_export_watermarks() -> export_state.ExportWatermarks:
+    """Get the watermarks of incremental exports, kept at
+    FHIR_EXPORT_STATE_LOCATION"""
+    return export_state.ExportWatermarks(
+        export_state.get_state_store(
+            config.get_required_config("FHIR_EXPORT_STATE_LOCATION")
+        )
+    )
+
+
+def get_poll_settings() -> dict:
+    """The bounds on the wait between polls of an export job"""
+    return {
+        "min_delay": float(config.get_required_config("FHIR_EXPORT_POLL_INTERVAL", 30)),
+        "max_delay": float(
+            config.get_required_config("FHIR_EXPORT_MAX_POLL_INTERVAL", 300)
+        ),
+    }
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -21,17 +55,31 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
     access_token = cred_manager.get_access_token()
 
+    incremental = req.params.get("incremental", "").lower() == "true"
+
+    if req.params.get("job_id"):
+        return _export_job_status(req.params["job_id"], access_token.token)
+    if req.params.get("wait", "").lower() == "false":
+        return _kickoff_export_job(req, access_token.token, fhir_url, container)
+
+    export_args = dict(
+        access_token=access_token.token,
+        fhir_url=fhir_url,
+        export_scope=req.params.get("export_scope", ""),
+        since=req.params.get("since", ""),
+        resource_type=req.params.get("type", ""),
+        container=container,
+        poll_step=poll_step,
+        poll_timeout=poll_timeout,
+    )
+
     try:
-        export_response = fhir.export_from_fhir_server(
-            access_token=access_token.token,
-            fhir_url=fhir_url,
-            export_scope=req.params.get("export_scope", ""),
-            since=req.params.get("since", ""),
-            resource_type=req.params.get("type", ""),
-            container=container,
-            poll_step=poll_step,
-            poll_timeout=poll_timeout,
-        )
+        if incremental:
+            export_response = export_state.incremental_export(
+                watermarks=get_export_watermarks(), **export_args
+            )
+        else:
+            export_response = fhir.export_from_fhir_server(**export_args)
         logging.debug(f"Export response received: {json.dumps(export_response)}")
     except requests.HTTPError as exception:
         logging.exception(
@@ -44,3 +92,43 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         raise exception
 
     return func.HttpResponse(status_code=202)
+
+
+def _kickoff_export_job(
+    req: func.HttpRequest, access_token: str, fhir_url: str, container: str
+) -> func.HttpResponse:
+    """Kick off an export without waiting for it, and respond with its job record,
+    which FhirServerExportPoller (or a request with its job_id) polls later"""
+    incremental = req.params.get("incremental", "").lower() == "true"
+    job = export_jobs.kickoff_export_job(
+        access_token=access_token,
+        fhir_url=fhir_url,
+        jobs=get_export_jobs(),
+        export_scope=req.params.get("export_scope", ""),
+        since=req.params.get("since", ""),
+        resource_type=req.params.get("type", ""),
+        container=container,
+        watermarks=get_export_watermarks() if incremental else None,
+        min_delay=get_poll_settings()["min_delay"],
+    )
+    return func.HttpResponse(
+        body=job.json(), status_code=202, mimetype="application/json"
+    )
+
+
+def _export_job_status(job_id: str, access_token: str) -> func.HttpResponse:
+    """Poll an export job if it is due, and respond with its job record: 200 once
+    the export is complete, and 202 while it is in progress"""
+    jobs = get_export_jobs()
+    job = jobs.get(job_id)
+    if job is None:
+        return func.HttpResponse(f"No export job {job_id}", status_code=404)
+
+    watermarks = get_export_watermarks() if job.incremental else None
+    job = export_jobs.poll_export_job(
+        job, access_token, jobs, watermarks=watermarks, **get_poll_settings()
+    )
+    status_code = {"complete": 200, "failed": 500}.get(job.status, 202)
+    return func.HttpResponse(
+        body=job.json(), status_code=status_code, mimetype="application/json"
+    )
@@ -0,0 +1,40 @@
+import azure.functions as func
+import config
+import logging
+import os
+
+from phdi_building_blocks import export_jobs, fhir
+
+from FhirServerExport import get_export_jobs, get_export_watermarks, get_poll_settings
+
+
+def main(timer: func.TimerRequest) -> None:
+    """
+    Resume the export jobs kicked off by FhirServerExport, polling each one that is
+    due.  Jobs that complete are recorded with their export response, and the
+    watermarks of incremental jobs are advanced.
+    """
+    if "FHIR_EXPORT_JOBS_LOCATION" not in os.environ:
+        # Jobs are only recorded for exports started with wait=false, which need
+        # the setting, so without it there is nothing to poll
+        logging.debug("FHIR_EXPORT_JOBS_LOCATION is not set, no export jobs to poll")
+        return
+
+    fhir_url = config.get_required_config("FHIR_URL")
+    jobs = get_export_jobs()
+    pending = jobs.pending()
+    if not pending:
+        return
+
+    cred_manager = fhir.AzureFhirserverCredentialManager(fhir_url=fhir_url)
+    access_token = cred_manager.get_access_token()
+
+    watermarks = None
+    if any(job.incremental for job in pending):
+        watermarks = get_export_watermarks()
+
+    finished = export_jobs.poll_export_jobs(
+        access_token.token, jobs, watermarks=watermarks, **get_poll_settings()
+    )
+    for job in finished:
+        logging.info(f"Export job {job.id} finished with status {job.status}")
@@ -1,78 +1,71 @@
 import logging
-from typing import Dict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Optional
 
 import azure.functions as func
 from azure.core.exceptions import ResourceExistsError
 
-from config import get_required_config
-
 from phdi_building_blocks.azure_blob import store_data
 
 from phdi_building_blocks.fhir import (
+    FhirBundleAggregator,
+    FhirUploadResult,
     upload_bundle_to_fhir_server,
     generate_filename,
-    get_fhirserver_cred_manager,
 )
 from phdi_building_blocks.conversion import (
-    convert_batch_messages_to_list,
-    convert_message_to_fhir,
     get_file_type_mappings,
+    stream_batch_messages,
 )
 
-from phdi_building_blocks.geo import get_smartystreets_client, geocode_patient_address
-from phdi_building_blocks.standardize import (
-    standardize_patient_name,
-    standardize_patient_phone,
-)
-from phdi_building_blocks.linkage import add_patient_identifier
+from phdi_building_blocks.enrichment import enrich_patients
+from phdi_building_blocks.standardize import standardization_cache_stats
+
+from .context import PipelineContext, get_pipeline_context
 
 
 def run_pipeline(
     message: str,
     message_mappings: Dict[str, str],
-    fhir_url: str,
-    access_token: str,
-) -> None:
+    context: PipelineContext,
+    aggregator: FhirBundleAggregator = None,
+) -> Optional[Dict[str, FhirUploadResult]]:
     """
     This function takes in a single message and attempts to convert, transform, and
-    store the output to blob storage and the FHIR server.
+    store the output to blob storage and the FHIR server.  Configuration, clients
+    and the FHIR converter are taken from the shared pipeline context.
+
+    The results of uploads to the FHIR server are returned by source filename.  If
+    an aggregator is provided, the converted bundle is added to it rather than
+    uploaded on its own, and the results of any batch uploads that adding it
+    triggered are returned instead.
 
     If the incoming message cannot be converted, it is stored to the configured
-    invalid blob container and no further processing is done.
+    invalid blob container, no further processing is done, and None is returned so
+    the caller can report the message as failed.
     """
-    salt = get_required_config("HASH_SALT")
-    geocoder = get_smartystreets_client(
-        get_required_config("SMARTYSTREETS_AUTH_ID"),
-        get_required_config("SMARTYSTREETS_AUTH_TOKEN"),
-    )
-    container_url = get_required_config("INTAKE_CONTAINER_URL")
-    valid_output_path = get_required_config("VALID_OUTPUT_CONTAINER_PATH")
-    invalid_output_path = get_required_config("INVALID_OUTPUT_CONTAINER_PATH")
+    access_token = context.access_token
+    upload_results = {}
 
-    response = convert_message_to_fhir(
+    response = context.converter.convert(
         message=message,
         filename=message_mappings["filename"],
         input_data_type=message_mappings["input_data_type"],
         root_template=message_mappings["root_template"],
         template_collection=message_mappings["template_collection"],
-        access_token=access_token,
-        fhir_url=fhir_url,
     )
 
     if response and response.get("resourceType") == "Bundle":
         bundle = response
-        standardize_patient_name(bundle)
-        standardize_patient_phone(bundle)
-        geocode_patient_address(bundle, geocoder)
-
-        add_patient_identifier(bundle, salt)
+        enrich_patients(bundle, context.patient_transforms)
         try:
             store_data(
-                container_url,
-                valid_output_path,
+                context.container_url,
+                context.valid_output_path,
                 f"{message_mappings['filename']}.fhir",
                 message_mappings["bundle_type"],
                 message_json=bundle,
+                client=context.container_client,
             )
         except ResourceExistsError:
             logging.warning(
@@ -80,16 +73,22 @@ def run_pipeline(
                 + f"{message_mappings['filename']}.fhir"
             )
 
-        upload_bundle_to_fhir_server(bundle, access_token, fhir_url)
+        if aggregator is None:
+            upload_results[message_mappings["filename"]] = upload_bundle_to_fhir_server(
+                bundle, access_token, context.fhir_url, client=context.fhir_client
+            )
+        else:
+            upload_results = aggregator.add(message_mappings["filename"], bundle)
     else:
         try:
             # Store invalid message
             store_data(
-                container_url,
-                invalid_output_path,
+                context.container_url,
+                context.invalid_output_path,
                 f"{message_mappings['filename']}.{message_mappings['file_suffix']}",
                 message_mappings["bundle_type"],
                 message=message,
+                client=context.container_client,
             )
         except ResourceExistsError:
             logging.warning(
@@ -99,12 +98,13 @@ def run_pipeline(
         try:
             # Store response information
             store_data(
-                container_url,
-                invalid_output_path,
+                context.container_url,
+                context.invalid_output_path,
                 f"{message_mappings['filename']}.{message_mappings['file_suffix']}"
                 + ".convert-resp",
                 message_mappings["bundle_type"],
                 message_json=response,
+                client=context.container_client,
             )
         except ResourceExistsError:
             logging.warning(
@@ -112,31 +112,199 @@ def run_pipeline(
                 + f"{message_mappings['filename']}.{message_mappings['file_suffix']}"
                 + ".convert-resp"
             )
+        return None
+
+    return upload_results
+
+
+def store_failed_upload(
+    filename: str,
+    result: FhirUploadResult,
+    message_mappings: Dict[str, str],
+    context: PipelineContext,
+) -> None:
+    """
+    Store the entries of a bundle that the FHIR server did not accept, along with
+    the upload result, to the configured dead-letter blob location so they can be
+    inspected and resubmitted.
+    """
+    try:
+        store_data(
+            context.container_url,
+            context.dead_letter_output_path,
+            f"{filename}.fhir",
+            message_mappings["bundle_type"],
+            message_json={
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": result.failed_entries,
+            },
+            client=context.container_client,
+        )
+        store_data(
+            context.container_url,
+            context.dead_letter_output_path,
+            f"{filename}.fhir.upload-resp",
+            message_mappings["bundle_type"],
+            message_json=result.dict(),
+            client=context.container_client,
+        )
+    except ResourceExistsError:
+        logging.warning(f"Attempted to store preexisting resource: {filename}.fhir")
+
+
+def run_pipelines(
+    messages: Iterable[str],
+    message_mappings: Dict[str, str],
+    blob_name: str,
+    context: PipelineContext,
+    max_workers: int = 1,
+) -> Dict[str, bool]:
+    """
+    Run the pipeline for every message in a batch, processing up to max_workers
+    messages concurrently.  Messages are pulled from the iterable only as workers
+    free up, so at most max_workers messages are in flight at any time.
+
+    Each message is named with generate_filename using its index within the batch,
+    so output filenames do not depend on the order in which messages complete.
+    A failure in one message is logged and does not stop the rest of the batch.
+
+    If FHIR batch uploads are enabled in the context, converted bundles are merged
+    into batch Bundles and uploaded together.  A message whose entries are rejected
+    by the FHIR server is reported as failed, and the rejected entries are stored
+    to the dead-letter location.  A summary of the upload results (failures,
+    throttling, retries and latency) is logged to guide concurrency tuning.
+
+    :param messages: The individual messages split out of the batch
+    :param message_mappings: The file type mappings for the batch
+    :param blob_name: The name of the blob the batch was read from
+    :param context: The pipeline context shared by every message
+    :param max_workers: The maximum number of messages to process concurrently
+    :return: A mapping of each message's filename to whether it was processed
+    successfully
+    """
+    results = {}
+    in_flight = {}
+    upload_results = {}
+
+    aggregator = None
+    if context.fhir_batch_max_entries > 0:
+        aggregator = FhirBundleAggregator(
+            context.cred_manager,
+            context.fhir_url,
+            client=context.fhir_client,
+            max_entries=context.fhir_batch_max_entries,
+            max_bytes=context.fhir_batch_max_bytes,
+        )
+
+    def collect(futures) -> None:
+        for future in futures:
+            filename = in_flight.pop(future)
+            try:
+                message_results = future.result()
+            except Exception:
+                logging.exception(f"Exception occurred while processing {filename}.")
+                results[filename] = False
+                continue
+            if message_results is None:
+                logging.error(f"{filename} could not be converted to FHIR.")
+                results[filename] = False
+            else:
+                upload_results.update(message_results)
+                results[filename] = True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, message in enumerate(messages):
+            if len(in_flight) >= max_workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            mappings = {
+                **message_mappings,
+                "filename": generate_filename(blob_name, i),
+            }
+            future = executor.submit(
+                run_pipeline, message, mappings, context, aggregator
+            )
+            in_flight[future] = mappings["filename"]
+
+        collect(list(in_flight))
+
+    if aggregator is not None:
+        upload_results.update(aggregator.flush())
+
+    for filename, result in upload_results.items():
+        if not result.succeeded:
+            logging.error(
+                f"FHIR server did not accept {len(result.failed_entries)} entries "
+                + f"for {filename}, status {result.status_code}"
+            )
+            store_failed_upload(filename, result, message_mappings, context)
+            results[filename] = False
+
+    if upload_results:
+        uploads = upload_results.values()
+        mean_latency = sum(result.latency for result in uploads) / len(uploads)
+        logging.info(
+            f"Uploaded {len(uploads)} bundles from {blob_name}: "
+            + f"{sum(not result.succeeded for result in uploads)} failed, "
+            + f"{sum(result.status_code == 429 for result in uploads)} throttled, "
+            + f"{sum(result.retries for result in uploads)} retries, "
+            + f"mean latency {mean_latency:.3f}s"
+        )
+
+    return results
 
 
 def main(blob: func.InputStream) -> None:
     """
     This is the main entry point for the IntakePipeline Azure function.
     It is responsible for splitting an incoming batch file (or individual message)
-    into a list of individual messages.  Each individual message is passed to the
-    processing pipeline.
+    into individual messages.  The batch is read incrementally, and each individual
+    message is passed to the processing pipeline as soon as it has been read.
     """
     logging.debug("Entering intake pipeline ")
 
-    fhir_url = get_required_config("FHIR_URL")
-    cred_manager = get_fhirserver_cred_manager(fhir_url)
-
     try:
-        access_token = cred_manager.get_access_token()
+        context = get_pipeline_context()
 
-        # VA sends \\u000b & \\u001c in real data, ignore for now
-        messages = convert_batch_messages_to_list(
-            blob.read().decode("utf-8", errors="ignore")
-        )
         message_mappings = get_file_type_mappings(blob.name)
 
-        for i, message in enumerate(messages):
-            message_mappings["filename"] = generate_filename(blob.name, i)
-            run_pipeline(message, message_mappings, fhir_url, access_token.token)
+        # VA sends \\u000b & \\u001c in real data, which are stripped while splitting
+        messages = stream_batch_messages(blob)
+
+        results = run_pipelines(
+            messages,
+            message_mappings,
+            blob.name,
+            context,
+            max_workers=context.max_workers,
+        )
+
+        cache_stats = {
+            name: cache.stats
+            for name, cache in (
+                ("Conversion", context.conversion_cache),
+                ("Geocode", context.geocode_cache),
+            )
+            if cache is not None
+        }
+        # The standardization caches live for the whole process, so their counts
+        # are cumulative across invocations
+        for name, stats in standardization_cache_stats().items():
+            cache_stats[f"Standardized {name}"] = stats
+        for name, stats in cache_stats.items():
+            logging.info(
+                f"{name} cache: {stats.hits} hits, "
+                + f"{stats.misses} misses, "
+                + f"hit rate {stats.hit_rate:.2f}"
+            )
+
+        failures = [filename for filename, success in results.items() if not success]
+        if failures:
+            logging.error(
+                f"{len(failures)} of {len(results)} messages in {blob.name} "
+                + f"failed to process: {', '.join(sorted(failures))}"
+            )
     except Exception:
         logging.exception("Exception occurred during IntakePipeline processing.")
@@ -0,0 +1,154 @@
+import threading
+
+from azure.identity import DefaultAzureCredential
+
+from config import get_required_config
+
+from phdi_building_blocks.azure_blob import get_blob_client
+from phdi_building_blocks.cache import BlobCache, LRUCache, TieredCache
+from phdi_building_blocks.conversion import (
+    CachingFhirConverter,
+    FhirConverter,
+    RemoteFhirConverter,
+)
+from phdi_building_blocks.enrichment import (
+    add_identifier,
+    geocode_addresses,
+    standardize_names,
+    standardize_phones,
+)
+from phdi_building_blocks.fhir import FhirClient, get_fhirserver_cred_manager
+from phdi_building_blocks.geo import GeocodeCache, get_smartystreets_client
+from phdi_building_blocks.local_conversion import LocalHl7v2Converter
+from phdi_building_blocks.offline_geo import OfflineGeocoder
+
+
+class PipelineContext:
+    """
+    Configuration and clients shared by every message processed by the
+    IntakePipeline.  Building these is expensive (credential discovery, client
+    construction and TLS handshakes), so a context is built once and reused for
+    every message in a batch, and across warm invocations of the function.
+    """
+
+    def __init__(self):
+        """Read the pipeline configuration and build the shared clients"""
+        self.fhir_url = get_required_config("FHIR_URL")
+        self.salt = get_required_config("HASH_SALT")
+        self.container_url = get_required_config("INTAKE_CONTAINER_URL")
+        self.valid_output_path = get_required_config("VALID_OUTPUT_CONTAINER_PATH")
+        self.invalid_output_path = get_required_config("INVALID_OUTPUT_CONTAINER_PATH")
+        self.dead_letter_output_path = get_required_config(
+            "DEAD_LETTER_CONTAINER_PATH", self.invalid_output_path
+        )
+        self.max_workers = int(get_required_config("INTAKE_MAX_WORKERS", "4"))
+        self.fhir_batch_max_entries = int(
+            get_required_config("FHIR_BATCH_MAX_ENTRIES", "0")
+        )
+        self.fhir_batch_max_bytes = int(
+            get_required_config("FHIR_BATCH_MAX_BYTES", str(4 * 1024 * 1024))
+        )
+
+        self.geocoder = self._build_geocoder(
+            get_required_config("GEOCODER", "smartystreets")
+        )
+
+        self.credential = DefaultAzureCredential()
+        self.container_client = get_blob_client(self.container_url, self.credential)
+        self.cred_manager = get_fhirserver_cred_manager(self.fhir_url, self.credential)
+
+        # Size the connection pool so every worker can hold a FHIR connection open
+        self.fhir_client = FhirClient(pool_size=self.max_workers)
+
+        self.converter = self._build_converter(
+            get_required_config("FHIR_CONVERTER", "remote")
+        )
+        self.geocode_cache = self._build_geocode_cache()
+        self.conversion_cache = self._build_conversion_cache()
+        if self.conversion_cache is not None:
+            self.converter = CachingFhirConverter(self.converter, self.conversion_cache)
+
+        # Applied to each converted bundle's patients, in a single pass
+        self.patient_transforms = [
+            standardize_names(),
+            standardize_phones(),
+            geocode_addresses(self.geocoder, self.geocode_cache),
+            add_identifier(self.salt),
+        ]
+
+    def _build_converter(self, name: str) -> FhirConverter:
+        """Build the converter named by the FHIR_CONVERTER setting.  The local
+        converter falls back to the FHIR server for messages it does not support."""
+        remote = RemoteFhirConverter(
+            self.cred_manager, self.fhir_url, client=self.fhir_client
+        )
+        if name == "remote":
+            return remote
+        if name == "local":
+            return LocalHl7v2Converter(fallback=remote)
+        raise ValueError(f"Unknown FHIR_CONVERTER {name}, expected local or remote")
+
+    def _build_geocoder(self, name: str):
+        """Build the geocoder named by the GEOCODER setting"""
+        if name == "smartystreets":
+            return get_smartystreets_client(
+                get_required_config("SMARTYSTREETS_AUTH_ID"),
+                get_required_config("SMARTYSTREETS_AUTH_TOKEN"),
+            )
+        if name == "offline":
+            return OfflineGeocoder.from_csv(
+                get_required_config("OFFLINE_GEOCODER_REFERENCE_PATH")
+            )
+        raise ValueError(f"Unknown GEOCODER {name}, expected smartystreets or offline")
+
+    def _build_geocode_cache(self) -> GeocodeCache:
+        """Build the cache of geocoding results, or return None if it is disabled.
+        Results are cached in memory, and also in blob storage if a container path
+        is configured."""
+        size = int(get_required_config("GEOCODE_CACHE_SIZE", "10000"))
+        if size <= 0:
+            return None
+        ttl = float(get_required_config("GEOCODE_CACHE_TTL", str(30 * 24 * 60 * 60)))
+        negative_ttl = float(
+            get_required_config("GEOCODE_CACHE_NEGATIVE_TTL", str(24 * 60 * 60))
+        )
+        cache = LRUCache(max_size=size)
+
+        path = get_required_config("GEOCODE_CACHE_CONTAINER_PATH", "")
+        if path:
+            cache = TieredCache(cache, BlobCache(self.container_client, path))
+        return GeocodeCache(cache, ttl=ttl, negative_ttl=negative_ttl)
+
+    def _build_conversion_cache(self):
+        """Build the cache of converted bundles, or return None if it is disabled.
+        Bundles are cached in memory, and also in blob storage if a container path
+        is configured."""
+        size = int(get_required_config("CONVERSION_CACHE_SIZE", "0"))
+        if size <= 0:
+            return None
+        ttl = float(get_required_config("CONVERSION_CACHE_TTL", "86400"))
+        cache = LRUCache(max_size=size, ttl=ttl)
+
+        path = get_required_config("CONVERSION_CACHE_CONTAINER_PATH", "")
+        if path:
+            cache = TieredCache(cache, BlobCache(self.container_client, path, ttl))
+        return cache
+
+    @property
+    def access_token(self) -> str:
+        """A FHIR server access token, refreshed when it is about to expire"""
+        return self.cred_manager.get_access_token().token
+
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_pipeline_context() -> PipelineContext:
+    """Get the pipeline context, building it on the first call.  The context is
+    cached at module level, so warm invocations of the function reuse it."""
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = PipelineContext()
+        return _context
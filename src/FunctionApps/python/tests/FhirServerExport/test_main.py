@@ -1,4 +1,5 @@
 import io
+import json
 import logging
 
 from FhirServerExport import main
@@ -71,3 +72,62 @@ def test_main(mock_get_access_token, mock_export, mock_download):
         poll_step=0.1,
         poll_timeout=1.0,
     )
+
+
+@mock.patch("FhirServerExport.export_state.fhir.export_from_fhir_server")
+@mock.patch.object(AzureFhirserverCredentialManager, "get_access_token")
+def test_main_incremental(mock_get_access_token, mock_export, tmp_path):
+    state_path = tmp_path / "export-state.json"
+    req = mock.Mock()
+    req.params = {"export_scope": "Patient", "type": "Patient", "incremental": "true"}
+    mock_get_access_token.return_value = mock.Mock(token="some-token")
+
+    with mock.patch.dict(
+        "os.environ", {**ENVIRONMENT, "FHIR_EXPORT_STATE_LOCATION": str(state_path)}
+    ):
+        mock_export.return_value = {"transactionTime": "2022-03-01T00:00:00Z"}
+        main(req)
+        assert mock_export.call_args.kwargs["since"] == ""
+
+        # The next run only exports changes since the previous one
+        mock_export.return_value = {"transactionTime": "2022-03-02T00:00:00Z"}
+        main(req)
+        assert mock_export.call_args.kwargs["since"] == "2022-03-01T00:00:00Z"
+
+    assert "2022-03-02T00:00:00Z" in state_path.read_text()
+
+
+@mock.patch.object(AzureFhirserverCredentialManager, "get_access_token")
+def test_main_export_job(mock_get_access_token, tmp_path):
+    mock_get_access_token.return_value = mock.Mock(token="some-token")
+    environment = {
+        **ENVIRONMENT,
+        "FHIR_EXPORT_JOBS_LOCATION": str(tmp_path / "jobs.json"),
+    }
+
+    with mock.patch.dict("os.environ", environment), mock.patch(
+        "FhirServerExport.export_jobs.fhir.kickoff_export"
+    ) as mock_kickoff, mock.patch(
+        "FhirServerExport.export_jobs.fhir.check_export_status"
+    ) as mock_check_status:
+        mock_kickoff.return_value = "https://some-fhir-url/export-status"
+        response = main(mock.Mock(params={"type": "Patient", "wait": "false"}))
+
+        # The export is kicked off without waiting for it to complete
+        assert response.status_code == 202
+        job = json.loads(response.get_body())
+        assert job["poll_url"] == "https://some-fhir-url/export-status"
+        assert job["resource_type"] == "Patient"
+        mock_check_status.assert_not_called()
+
+        # Later requests with the job id poll it, once it is due
+        mock_check_status.return_value = mock.Mock(
+            status_code=200, json=lambda: {"output": []}
+        )
+        with mock.patch("time.time", return_value=job["next_poll"]):
+            response = main(mock.Mock(params={"job_id": job["id"]}))
+        assert response.status_code == 200
+        assert json.loads(response.get_body())["response"] == {"output": []}
+
+        response = main(mock.Mock(params={"job_id": "no-such-job"}))
+        assert response.status_code == 404
@@ -0,0 +1,45 @@
+import os
+
+from unittest import mock
+
+from phdi_building_blocks.export_jobs import ExportJob, ExportJobs
+from phdi_building_blocks.export_state import LocalStateStore
+from phdi_building_blocks.fhir import AzureFhirserverCredentialManager
+
+from FhirServerExportPoller import main
+
+
+@mock.patch("FhirServerExportPoller.export_jobs.fhir.check_export_status")
+@mock.patch.object(AzureFhirserverCredentialManager, "get_access_token")
+def test_poller(mock_get_access_token, mock_check_status, tmp_path):
+    mock_get_access_token.return_value = mock.Mock(token="some-token")
+    mock_check_status.return_value = mock.Mock(
+        status_code=202, headers={"Retry-After": "120"}
+    )
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"))
+    jobs.save(ExportJob(id="due", poll_url="https://due", started=0, next_poll=0))
+    jobs.save(
+        ExportJob(id="later", poll_url="https://later", started=0, next_poll=1e12)
+    )
+    environment = {
+        "FHIR_URL": "https://some-fhir-url",
+        "FHIR_EXPORT_JOBS_LOCATION": str(tmp_path / "jobs.json"),
+    }
+
+    with mock.patch.dict("os.environ", environment):
+        main(mock.Mock())
+
+    # Only the job that is due is polled, and its next poll honors Retry-After
+    mock_check_status.assert_called_once_with("https://due", "some-token", None)
+    assert jobs.get("due").attempts == 1
+    assert jobs.get("due").next_poll > jobs.get("due").started + 100
+    assert jobs.get("later").attempts == 0
+
+
+@mock.patch("FhirServerExportPoller.get_export_jobs")
+def test_poller_without_jobs_location(mock_get_export_jobs):
+    with mock.patch.dict("os.environ", {"FHIR_URL": "https://some-fhir-url"}):
+        os.environ.pop("FHIR_EXPORT_JOBS_LOCATION", None)
+        main(mock.Mock())
+
+    mock_get_export_jobs.assert_not_called()
@@ -1,10 +1,19 @@
 import pathlib
 import pytest
+import threading
+import time
 from unittest import mock
 
-from phdi_building_blocks.conversion import convert_batch_messages_to_list
+from phdi_building_blocks.conversion import (
+    CachingFhirConverter,
+    RemoteFhirConverter,
+    convert_batch_messages_to_list,
+)
+from phdi_building_blocks.cache import LRUCache
+from phdi_building_blocks.local_conversion import LocalHl7v2Converter
 
-from IntakePipeline import run_pipeline
+from IntakePipeline import run_pipeline, run_pipelines
+from IntakePipeline.context import PipelineContext
 
 
 @pytest.fixture()
@@ -25,6 +34,21 @@ TEST_ENV = {
     "FHIR_URL": "fhir-url",
 }
 
+
+@pytest.fixture()
+def pipeline_context():
+    context = mock.Mock()
+    context.fhir_url = "some-fhir-url"
+    context.access_token = "some-token"
+    context.salt = TEST_ENV["HASH_SALT"]
+    context.container_url = TEST_ENV["INTAKE_CONTAINER_URL"]
+    context.valid_output_path = TEST_ENV["VALID_OUTPUT_CONTAINER_PATH"]
+    context.invalid_output_path = TEST_ENV["INVALID_OUTPUT_CONTAINER_PATH"]
+    context.dead_letter_output_path = "output/dead-letter/path"
+    context.fhir_batch_max_entries = 0
+    return context
+
+
 MESSAGE_MAPPINGS = {
     "file_suffix": "hl7",
     "bundle_type": "VXU",
@@ -35,63 +59,40 @@ MESSAGE_MAPPINGS = {
 }
 
 
-@mock.patch("IntakePipeline.standardize_patient_name")
-@mock.patch("IntakePipeline.standardize_patient_phone")
-@mock.patch("IntakePipeline.geocode_patient_address")
-@mock.patch("IntakePipeline.add_patient_identifier")
+@mock.patch("IntakePipeline.enrich_patients")
 @mock.patch("IntakePipeline.upload_bundle_to_fhir_server")
 @mock.patch("IntakePipeline.store_data")
-@mock.patch("IntakePipeline.get_smartystreets_client")
-@mock.patch("IntakePipeline.convert_message_to_fhir")
-@mock.patch.dict("os.environ", TEST_ENV)
 def test_pipeline_valid_message(
-    patched_converter,
-    patched_get_geocoder,
     patched_store,
     patched_upload,
-    patched_patient_id,
-    patched_address_standardization,
-    patched_phone_standardization,
-    patched_name_standardization,
+    patched_enrichment,
+    pipeline_context,
 ):
+    patched_converter = pipeline_context.converter.convert
     patched_converter.return_value = {
         "resourceType": "Bundle",
         "entry": [{"hello": "world"}],
     }
 
-    patched_geocoder = mock.Mock()
-    patched_get_geocoder.return_value = patched_geocoder
-
-    run_pipeline("MSH|Hello World", MESSAGE_MAPPINGS, "some-fhir-url", "some-token")
+    run_pipeline("MSH|Hello World", MESSAGE_MAPPINGS, pipeline_context)
 
-    patched_get_geocoder.assert_called_with("smarty-auth-id", "smarty-auth-token")
     patched_converter.assert_called_with(
         message="MSH|Hello World",
         filename="some-filename-1",
         input_data_type=MESSAGE_MAPPINGS["input_data_type"],
         root_template=MESSAGE_MAPPINGS["root_template"],
         template_collection=MESSAGE_MAPPINGS["template_collection"],
-        access_token="some-token",
-        fhir_url="some-fhir-url",
-    )
-
-    patched_name_standardization.assert_called_with(
-        {"resourceType": "Bundle", "entry": [{"hello": "world"}]}
-    )
-    patched_phone_standardization.assert_called_with(
-        {"resourceType": "Bundle", "entry": [{"hello": "world"}]}
-    )
-    patched_address_standardization.assert_called_with(
-        {"resourceType": "Bundle", "entry": [{"hello": "world"}]}, patched_geocoder
     )
 
-    patched_patient_id.assert_called_with(
-        {"resourceType": "Bundle", "entry": [{"hello": "world"}]}, TEST_ENV["HASH_SALT"]
+    patched_enrichment.assert_called_with(
+        {"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+        pipeline_context.patient_transforms,
     )
     patched_upload.assert_called_with(
         {"resourceType": "Bundle", "entry": [{"hello": "world"}]},
         "some-token",
         "some-fhir-url",
+        client=pipeline_context.fhir_client,
     )
     patched_store.assert_called_with(
         "some-url",
@@ -99,52 +100,35 @@ def test_pipeline_valid_message(
         f"{MESSAGE_MAPPINGS['filename']}.fhir",
         MESSAGE_MAPPINGS["bundle_type"],
         message_json={"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+        client=pipeline_context.container_client,
     )
 
 
-@mock.patch("IntakePipeline.standardize_patient_name")
-@mock.patch("IntakePipeline.standardize_patient_phone")
-@mock.patch("IntakePipeline.geocode_patient_address")
-@mock.patch("IntakePipeline.add_patient_identifier")
+@mock.patch("IntakePipeline.enrich_patients")
 @mock.patch("IntakePipeline.upload_bundle_to_fhir_server")
 @mock.patch("IntakePipeline.store_data")
-@mock.patch("IntakePipeline.get_smartystreets_client")
-@mock.patch("IntakePipeline.convert_message_to_fhir")
-@mock.patch.dict("os.environ", TEST_ENV)
 def test_pipeline_invalid_message(
-    patched_converter,
-    patched_get_geocoder,
     patched_store,
     patched_upload,
-    patched_patient_id,
-    patched_address_standardization,
-    patched_phone_standardization,
-    patched_name_standardization,
+    patched_enrichment,
+    pipeline_context,
 ):
+    patched_converter = pipeline_context.converter.convert
     patched_converter.return_value = {
         "http_status_code": 400,
         "response_content": "some-error",
     }
 
-    patched_geocoder = mock.Mock()
-    patched_get_geocoder.return_value = patched_geocoder
-
-    run_pipeline("MSH|Hello World", MESSAGE_MAPPINGS, "some-fhir-url", "some-token")
+    assert run_pipeline("MSH|Hello World", MESSAGE_MAPPINGS, pipeline_context) is None
 
-    patched_get_geocoder.assert_called_with("smarty-auth-id", "smarty-auth-token")
     patched_converter.assert_called_with(
         message="MSH|Hello World",
         filename="some-filename-1",
         input_data_type=MESSAGE_MAPPINGS["input_data_type"],
         root_template=MESSAGE_MAPPINGS["root_template"],
         template_collection=MESSAGE_MAPPINGS["template_collection"],
-        access_token="some-token",
-        fhir_url="some-fhir-url",
     )
-    patched_address_standardization.assert_not_called()
-    patched_phone_standardization.assert_not_called()
-    patched_name_standardization.assert_not_called()
-    patched_patient_id.assert_not_called()
+    patched_enrichment.assert_not_called()
     patched_upload.assert_not_called()
     patched_store.assert_has_calls(
         [
@@ -154,6 +138,7 @@ def test_pipeline_invalid_message(
                 f"{MESSAGE_MAPPINGS['filename']}.hl7",
                 MESSAGE_MAPPINGS["bundle_type"],
                 message="MSH|Hello World",
+                client=pipeline_context.container_client,
             ),
             mock.call(
                 "some-url",
@@ -164,31 +149,23 @@ def test_pipeline_invalid_message(
                     "http_status_code": 400,
                     "response_content": "some-error",
                 },
+                client=pipeline_context.container_client,
             ),
         ]
     )
 
 
-@mock.patch("IntakePipeline.standardize_patient_name")
-@mock.patch("IntakePipeline.standardize_patient_phone")
-@mock.patch("IntakePipeline.geocode_patient_address")
-@mock.patch("IntakePipeline.add_patient_identifier")
+@mock.patch("IntakePipeline.enrich_patients")
 @mock.patch("IntakePipeline.upload_bundle_to_fhir_server")
 @mock.patch("IntakePipeline.store_data")
-@mock.patch("IntakePipeline.get_smartystreets_client")
-@mock.patch("IntakePipeline.convert_message_to_fhir")
-@mock.patch.dict("os.environ", TEST_ENV)
 def test_pipeline_partial_invalid_message(
-    patched_converter,
-    patched_get_geocoder,
     patched_store,
     patched_upload,
-    patched_patient_id,
-    patched_address_standardization,
-    patched_phone_standardization,
-    patched_name_standardization,
+    patched_enrichment,
     partial_failure_message,
+    pipeline_context,
 ):
+    patched_converter = pipeline_context.converter.convert
     patched_converter.side_effect = [
         {"resourceType": "Bundle", "entry": [{"hello": "world"}]},
         {"resourceType": "Bundle", "entry": [{"hello": "world"}]},
@@ -197,9 +174,6 @@ def test_pipeline_partial_invalid_message(
         {"resourceType": "Bundle", "entry": [{"hello": "world"}]},
     ]
 
-    patched_geocoder = mock.Mock()
-    patched_get_geocoder.return_value = patched_geocoder
-
     messages = convert_batch_messages_to_list(partial_failure_message)
 
     message_mappings = {
@@ -212,26 +186,23 @@ def test_pipeline_partial_invalid_message(
 
     # Message 0
     message_mappings["filename"] = "some-filename-0"
-    run_pipeline(messages[0], message_mappings, "some-fhir-url", "some-token")
+    run_pipeline(messages[0], message_mappings, pipeline_context)
 
     # Message 1
     message_mappings["filename"] = "some-filename-1"
-    run_pipeline(messages[1], message_mappings, "some-fhir-url", "some-token")
+    run_pipeline(messages[1], message_mappings, pipeline_context)
 
     # Message 2
     message_mappings["filename"] = "some-filename-2"
-    run_pipeline(messages[2], message_mappings, "some-fhir-url", "some-token")
+    run_pipeline(messages[2], message_mappings, pipeline_context)
 
     # Message 3
     message_mappings["filename"] = "some-filename-3"
-    run_pipeline(messages[3], message_mappings, "some-fhir-url", "some-token")
+    run_pipeline(messages[3], message_mappings, pipeline_context)
 
     # Message 4
     message_mappings["filename"] = "some-filename-4"
-    run_pipeline(messages[4], message_mappings, "some-fhir-url", "some-token")
-
-    # Geocoder called 4 times
-    patched_get_geocoder.call_count = 4
+    run_pipeline(messages[4], message_mappings, pipeline_context)
 
     patched_converter.assert_has_calls(
         [
@@ -241,8 +212,6 @@ def test_pipeline_partial_invalid_message(
                 input_data_type=message_mappings["input_data_type"],
                 root_template=message_mappings["root_template"],
                 template_collection=message_mappings["template_collection"],
-                access_token="some-token",
-                fhir_url="some-fhir-url",
             ),
             mock.call(
                 message=messages[1],
@@ -250,8 +219,6 @@ def test_pipeline_partial_invalid_message(
                 input_data_type=message_mappings["input_data_type"],
                 root_template=message_mappings["root_template"],
                 template_collection=message_mappings["template_collection"],
-                access_token="some-token",
-                fhir_url="some-fhir-url",
             ),
             mock.call(
                 message=messages[2],
@@ -259,8 +226,6 @@ def test_pipeline_partial_invalid_message(
                 input_data_type=message_mappings["input_data_type"],
                 root_template=message_mappings["root_template"],
                 template_collection=message_mappings["template_collection"],
-                access_token="some-token",
-                fhir_url="some-fhir-url",
             ),
             mock.call(
                 message=messages[3],
@@ -268,8 +233,6 @@ def test_pipeline_partial_invalid_message(
                 input_data_type=message_mappings["input_data_type"],
                 root_template=message_mappings["root_template"],
                 template_collection=message_mappings["template_collection"],
-                access_token="some-token",
-                fhir_url="some-fhir-url",
             ),
             mock.call(
                 message=messages[4],
@@ -277,15 +240,10 @@ def test_pipeline_partial_invalid_message(
                 input_data_type=message_mappings["input_data_type"],
                 root_template=message_mappings["root_template"],
                 template_collection=message_mappings["template_collection"],
-                access_token="some-token",
-                fhir_url="some-fhir-url",
             ),
         ]
     )
-    patched_address_standardization.call_count = 4
-    patched_phone_standardization.call_count = 4
-    patched_name_standardization.call_count = 4
-    patched_patient_id.call_count = 4
+    patched_enrichment.call_count = 4
     patched_upload.call_count = 4
     patched_store.assert_has_calls(
         [
@@ -295,6 +253,7 @@ def test_pipeline_partial_invalid_message(
                 "some-filename-0.fhir",
                 "VXU",
                 message_json={"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+                client=pipeline_context.container_client,
             ),
             mock.call(
                 "some-url",
@@ -302,6 +261,7 @@ def test_pipeline_partial_invalid_message(
                 "some-filename-1.fhir",
                 "VXU",
                 message_json={"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+                client=pipeline_context.container_client,
             ),
             mock.call(
                 "some-url",
@@ -309,6 +269,7 @@ def test_pipeline_partial_invalid_message(
                 "some-filename-2.hl7",
                 "VXU",
                 message=messages[2],
+                client=pipeline_context.container_client,
             ),
             mock.call(
                 "some-url",
@@ -319,6 +280,7 @@ def test_pipeline_partial_invalid_message(
                     "http_status_code": 400,
                     "response_content": '"some-error"',
                 },
+                client=pipeline_context.container_client,
             ),
             mock.call(
                 "some-url",
@@ -326,6 +288,7 @@ def test_pipeline_partial_invalid_message(
                 "some-filename-3.fhir",
                 "VXU",
                 message_json={"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+                client=pipeline_context.container_client,
             ),
             mock.call(
                 "some-url",
@@ -333,6 +296,241 @@ def test_pipeline_partial_invalid_message(
                 "some-filename-4.fhir",
                 "VXU",
                 message_json={"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+                client=pipeline_context.container_client,
             ),
         ]
     )
+
+
+@mock.patch("IntakePipeline.run_pipeline")
+def test_run_pipelines(patched_run_pipeline, pipeline_context):
+    lock = threading.Lock()
+    active = {"current": 0, "max": 0}
+
+    def fake_run_pipeline(message, message_mappings, context, aggregator):
+        with lock:
+            active["current"] += 1
+            active["max"] = max(active["max"], active["current"])
+        time.sleep(0.01)
+        with lock:
+            active["current"] -= 1
+        if message == "MSH|bad":
+            raise Exception("some-error")
+        return {}
+
+    patched_run_pipeline.side_effect = fake_run_pipeline
+
+    messages = ["MSH|good", "MSH|good", "MSH|bad", "MSH|good", "MSH|good"]
+    results = run_pipelines(
+        iter(messages),
+        {"bundle_type": "VXU", "file_suffix": "hl7"},
+        "decrypted/VXU/some-filename.hl7",
+        pipeline_context,
+        max_workers=2,
+    )
+
+    assert results == {
+        "some-filename-0": True,
+        "some-filename-1": True,
+        "some-filename-2": False,
+        "some-filename-3": True,
+        "some-filename-4": True,
+    }
+    assert active["max"] <= 2
+    patched_run_pipeline.assert_any_call(
+        "MSH|bad",
+        {"bundle_type": "VXU", "file_suffix": "hl7", "filename": "some-filename-2"},
+        pipeline_context,
+        None,
+    )
+
+
+@mock.patch("IntakePipeline.upload_bundle_to_fhir_server")
+@mock.patch("IntakePipeline.store_data")
+def test_run_pipelines_conversion_failure(
+    patched_store, patched_upload, pipeline_context
+):
+    pipeline_context.converter.convert.return_value = {
+        "http_status_code": 400,
+        "response_content": "some-error",
+    }
+
+    results = run_pipelines(
+        iter(["MSH|bad"]),
+        {"bundle_type": "VXU", "file_suffix": "hl7"},
+        "decrypted/VXU/b.hl7",
+        pipeline_context,
+    )
+
+    assert results == {"b-0": False}
+    patched_upload.assert_not_called()
+
+
+@mock.patch("IntakePipeline.enrich_patients")
+@mock.patch("IntakePipeline.upload_bundle_to_fhir_server")
+@mock.patch("IntakePipeline.store_data")
+def test_run_pipelines_batched_upload(
+    patched_store,
+    patched_upload,
+    patched_enrichment,
+    pipeline_context,
+):
+    patched_converter = pipeline_context.converter.convert
+    patched_converter.side_effect = [
+        {"resourceType": "Bundle", "entry": [{"request": {"url": "Patient/0"}}]},
+        {"resourceType": "Bundle", "entry": [{"request": {"url": "Patient/1"}}]},
+        {"resourceType": "Bundle", "entry": [{"request": {"url": "Patient/2"}}]},
+    ]
+    pipeline_context.fhir_batch_max_entries = 2
+    pipeline_context.fhir_batch_max_bytes = 1024
+    pipeline_context.fhir_client.post.side_effect = [
+        mock.Mock(
+            status_code=200,
+            json=lambda: {
+                "entry": [
+                    {"response": {"status": "201 Created"}},
+                    {"response": {"status": "400 Bad Request"}},
+                ]
+            },
+        ),
+        mock.Mock(
+            status_code=200,
+            json=lambda: {"entry": [{"response": {"status": "200 OK"}}]},
+        ),
+    ]
+
+    results = run_pipelines(
+        ["MSH|one", "MSH|two", "MSH|three"],
+        MESSAGE_MAPPINGS,
+        "decrypted/VXU/some-filename.hl7",
+        pipeline_context,
+    )
+
+    assert results == {
+        "some-filename-0": True,
+        "some-filename-1": False,
+        "some-filename-2": True,
+    }
+    patched_upload.assert_not_called()
+    assert pipeline_context.fhir_client.post.call_count == 2
+
+    # The rejected entry is stored to the dead-letter location
+    patched_store.assert_any_call(
+        "some-url",
+        "output/dead-letter/path",
+        "some-filename-1.fhir",
+        "VXU",
+        message_json={
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [{"request": {"url": "Patient/1"}}],
+        },
+        client=pipeline_context.container_client,
+    )
+
+
+@mock.patch("IntakePipeline.context.get_fhirserver_cred_manager")
+@mock.patch("IntakePipeline.context.get_blob_client")
+@mock.patch("IntakePipeline.context.DefaultAzureCredential")
+@mock.patch("IntakePipeline.context.get_smartystreets_client")
+@mock.patch.dict("os.environ", TEST_ENV)
+def test_pipeline_context(
+    patched_get_geocoder,
+    patched_credential,
+    patched_get_blob_client,
+    patched_get_cred_manager,
+):
+    credential = patched_credential.return_value
+    patched_get_cred_manager.return_value.get_access_token.return_value = mock.Mock(
+        token="some-token"
+    )
+
+    context = PipelineContext()
+
+    patched_get_geocoder.assert_called_once_with("smarty-auth-id", "smarty-auth-token")
+    patched_get_blob_client.assert_called_once_with("some-url", credential)
+    patched_get_cred_manager.assert_called_once_with("fhir-url", credential)
+    assert context.geocoder == patched_get_geocoder.return_value
+    assert context.container_client == patched_get_blob_client.return_value
+    assert context.salt == TEST_ENV["HASH_SALT"]
+    assert context.max_workers == 4
+    assert context.access_token == "some-token"
+    adapter = context.fhir_client.session.get_adapter("https://fhir-url")
+    assert adapter._pool_maxsize == 4
+    assert isinstance(context.converter, RemoteFhirConverter)
+    assert context.conversion_cache is None
+    assert isinstance(context.geocode_cache.cache, LRUCache)
+    assert len(context.patient_transforms) == 4
+
+
+@mock.patch("IntakePipeline.context.get_fhirserver_cred_manager")
+@mock.patch("IntakePipeline.context.get_blob_client")
+@mock.patch("IntakePipeline.context.DefaultAzureCredential")
+@mock.patch("IntakePipeline.context.get_smartystreets_client")
+@mock.patch.dict("os.environ", {**TEST_ENV, "FHIR_CONVERTER": "local"})
+def test_pipeline_context_local_converter(
+    patched_get_geocoder,
+    patched_credential,
+    patched_get_blob_client,
+    patched_get_cred_manager,
+):
+    context = PipelineContext()
+
+    assert isinstance(context.converter, LocalHl7v2Converter)
+    assert isinstance(context.converter.fallback, RemoteFhirConverter)
+    assert context.converter.fallback.client == context.fhir_client
+
+
+@mock.patch("IntakePipeline.context.get_fhirserver_cred_manager")
+@mock.patch("IntakePipeline.context.get_blob_client")
+@mock.patch("IntakePipeline.context.DefaultAzureCredential")
+@mock.patch("IntakePipeline.context.get_smartystreets_client")
+@mock.patch.dict(
+    "os.environ",
+    {
+        **TEST_ENV,
+        "CONVERSION_CACHE_SIZE": "100",
+        "CONVERSION_CACHE_TTL": "60",
+        "CONVERSION_CACHE_CONTAINER_PATH": "conversion-cache",
+    },
+)
+def test_pipeline_context_conversion_cache(
+    patched_get_geocoder,
+    patched_credential,
+    patched_get_blob_client,
+    patched_get_cred_manager,
+):
+    context = PipelineContext()
+
+    assert isinstance(context.converter, CachingFhirConverter)
+    assert isinstance(context.converter.converter, RemoteFhirConverter)
+    assert context.converter.cache == context.conversion_cache
+    memory, blob = context.conversion_cache.tiers
+    assert memory.max_size == 100
+    assert memory.ttl == 60
+    assert blob.client == patched_get_blob_client.return_value
+    assert blob.prefix == "conversion-cache"
+
+
+@mock.patch("IntakePipeline.context.get_fhirserver_cred_manager")
+@mock.patch("IntakePipeline.context.get_blob_client")
+@mock.patch("IntakePipeline.context.DefaultAzureCredential")
+@mock.patch("IntakePipeline.context.OfflineGeocoder.from_csv")
+@mock.patch.dict(
+    "os.environ",
+    {
+        **TEST_ENV,
+        "GEOCODER": "offline",
+        "OFFLINE_GEOCODER_REFERENCE_PATH": "reference.csv",
+    },
+)
+def test_pipeline_context_offline_geocoder(
+    patched_from_csv,
+    patched_credential,
+    patched_get_blob_client,
+    patched_get_cred_manager,
+):
+    context = PipelineContext()
+
+    patched_from_csv.assert_called_once_with("reference.csv")
+    assert context.geocoder == patched_from_csv.return_value
@@ -0,0 +1,267 @@
+"""
+Benchmarks for the building blocks' hot paths, run on synthetic HL7 v2 batches and
+FHIR bundles.
+
+    python -m benchmarks --messages 1000 --bundles 1000 --output baseline.json
+    python -m benchmarks --compare baseline.json
+
+Each benchmark reports messages per second, p50 and p99 latency per call, and the
+peak memory it allocated, measured with tracemalloc in a separate pass so that
+tracing doesn't slow the timed one.  Each bundle stands in for one converted
+message.  With --compare, the run is compared to a saved baseline and exits with
+a non-zero status if any benchmark's throughput dropped, or its latency or peak
+memory rose, by more than --tolerance.
+"""
+import argparse
+import copy
+import json
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable, List
+
+from phdi_building_blocks.conversion import (
+    clean_message,
+    convert_batch_messages_to_list,
+)
+from phdi_building_blocks.enrichment import (
+    add_identifier,
+    enrich_patients,
+    geocode_addresses,
+    standardize_names,
+    standardize_phones,
+)
+from phdi_building_blocks.geo import geocode_patient_address
+from phdi_building_blocks.linkage import add_patient_identifier
+from phdi_building_blocks.standardize import (
+    standardize_patient_name,
+    standardize_patient_names,
+    standardize_patient_phone,
+    standardize_patient_phones,
+)
+
+from benchmarks.synthetic import generate_hl7_batch, generate_patient_bundles
+
+
+class StubGeocoder:
+    """Stands in for a SmartyStreets client, filling in a fixed candidate for every
+    lookup without any network calls"""
+
+    def send_lookup(self, lookup) -> None:
+        lookup.result = [
+            SimpleNamespace(
+                delivery_line_1=lookup.street.split(",")[0].upper(),
+                delivery_line_2=None,
+                components=SimpleNamespace(
+                    city_name="SPRINGFIELD", state_abbreviation="IL", zipcode="62701"
+                ),
+                metadata=SimpleNamespace(
+                    latitude=39.78,
+                    longitude=-89.65,
+                    county_fips="17167",
+                    county_name="Sangamon",
+                    precision="Zip9",
+                ),
+            )
+        ]
+
+    def send_batch(self, batch) -> None:
+        for lookup in batch:
+            self.send_lookup(lookup)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Get a percentile of a list of values, by the nearest-rank method
+
+    >>> percentile([4.0, 1.0, 3.0, 2.0], 0.5)
+    2.0
+    """
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def run_benchmark(
+    name: str, function: Callable, items: list, messages_per_item: int = 1
+) -> dict:
+    """Call a function on each item, and summarize its throughput, latency and
+    peak memory.  The first few items are run once beforehand, on copies, to warm
+    up caches."""
+    for item in copy.deepcopy(items[:10]):
+        function(item)
+    # The functions may work in place, so the memory pass gets its own copy
+    memory_items = copy.deepcopy(items)
+
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        item_start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - item_start)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        for item in memory_items:
+            function(item)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "name": name,
+        "messages": len(items) * messages_per_item,
+        "messages_per_sec": len(items) * messages_per_item / elapsed
+        if elapsed
+        else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        # Allocated by this benchmark alone, as tracing starts and stops with it
+        "peak_mb": peak / 2**20,
+    }
+
+
+def run_benchmarks(
+    messages: int, bundles: int, patients: int, batches: int, seed: int
+) -> List[dict]:
+    batch = generate_hl7_batch(messages, seed)
+    hl7_messages = convert_batch_messages_to_list(batch)
+    corpus = generate_patient_bundles(bundles, patients, seed)
+    geocoder = StubGeocoder()
+    salt = "benchmark-salt"
+    chunk = bundles // batches
+    transforms = [
+        standardize_names(),
+        standardize_phones(),
+        geocode_addresses(geocoder),
+        add_identifier(salt),
+    ]
+
+    def fresh_bundles() -> List[dict]:
+        # The bundle transforms work in place, so each benchmark gets its own copy
+        return copy.deepcopy(corpus)
+
+    def fresh_chunks() -> List[List[dict]]:
+        # The bulk transforms are given the bundles in batches of chunk bundles
+        copies = fresh_bundles()
+        return [copies[i * chunk : (i + 1) * chunk] for i in range(batches)]  # noqa
+
+    return [
+        run_benchmark(
+            "convert_batch_messages_to_list",
+            convert_batch_messages_to_list,
+            [generate_hl7_batch(messages // batches, seed + i) for i in range(batches)],
+            messages_per_item=messages // batches,
+        ),
+        run_benchmark("clean_message", clean_message, hl7_messages),
+        run_benchmark(
+            "standardize_patient_name", standardize_patient_name, fresh_bundles()
+        ),
+        run_benchmark(
+            "standardize_patient_phone", standardize_patient_phone, fresh_bundles()
+        ),
+        run_benchmark(
+            "standardize_patient_names",
+            standardize_patient_names,
+            fresh_chunks(),
+            messages_per_item=chunk,
+        ),
+        run_benchmark(
+            "standardize_patient_phones",
+            standardize_patient_phones,
+            fresh_chunks(),
+            messages_per_item=chunk,
+        ),
+        run_benchmark(
+            "add_patient_identifier",
+            lambda bundle: add_patient_identifier(bundle, salt),
+            fresh_bundles(),
+        ),
+        run_benchmark(
+            "geocode_patient_address",
+            lambda bundle: geocode_patient_address(bundle, geocoder),
+            fresh_bundles(),
+        ),
+        run_benchmark(
+            "enrich_patients",
+            lambda bundle: enrich_patients(bundle, transforms),
+            fresh_bundles(),
+        ),
+    ]
+
+
+# The metrics compared to a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "messages_per_sec": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_mb": False,
+}
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> bool:
+    """Print the change in each metric from a baseline, and return whether every
+    benchmark is within tolerance of it.  Metrics missing from the baseline, such
+    as those of older baselines, are skipped."""
+    baseline = {result["name"]: result for result in baseline}
+    ok = True
+    for result in results:
+        if result["name"] not in baseline:
+            continue
+        changes = []
+        regressed = []
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before = baseline[result["name"]].get(metric)
+            if not before:
+                continue
+            change = (result[metric] - before) / before
+            changes.append(f"{metric} {change:+.1%}")
+            if (-change if higher_is_better else change) > tolerance:
+                regressed.append(metric)
+        ok = ok and not regressed
+        print(
+            f"{result['name']:32} {', '.join(changes)}"
+            + (f"  REGRESSION in {', '.join(regressed)}" if regressed else "")
+        )
+    return ok
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--bundles", type=int, default=1000)
+    parser.add_argument("--patients", type=int, default=1, help="Patients per bundle")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the results as a JSON baseline")
+    parser.add_argument("--compare", help="Compare the results to a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.messages, args.bundles, args.patients, args.batches, args.seed
+    )
+
+    print(f"{'benchmark':32} {'msgs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+    for result in results:
+        print(
+            f"{result['name']:32} {result['messages_per_sec']:10.1f} "
+            + f"{result['p50_ms']:8.3f} {result['p99_ms']:8.3f} "
+            + f"{result['peak_mb']:8.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"python": sys.version, "results": results}, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            if not compare(results, json.load(baseline)["results"], args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
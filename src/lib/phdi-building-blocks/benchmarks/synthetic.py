@@ -0,0 +1,127 @@
+import random
+import uuid
+from typing import List
+
+FAMILY_NAMES = ["Smith", "johnson", "WILLIAMS", "Brown ", "jones", "Garcia", "Miller"]
+GIVEN_NAMES = ["John", " mary", "JAMES", "Patricia ", "robert", "Jennifer", "Michael"]
+STREETS = ["Main St", "Oak Ave", "Pine Rd", "Maple Dr", "Cedar Ln", "Elm St"]
+CITIES = [
+    ("Springfield", "IL", "62701"),
+    ("Madison", "WI", "53703"),
+    ("Albany", "NY", ""),
+]
+VACCINES = [("08", "HepB pediatric"), ("20", "DTaP"), ("208", "COVID-19 Pfizer")]
+TESTS = [("94500-6", "SARS-CoV-2 RNA"), ("2160-0", "Creatinine"), ("718-7", "Hgb")]
+
+
+def _phone(rng: random.Random) -> str:
+    return (
+        f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(0, 9999):04}"
+    )
+
+
+def generate_hl7_message(rng: random.Random, index: int, obx_count: int = 3) -> str:
+    """
+    Generate a synthetic HL7 v2 message, alternately a VXU_V04 and an ORU_R01 with
+    obx_count results.  Datetimes carry more precision than HL7 allows, so that
+    clean_message has work to do.
+    """
+    city, state, zipcode = rng.choice(CITIES)
+    timestamp = f"2022{rng.randint(1, 12):02}{rng.randint(1, 28):02}0930001234567"
+    pid = (
+        f"PID|1||{100000 + index}^^^FAC^MR||{rng.choice(FAMILY_NAMES)}^"
+        + f"{rng.choice(GIVEN_NAMES)}^Q^^^^L||19{rng.randint(40, 99)}0101000000000|"
+        + f"{rng.choice('MF')}|||{rng.randint(1, 9999)} {rng.choice(STREETS)}^^"
+        + f"{city}^{state}^{zipcode}^USA^H||^PRN^PH^^1^{_phone(rng)}"
+    )
+
+    if index % 2 == 0:
+        code, name = rng.choice(VACCINES)
+        segments = [
+            f"MSH|^~\\&|SYN|FAC||PH|{timestamp}||VXU^V04^VXU_V04|MSG{index}|P|2.5.1",
+            pid,
+            f"RXA|0|1|{timestamp}|{timestamp}|{code}^{name}^CVX|0.5|mL",
+        ]
+    else:
+        segments = [
+            f"MSH|^~\\&|SYN|FAC||PH|{timestamp}||ORU^R01^ORU_R01|MSG{index}|P|2.5.1",
+            pid,
+            f"OBR|1|ORD{index}|FIL{index}|{TESTS[0][0]}^{TESTS[0][1]}^LN|||{timestamp}",
+        ]
+        for i in range(obx_count):
+            code, name = rng.choice(TESTS)
+            segments.append(
+                f"OBX|{i + 1}|NM|{code}^{name}^LN||{rng.uniform(0, 10):.2f}|mg/dL"
+                + f"||||||F|||{timestamp}"
+            )
+    return "\n".join(segments)
+
+
+def generate_hl7_batch(messages: int, seed: int = 0) -> str:
+    """Generate a synthetic HL7 v2 batch file with the given number of messages,
+    framed with batch headers and trailers"""
+    rng = random.Random(seed)
+    lines = [
+        "FHS|^~\\&|SYN|FAC|||20220101||batch.hl7",
+        "BHS|^~\\&|SYN|FAC|||20220101",
+    ]
+    lines += [generate_hl7_message(rng, i) for i in range(messages)]
+    lines += [f"BTS|{messages}|", "FTS|1|"]
+    return "\r\n".join(lines)
+
+
+def generate_patient_bundle(rng: random.Random, patients: int = 1) -> dict:
+    """Generate a synthetic FHIR bundle with the given number of Patient resources,
+    each followed by an Observation about them"""
+    entries = []
+    for _ in range(patients):
+        city, state, zipcode = rng.choice(CITIES)
+        patient_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        entries.append(
+            {
+                "resource": {
+                    "resourceType": "Patient",
+                    "id": patient_id,
+                    "name": [
+                        {
+                            "family": rng.choice(FAMILY_NAMES),
+                            "given": [rng.choice(GIVEN_NAMES), "Q1"],
+                            "use": "official",
+                        }
+                    ],
+                    "birthDate": f"19{rng.randint(40, 99)}-01-01",
+                    "address": [
+                        {
+                            "line": [f"{rng.randint(1, 9999)} {rng.choice(STREETS)}"],
+                            "city": city,
+                            "state": state,
+                            "postalCode": zipcode,
+                            "country": "USA",
+                            "use": "home",
+                        }
+                    ],
+                    "telecom": [
+                        {"system": "phone", "value": _phone(rng), "use": "home"},
+                        {"system": "email", "value": "someone@example.com"},
+                    ],
+                }
+            }
+        )
+        entries.append(
+            {
+                "resource": {
+                    "resourceType": "Observation",
+                    "status": "final",
+                    "subject": {"reference": f"Patient/{patient_id}"},
+                }
+            }
+        )
+    return {"resourceType": "Bundle", "type": "batch", "entry": entries}
+
+
+def generate_patient_bundles(
+    bundles: int, patients: int = 1, seed: int = 0
+) -> List[dict]:
+    """Generate the given number of synthetic FHIR bundles"""
+    rng = random.Random(seed)
+    return [generate_patient_bundle(rng, patients) for _ in range(bundles)]
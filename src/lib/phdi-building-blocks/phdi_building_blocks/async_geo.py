@@ -0,0 +1,191 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+from typing import List, Optional, Union
+
+from smartystreets_python_sdk import Batch, us_street
+from smartystreets_python_sdk.exceptions import (
+    BadGatewayError,
+    GatewayTimeoutError,
+    InternalServerError,
+    RequestTimeoutError,
+    ServiceUnavailableError,
+    TooManyRequestsError,
+)
+
+from phdi_building_blocks.geo import (
+    GeocodeCache,
+    GeocodeRecord,
+    GeocodeResult,
+    Geocoder,
+    PatientAddresses,
+    geocode,
+    geocode_records,
+)
+
+# Errors that are worth retrying, as the same request may succeed later
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    BadGatewayError,
+    GatewayTimeoutError,
+    InternalServerError,
+    RequestTimeoutError,
+    ServiceUnavailableError,
+    TooManyRequestsError,
+)
+
+
+class TokenBucket:
+    """
+    An asyncio rate limiter that allows rate requests per second on average, and
+    bursts of up to capacity requests.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: The number of tokens added to the bucket per second
+        :param capacity: The most tokens the bucket can hold, defaults to rate
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, and take it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncGeocoder:
+    """
+    Geocodes addresses concurrently with asyncio, while staying within the
+    SmartyStreets plan's rate limit.  The SmartyStreets SDK is synchronous, so each
+    request is sent from a worker thread.
+
+    At most max_concurrency requests are in flight at once, and requests are
+    started at no more than rate per second.  Requests that time out, are
+    throttled or fail with a server error are retried up to retries times, after
+    an exponential backoff with full jitter.  A worker thread can't be stopped, so
+    a request that times out keeps its place among the max_concurrency in flight
+    until its thread actually finishes.
+    """
+
+    def __init__(
+        self,
+        client: Union[us_street.Client, Geocoder],
+        max_concurrency: int = 10,
+        rate: float = 10.0,
+        burst: float = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+    ):
+        """Async geocoder constructor
+
+        :param client: A SmartyStreets client, or a Geocoder
+        :param max_concurrency: The most requests to have in flight at once
+        :param rate: The most requests to start per second, on average
+        :param burst: The most requests to start at once, defaults to rate
+        :param retries: The number of times to retry a failed request
+        :param backoff: The base delay, in seconds, between retries
+        :param timeout: The number of seconds to wait for each request
+        """
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._semaphores = {}
+
+    async def geocode(self, address: str) -> Optional[GeocodeResult]:
+        """Geocode a single address, as geocode does"""
+        return await self._call(geocode, self.client, address)
+
+    async def geocode_batch(
+        self, addresses: List[str]
+    ) -> List[Optional[GeocodeResult]]:
+        """Geocode a list of addresses, as geocode_batch does, sending up to
+        max_concurrency batches of 100 lookups at once"""
+        records = await self.geocode_records(addresses)
+        return [record.to_model() if record else None for record in records]
+
+    async def geocode_records(
+        self, addresses: List[str]
+    ) -> List[Optional[GeocodeRecord]]:
+        """Geocode a list of addresses as geocode_batch does, returning a
+        GeocodeRecord for each address, as geocode_records does"""
+        chunks = [
+            addresses[start : start + Batch.MAX_BATCH_SIZE]  # noqa: E203
+            for start in range(0, len(addresses), Batch.MAX_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *[self._call(geocode_records, self.client, chunk) for chunk in chunks]
+        )
+        return [result for chunk in results for result in chunk]
+
+    async def geocode_patient_addresses(
+        self, bundles: List[dict], cache: GeocodeCache = None
+    ) -> List[dict]:
+        """Geocode all patient addresses in all of the bundles, as
+        geocode_patient_addresses does, sending the lookups concurrently"""
+        addresses = PatientAddresses(bundles, cache)
+        addresses.update(await self.geocode_records(list(addresses.misses.values())))
+        return bundles
+
+    async def _call(self, function, *args):
+        """Call a blocking geocoding function from a worker thread, within the
+        concurrency and rate limits, retrying errors that may be transient"""
+        semaphore = self._semaphore()
+        for attempt in range(self.retries + 1):
+            await semaphore.acquire()
+            try:
+                await self.bucket.acquire()
+                request = asyncio.ensure_future(asyncio.to_thread(function, *args))
+            except BaseException:
+                semaphore.release()
+                raise
+            request.add_done_callback(
+                functools.partial(_release_request, semaphore=semaphore)
+            )
+            try:
+                # Shielded, so that timing out stops waiting for the request
+                # without releasing its slot before the thread finishes
+                return await asyncio.wait_for(asyncio.shield(request), self.timeout)
+            except RETRYABLE_ERRORS as error:
+                if attempt == self.retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2**attempt)
+                logging.warning(
+                    f"Geocoding request failed ({type(error).__name__}), "
+                    + f"retrying in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Semaphores belong to an event loop, so keep one per running loop
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores = {loop: asyncio.Semaphore(self.max_concurrency)}
+        return self._semaphores[loop]
+
+
+def _release_request(request: asyncio.Future, semaphore: asyncio.Semaphore) -> None:
+    """Free a request's concurrency slot once its thread has finished"""
+    semaphore.release()
+    if not request.cancelled():
+        # Retrieve the error of an abandoned request, so it isn't reported as
+        # never retrieved
+        request.exception()
@@ -4,9 +4,10 @@ from azure.identity import DefaultAzureCredential
 from azure.storage.blob import ContainerClient
 
 
-def get_blob_client(container_url: str) -> ContainerClient:
-    """Use whatever creds Azure can find to authenticate with the storage container"""
-    creds = DefaultAzureCredential()
+def get_blob_client(container_url: str, credential=None) -> ContainerClient:
+    """Use whatever creds Azure can find to authenticate with the storage container.
+    An existing credential may be passed in to skip credential discovery."""
+    creds = credential if credential is not None else DefaultAzureCredential()
     return ContainerClient.from_container_url(container_url, credential=creds)
 
 
@@ -17,12 +18,15 @@ def store_data(
     bundle_type: str,
     message_json: dict = None,
     message: str = None,
+    client: ContainerClient = None,
 ) -> None:
     """
     Store the given data, which is either a FHIR bundle or an HL7 message in the
-    appropriate output container
+    appropriate output container.  If a container client is provided it is reused,
+    otherwise a new one is built for container_url.
     """
-    client = get_blob_client(container_url)
+    if client is None:
+        client = get_blob_client(container_url)
     blob = client.get_blob_client(str(pathlib.Path(prefix) / bundle_type / filename))
     if message_json is not None:
         blob.upload_blob(json.dumps(message_json).encode("utf-8"), overwrite=True)
@@ -0,0 +1,238 @@
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContainerClient
+
+
+class CacheStats:
+    """Hit and miss counters for a cache"""
+
+    def __init__(self, hits: int = 0, misses: int = 0):
+        self.hits = hits
+        self.misses = misses
+        self._lock = threading.Lock()
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups that were hits, or 0 if there were none"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def dict(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+def _expiry(ttl: Optional[float]) -> Optional[float]:
+    return time.time() + ttl if ttl is not None else None
+
+
+def _expired(expires: Optional[float]) -> bool:
+    return expires is not None and expires <= time.time()
+
+
+def _value(entry: Optional[Tuple[Any, Optional[float]]]) -> Optional[Any]:
+    return entry[0] if entry is not None else None
+
+
+class LRUCache:
+    """
+    A thread-safe in-memory cache that evicts the least recently used entry once
+    it holds max_size entries.  Entries expire ttl seconds after they are set, or
+    never if ttl is None.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get the value stored for a key, or None if it is missing or expired"""
+        return _value(self.get_entry(key))
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """Get the value stored for a key and the time it expires, or None if it is
+        missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and _expired(entry[0]):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        self.stats.record(entry is not None)
+        return (entry[1], entry[0]) if entry is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value for a key, expiring after ttl seconds if given, and
+        otherwise after the cache's ttl"""
+        with self._lock:
+            self._entries[key] = (_expiry(ttl if ttl is not None else self.ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteCache:
+    """
+    A cache of string values persisted to a local SQLite database, so cached
+    values survive restarts of the process.  Entries expire ttl seconds after they
+    are set, or never if ttl is None.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                + "(key TEXT PRIMARY KEY, expires REAL, value TEXT)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the value stored for a key, or None if it is missing or expired"""
+        return _value(self.get_entry(key))
+
+    def get_entry(self, key: str) -> Optional[Tuple[str, Optional[float]]]:
+        """Get the value stored for a key and the time it expires, or None if it is
+        missing or expired"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT expires, value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and _expired(row[0]):
+                with self._connection:
+                    self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                row = None
+        self.stats.record(row is not None)
+        return (row[1], row[0]) if row is not None else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        """Store a value for a key, expiring after ttl seconds if given, and
+        otherwise after the cache's ttl"""
+        expires = _expiry(ttl if ttl is not None else self.ttl)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)",
+                (key, expires, value),
+            )
+
+
+class BlobCache:
+    """
+    A cache of string values persisted as blobs under a prefix of a storage
+    container, so cached values are shared by every instance of a function app.
+    Entries expire ttl seconds after they are set, or never if ttl is None.
+    """
+
+    def __init__(
+        self, client: ContainerClient, prefix: str, ttl: Optional[float] = None
+    ):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the value stored for a key, or None if it is missing or expired.
+        Errors reading the blob are logged and treated as a miss, as the value can
+        always be looked up again."""
+        return _value(self.get_entry(key))
+
+    def get_entry(self, key: str) -> Optional[Tuple[str, Optional[float]]]:
+        """Get the value stored for a key and the time it expires, or None if it is
+        missing, expired or can't be read"""
+        entry = None
+        try:
+            blob = self.client.download_blob(self._blob_name(key))
+            entry = json.loads(blob.readall())
+            if _expired(entry["expires"]):
+                entry = None
+        except ResourceNotFoundError:
+            pass
+        except Exception:
+            logging.exception(f"Failed to read cached value for {key}")
+            entry = None
+        self.stats.record(entry is not None)
+        return (entry["value"], entry["expires"]) if entry is not None else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        """Store a value for a key, expiring after ttl seconds if given, and
+        otherwise after the cache's ttl"""
+        entry = {"expires": _expiry(ttl if ttl is not None else self.ttl)}
+        entry["value"] = value
+        self.client.upload_blob(
+            self._blob_name(key), json.dumps(entry).encode("utf-8"), overwrite=True
+        )
+
+    def _blob_name(self, key: str) -> str:
+        return str(pathlib.PurePosixPath(self.prefix) / key)
+
+
+class TieredCache:
+    """
+    A cache made of tiers that are checked in order, typically a small, fast
+    LRUCache in front of a larger persistent cache.  A value found in a later tier
+    is copied into the earlier tiers, to expire no later than it does in the tier
+    it was found in, and values are set in every tier.  The stats count a lookup
+    as a hit if any tier had the value.
+    """
+
+    def __init__(self, *tiers):
+        self.tiers = tiers
+        self.stats = CacheStats()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get the value stored for a key in the first tier that has it"""
+        return _value(self.get_entry(key))
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """Get the value stored for a key in the first tier that has it and the
+        time it expires there, or None if no tier has it"""
+        entry = None
+        for i, tier in enumerate(self.tiers):
+            entry = tier.get_entry(key)
+            if entry is not None:
+                value, expires = entry
+                for earlier in self.tiers[:i]:
+                    earlier.set(key, value, _remaining_ttl(expires, earlier))
+                break
+        self.stats.record(entry is not None)
+        return entry
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value for a key in every tier"""
+        for tier in self.tiers:
+            tier.set(key, value, ttl)
+
+
+def _remaining_ttl(expires: Optional[float], tier) -> Optional[float]:
+    """The ttl to copy a value into a tier with: the time left before it expires,
+    or the tier's own ttl if that is shorter"""
+    ttl = getattr(tier, "ttl", None)
+    if expires is None:
+        return ttl
+    remaining = max(expires - time.time(), 0.0)
+    return remaining if ttl is None else min(remaining, ttl)
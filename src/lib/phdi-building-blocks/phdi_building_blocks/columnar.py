@@ -0,0 +1,273 @@
+import hashlib
+import logging
+import os
+import pathlib
+import re
+from typing import Any, Dict, Iterable, List, NamedTuple
+
+from phdi_building_blocks.fhir import download_from_export_response
+from phdi_building_blocks.utils import batched
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+    pq = None
+
+# The number of rows buffered before they are written as a record batch
+PARQUET_BATCH_SIZE = 10000
+
+_WHERE_REGEX = re.compile(r"^where\((\w+)\s*=\s*'([^']*)'\)$")
+_INDEX_REGEX = re.compile(r"^(\w+)\[(\d+)\]$")
+
+
+class Column(NamedTuple):
+    """
+    A column of flattened resources: its name, a FHIRPath-like path to its value in
+    a resource, and its type, one of "string", "integer", "decimal" or "boolean".
+
+    Paths are dot-separated steps, each of which is a field name (which steps into
+    every element of a list), a field name with an index such as `given[0]`,
+    `where(field='value')` to keep only the elements with a field equal to a value,
+    or `first()`.  When a path selects several values, the column holds the first.
+    """
+
+    name: str
+    path: str
+    type: str = "string"
+
+
+# The columns written for each resource type by default
+DEFAULT_COLUMNS = {
+    "Patient": [
+        Column("id", "id"),
+        Column("family_name", "name.where(use='official').family"),
+        Column("given_name", "name.where(use='official').given[0]"),
+        Column("birth_date", "birthDate"),
+        Column("gender", "gender"),
+        Column("address_line", "address.where(use='home').line[0]"),
+        Column("city", "address.where(use='home').city"),
+        Column("state", "address.where(use='home').state"),
+        Column("postal_code", "address.where(use='home').postalCode"),
+        Column(
+            "latitude",
+            "address.extension.extension.where(url='latitude').valueDecimal",
+            "decimal",
+        ),
+        Column(
+            "longitude",
+            "address.extension.extension.where(url='longitude').valueDecimal",
+            "decimal",
+        ),
+        Column("phone", "telecom.where(system='phone').value"),
+    ],
+    "Observation": [
+        Column("id", "id"),
+        Column("patient", "subject.reference"),
+        Column("status", "status"),
+        Column("code_system", "code.coding.system"),
+        Column("code", "code.coding.code"),
+        Column("code_display", "code.coding.display"),
+        Column("effective", "effectiveDateTime"),
+        Column("value_quantity", "valueQuantity.value", "decimal"),
+        Column("value_unit", "valueQuantity.unit"),
+        Column("value_string", "valueString"),
+        Column("value_code", "valueCodeableConcept.coding.code"),
+    ],
+    "Immunization": [
+        Column("id", "id"),
+        Column("patient", "patient.reference"),
+        Column("status", "status"),
+        Column("vaccine_system", "vaccineCode.coding.system"),
+        Column("vaccine_code", "vaccineCode.coding.code"),
+        Column("vaccine_display", "vaccineCode.coding.display"),
+        Column("occurrence", "occurrenceDateTime"),
+        Column("primary_source", "primarySource", "boolean"),
+    ],
+}
+
+
+def evaluate_path(resource: dict, path: str) -> List[Any]:
+    """
+    Get the values a FHIRPath-like column path selects from a resource.
+
+    >>> patient = {"name": [{"use": "usual", "given": ["Johnny"]},
+    ...     {"use": "official", "given": ["John", "Q"], "family": "Doe"}]}
+    >>> evaluate_path(patient, "name.given")
+    ['Johnny', 'John', 'Q']
+    >>> evaluate_path(patient, "name.where(use='official').given[0]")
+    ['John']
+    >>> evaluate_path(patient, "name.family.first()")
+    ['Doe']
+
+    :param resource: The resource, as a dictionary
+    :param path: The path, as described for Column
+    :return: The selected values, in document order
+    """
+    values = [resource]
+    for step in path.split("."):
+        where = _WHERE_REGEX.match(step)
+        index = _INDEX_REGEX.match(step)
+        if step == "first()":
+            values = values[:1]
+        elif where:
+            field, expected = where.groups()
+            values = [
+                v for v in values if isinstance(v, dict) and v.get(field) == expected
+            ]
+        else:
+            field, position = (
+                (index.group(1), int(index.group(2))) if index else (step, None)
+            )
+            selected = []
+            for value in values:
+                child = value.get(field) if isinstance(value, dict) else None
+                if child is None:
+                    continue
+                if isinstance(child, list):
+                    if position is None:
+                        selected.extend(child)
+                    elif position < len(child):
+                        selected.append(child[position])
+                elif position in (None, 0):
+                    selected.append(child)
+            values = selected
+    return values
+
+
+def flatten_resource(resource: dict, columns: List[Column]) -> Dict[str, Any]:
+    """
+    Flatten a resource into a row with a value for each column, or None where the
+    column's path selects nothing.
+
+    >>> flatten_resource({"id": "1", "active": True},
+    ...     [Column("id", "id"), Column("active", "active", "boolean")])
+    {'id': '1', 'active': True}
+    """
+    row = {}
+    for column in columns:
+        values = evaluate_path(resource, column.path)
+        row[column.name] = _convert(values[0], column.type) if values else None
+    return row
+
+
+def _convert(value: Any, type: str) -> Any:
+    if type == "string":
+        return value if isinstance(value, str) else str(value)
+    if type == "integer":
+        return int(value)
+    if type == "decimal":
+        return float(value)
+    if type == "boolean":
+        return value if isinstance(value, bool) else str(value).lower() == "true"
+    raise ValueError(f"Unsupported column type {type}")
+
+
+def _arrow_schema(columns: List[Column]):
+    types = {
+        "string": pa.string(),
+        "integer": pa.int64(),
+        "decimal": pa.float64(),
+        "boolean": pa.bool_(),
+    }
+    return pa.schema([(column.name, types[column.type]) for column in columns])
+
+
+def write_parquet(
+    resources: Iterable[dict],
+    columns: List[Column],
+    path: str,
+    batch_size: int = PARQUET_BATCH_SIZE,
+) -> int:
+    """
+    Flatten resources into a Parquet file, writing a record batch for every
+    batch_size resources so that only one batch is held in memory at a time.  The
+    file is written under a temporary name, beginning with an underscore so that
+    Parquet dataset readers ignore it, and moved into place once it is complete, so
+    a file at path is always whole.
+
+    :param resources: The resources to flatten
+    :param columns: The columns to flatten them into
+    :param path: The path of the Parquet file
+    :param batch_size: The number of rows in each record batch
+    :return: The number of rows written
+    """
+    _require_pyarrow()
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f"_{path.name}.partial")
+    schema = _arrow_schema(columns)
+
+    rows = 0
+    with pq.ParquetWriter(partial, schema) as writer:
+        for batch in batched(resources, batch_size):
+            records = [flatten_resource(resource, columns) for resource in batch]
+            writer.write_batch(pa.RecordBatch.from_pylist(records, schema=schema))
+            rows += len(records)
+    os.replace(partial, path)
+    return rows
+
+
+def export_to_parquet(
+    export_response: dict,
+    output_path: str,
+    columns: Dict[str, List[Column]] = None,
+    batch_size: int = PARQUET_BATCH_SIZE,
+    credential=None,
+) -> List[pathlib.Path]:
+    """
+    Flatten the files of a FHIR export into Parquet files, partitioned by resource
+    type: the nth file of the export is written to
+    `{output_path}/resource_type={type}/part-{n}-{hash}.parquet`, where the hash
+    is of the export file's URL.  Each export file is streamed, as
+    download_from_export_response does, so memory use is bounded by the batch size
+    rather than the size of the export.
+
+    The stage is restartable per file: files that have already been written are
+    skipped without being downloaded again, and a file interrupted part way
+    through is written again from the start.  As the file names are specific to
+    the export, files written from another export to the same directory are never
+    mistaken for this one's.
+
+    :param export_response: export response JSON
+    :param output_path: The directory the partitions are written under
+    :param columns: The columns to write for each resource type, defaults to
+    DEFAULT_COLUMNS.  Files of other resource types are skipped.
+    :param batch_size: The number of rows in each record batch
+    :param credential: The credential used to read the export files
+    :return: The paths of the Parquet files written on this run
+    """
+    _require_pyarrow()
+    columns = columns or DEFAULT_COLUMNS
+    written = []
+    files = download_from_export_response(
+        export_response, stream=True, credential=credential
+    )
+    # Files are only downloaded as their resources are read, so skipped files
+    # aren't downloaded at all
+    outputs = zip(export_response.get("output", []), files)
+    for n, (export_entry, (resource_type, resources)) in enumerate(outputs):
+        if resource_type not in columns:
+            continue
+        url_hash = hashlib.sha256(export_entry.get("url", "").encode("utf-8"))
+        path = (
+            pathlib.Path(output_path)
+            / f"resource_type={resource_type}"
+            / f"part-{n:05d}-{url_hash.hexdigest()[:16]}.parquet"
+        )
+        if path.exists():
+            logging.info(f"Skipping {path}, which has already been written")
+            continue
+        rows = write_parquet(resources, columns[resource_type], path, batch_size)
+        logging.info(f"Wrote {rows} {resource_type} rows to {path}")
+        written.append(path)
+    return written
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError(
+            "Writing Parquet requires pyarrow, which is installed with the parquet "
+            + "extra: poetry install -E parquet"
+        )
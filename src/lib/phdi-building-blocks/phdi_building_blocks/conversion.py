@@ -1,66 +1,102 @@
+import codecs
+import hashlib
+import json
 import logging
 import re
-import requests
-import hl7
-from typing import List, Dict
+from typing import BinaryIO, Dict, Iterable, Iterator, List
+
+from phdi_building_blocks.cache import LRUCache
+from phdi_building_blocks.fhir import FhirClient, get_fhir_client
+
+# Batch header and trailer segments, which never belong to an individual message
+BATCH_FRAMING_SEGMENTS = ("FHS", "BHS", "BTS", "FTS")
+
+# Maps the vertical tab and file separator characters to None, for use with
+# str.translate when stripping them from batch content
+_BATCH_FRAMING_CHARS = {0x0B: None, 0x1C: None}
+
+_NEWLINES_REGEX = re.compile("[\r\n]+")
+
+_HL7_DATETIME_REGEX = re.compile(r"(\d{8}\d*)(\.\d+)?([+-]\d+)?")
+
+# The datetime fields normalized by clean_message, by segment, numbered as in the
+# HL7 specification
+HL7_DATETIME_FIELDS = {
+    # MSH-7 - Message date/time
+    "MSH": (7,),
+    # PID-7 - Date of Birth
+    # PID-29 - Date of Death
+    # PID-33 - Last update date/time
+    "PID": (7, 29, 33),
+    # PV1-44 - Admisstion Date
+    # PV1-45 - Discharge Date
+    "PV1": (44, 45),
+    # ORC-9 Date/time of transaction
+    # ORC-15 Order effective date/time
+    # ORC-27 Filler's expected availability date/time
+    "ORC": (9, 15, 27),
+    # OBR-7 Observation date/time
+    # OBR-8 Observation end date/time
+    # OBR-22 Status change date/time
+    # OBR-36 Scheduled date/time
+    "OBR": (7, 8, 22, 36),
+    # OBX-12 Effective date/time of reference range
+    # OBX-14 Date/time of observation
+    # OBX-19 Date/time of analysis
+    "OBX": (12, 14, 19),
+    # TQ1-7 Start date/time
+    # TQ1-8 End date/time
+    "TQ1": (7, 8),
+    # SPM-18 Specimen received date/time
+    # SPM-19 Specimen expiration date/time
+    "SPM": (18, 19),
+    # RXA-3 Date/time start of administration
+    # RXA-4 Date/time end of administration
+    # RXA-16 Substance expiration date
+    # RXA-22 System entry date/time
+    "RXA": (3, 4, 16, 22),
+}
+
+# HL7_DATETIME_FIELDS as indexes into a segment split on the field separator.  The
+# field separator is itself MSH-1, so MSH fields are shifted by one.
+_DATETIME_FIELD_INDEXES = {
+    segment_id: tuple(f - 1 if segment_id == "MSH" else f for f in fields)
+    for segment_id, fields in HL7_DATETIME_FIELDS.items()
+}
 
 
 def clean_message(message: str) -> str:
     """Prepare a message for conversion by adjusting problematic fields
     to conform to Azure's expectations.
-    * Convert segment terminators from \n to \r
     * Normalize datetime fields
-    * Convert segment terminators back from \r to \n
+    * Terminate every segment with \n
+
+    The message is cleaned in a single pass over its segments, working directly on
+    the delimited text.  Only the segments and fields listed in
+    HL7_DATETIME_FIELDS are split into fields and normalized.
     """
-    parsed_message = ""
     try:
-        # Conversion from \n to \r EOL characters is needed for hl7
-        # module, and doesn't hurt the Azure converter
-        parsed_message = hl7.parse(message.replace("\n", "\r"))
-
-        # Normalize Dates
-        # MSH-7 - Message date/time
-        normalize_hl7_datetime_segment(parsed_message, "MSH", [7])
-
-        # PID-7 - Date of Birth
-        # PID-29 - Date of Death
-        # PID-33 - Last update date/time
-        normalize_hl7_datetime_segment(parsed_message, "PID", [7, 29, 33])
-
-        # PV1-44 - Admisstion Date
-        # PV1-45 - Discharge Date
-        normalize_hl7_datetime_segment(parsed_message, "PV1", [44, 45])
-
-        # ORC-9 Date/time of transaction
-        # ORC-15 Order effective date/time
-        # ORC-27 Filler's expected availability date/time
-        normalize_hl7_datetime_segment(parsed_message, "ORC", [9, 15, 27])
-
-        # OBR-7 Observation date/time
-        # OBR-8 Observation end date/time
-        # OBR-22 Status change date/time
-        # OBR-36 Scheduled date/time
-        normalize_hl7_datetime_segment(parsed_message, "OBR", [7, 8, 22, 36])
-
-        # OBX-12 Effective date/time of reference range
-        # OBX-14 Date/time of observation
-        # OBX-19 Date/time of analysis
-        normalize_hl7_datetime_segment(parsed_message, "OBX", [12, 14, 19])
-
-        # TQ1-7 Start date/time
-        # TQ1-8 End date/time
-        normalize_hl7_datetime_segment(parsed_message, "TQ1", [7, 8])
-
-        # SPM-18 Specimen received date/time
-        # SPM-19 Specimen expiration date/time
-        normalize_hl7_datetime_segment(parsed_message, "SPM", [18, 19])
-
-        # RXA-3 Date/time start of administration
-        # RXA-4 Date/time end of administration
-        # RXA-16 Substance expiration date
-        # RXA-22 System entry date/time
-        normalize_hl7_datetime_segment(parsed_message, "RXA", [3, 4, 16, 22])
-
+        segments = [s for s in _NEWLINES_REGEX.split(message) if s]
+        if not segments or not segments[0].startswith("MSH"):
+            raise ValueError("Message does not start with an MSH segment")
+
+        # MSH-1 and MSH-2 declare the field separator and encoding characters
+        field_separator = segments[0][3]
+        repetition_separator = segments[0][5]
+        component_separators = {segments[0][4], segments[0][7]}
+
+        for i, segment in enumerate(segments):
+            field_indexes = _DATETIME_FIELD_INDEXES.get(segment[:3])
+            if not field_indexes:
+                continue
+            fields = segment.split(field_separator)
+            for index in field_indexes:
+                if index < len(fields) and fields[index]:
+                    fields[index] = repetition_separator.join(
+                        _normalize_hl7_datetime_field(repetition, component_separators)
+                        for repetition in fields[index].split(repetition_separator)
+                    )
+            segments[i] = field_separator.join(fields)
     except Exception:
         logging.exception(
             "Exception occurred while cleaning message.  "
@@ -69,7 +105,16 @@ def clean_message(message: str) -> str:
 
         return message
 
-    return str(parsed_message).replace("\r", "\n")
+    return "\n".join(segments) + "\n"
+
+
+def _normalize_hl7_datetime_field(field: str, component_separators: set) -> str:
+    """Normalize the datetime in the first component of a field (or repetition of
+    a field), and keep any other components as they are."""
+    for end, char in enumerate(field):
+        if char in component_separators:
+            return normalize_hl7_datetime(field[:end]) + field[end:]
+    return normalize_hl7_datetime(field)
 
 
 def normalize_hl7_datetime_segment(message: list, segment_id: str, field_list: list):
@@ -94,7 +139,7 @@ def normalize_hl7_datetime(hl7_datetime: str) -> str:
     following decimal point: max 4 digits
     following +/- (timezone): 4 digits
     """
-    hl7_datetime_match = re.match(r"(\d{8}\d*)(\.\d+)?([+-]\d+)?", hl7_datetime)
+    hl7_datetime_match = _HL7_DATETIME_REGEX.match(hl7_datetime)
 
     if not hl7_datetime_match:
         return hl7_datetime
@@ -158,41 +203,100 @@ def convert_batch_messages_to_list(content: str, delimiter: str = "\n") -> List[
     """
 
     cleaned_batch = clean_batch(content)
-    message_lines = cleaned_batch.split(delimiter)
-    next_message = ""
-    output = []
+    return list(_group_batch_lines(cleaned_batch.split(delimiter)))
 
-    for line in message_lines:
-        if line.startswith("FHS"):
-            continue
-        if line.startswith("BHS"):
-            continue
-        if line.startswith("BTS"):
-            continue
-        if line.startswith("FTS"):
+
+def stream_batch_messages(
+    stream: BinaryIO, chunk_size: int = 1024 * 1024, encoding: str = "utf-8"
+) -> Iterator[str]:
+    """
+    Incrementally split a batch file read from a binary file-like object (such as
+    the blob passed to an Azure function) into individual messages.
+
+    Messages are identical to those produced by convert_batch_messages_to_list, but
+    the content is read chunk_size bytes at a time and each message is yielded as
+    soon as the MSH segment of the following message has been read. Peak memory is
+    therefore bounded by the largest single message rather than the whole batch.
+    CR/LF/VT/FS framing is handled across chunk boundaries, and undecodable bytes
+    are ignored.
+
+    :param stream: A binary file-like object exposing a read(size) method
+    :param chunk_size: The number of bytes to read from the stream at a time
+    :param encoding: The encoding used to decode the stream content
+    """
+    lines = _strip_batch_lines(_read_batch_lines(stream, chunk_size, encoding))
+    yield from _group_batch_lines(lines)
+
+
+def _read_batch_lines(
+    stream: BinaryIO, chunk_size: int, encoding: str
+) -> Iterator[str]:
+    """Read a binary stream in chunks, yielding lines with CR/LF delimiters and
+    VT/FS characters removed. A partial line at the end of a chunk is held back
+    until the rest of it has been read."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="ignore")
+    remainder = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        text = decoder.decode(chunk, final=not chunk)
+        lines = _NEWLINES_REGEX.split(remainder + text.translate(_BATCH_FRAMING_CHARS))
+        if not chunk:
+            yield from lines
+            return
+        remainder = lines.pop()
+        yield from lines
+
+
+def _strip_batch_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Apply the equivalent of clean_batch's final strip() to a stream of lines,
+    dropping leading and trailing whitespace of the batch as a whole."""
+    started = False
+    # The most recent line with content, followed by any whitespace-only lines
+    # after it. They are only released once we know they aren't the batch's end.
+    held = []
+    for line in lines:
+        if not started:
+            line = line.lstrip()
+            if not line:
+                continue
+            started = True
+        if line.strip():
+            yield from held
+            held = [line]
+        else:
+            held.append(line)
+
+    if held:
+        yield held[0].rstrip()
+
+
+def _group_batch_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Group the lines of a cleaned batch into individual messages, skipping batch
+    headers and trailers. Each segment is terminated with \\r."""
+    message_lines = []
+
+    for line in lines:
+        if line.startswith(BATCH_FRAMING_SEGMENTS):
             continue
 
         # If we reach a line that starts with MSH and we have
-        # content in nextMessage, then by definition we have
-        # a full message in next_message and need to append it
-        # to output. This will not trigger the first time we
-        # see a line with MSH since next_message will be empty
-        # at that time.
-        if next_message != "" and line.startswith("MSH"):
-            output.append(next_message)
-            next_message = ""
-
-        # Otherwise, continue to add the line of text to next_message
+        # content in message_lines, then by definition we have
+        # a full message and need to yield it. This will not
+        # trigger the first time we see a line with MSH since
+        # message_lines will be empty at that time.
+        if message_lines and line.startswith("MSH"):
+            yield "".join(message_lines)
+            message_lines = []
+
+        # Otherwise, continue to add the line of text to the message
         if line != "":
-            next_message += f"{line}\r"
+            message_lines.append(f"{line}\r")
 
-    # Since our loop only adds messages to output when it finds
-    # a line that starts with MSH, the last message would never
-    # be added. So we explicitly add it here.
-    if next_message != "":
-        output.append(next_message)
-
-    return output
+    # Since our loop only yields messages when it finds a line
+    # that starts with MSH, the last message would never be
+    # yielded. So we explicitly yield it here.
+    if message_lines:
+        yield "".join(message_lines)
 
 
 def get_file_type_mappings(blob_name: str) -> Dict[str, str]:
@@ -237,6 +341,7 @@ def convert_message_to_fhir(
     template_collection: str,
     access_token: str,
     fhir_url: str,
+    client: FhirClient = None,
 ) -> dict:
     """
     Given a message in either HL7 v2 (pipe-delimited flat file) or HL7 v3 (XML),
@@ -261,7 +366,10 @@ def convert_message_to_fhir(
     https://docs.microsoft.com/en-us/azure/healthcare-apis/azure-api-for-fhir/convert-data
     :param access_token A Bearer token used to authenticate with the FHIR server
     :param fhir_url A URL that points to the location of the FHIR server
+    :param client The client used to make the request, defaults to the shared
+    client from get_fhir_client
     """
+    client = client or get_fhir_client()
     if input_data_type == "Hl7v2":
         message = clean_message(message)
 
@@ -275,7 +383,7 @@ def convert_message_to_fhir(
             {"name": "rootTemplate", "valueString": root_template},
         ],
     }
-    response = requests.post(
+    response = client.post(
         url=url, json=data, headers={"Authorization": f"Bearer {access_token}"}
     )
 
@@ -293,3 +401,115 @@ def convert_message_to_fhir(
         return error_info
 
     return response.json()
+
+
+class FhirConverter:
+    """
+    Interface for converters that turn an HL7 v2 or HL7 v3 message into a FHIR
+    bundle.  Implementations return the converted bundle on success, and otherwise
+    a dictionary describing the error, as convert_message_to_fhir does.
+    """
+
+    def convert(
+        self,
+        message: str,
+        filename: str,
+        input_data_type: str,
+        root_template: str,
+        template_collection: str,
+    ) -> dict:
+        """Convert a message to FHIR.  Parameters are described in
+        convert_message_to_fhir."""
+        raise NotImplementedError
+
+
+class RemoteFhirConverter(FhirConverter):
+    """Converts messages with the FHIR server's $convert-data endpoint, using
+    convert_message_to_fhir."""
+
+    def __init__(self, cred_manager, fhir_url: str, client: FhirClient = None):
+        """Remote converter constructor
+
+        :param cred_manager: Credential manager used to get a FHIR server access
+        token for each conversion
+        :param fhir_url: A URL that points to the location of the FHIR server
+        :param client: The client used to make requests, defaults to the shared
+        client from get_fhir_client
+        """
+        self.cred_manager = cred_manager
+        self.fhir_url = fhir_url
+        self.client = client
+
+    def convert(
+        self,
+        message: str,
+        filename: str,
+        input_data_type: str,
+        root_template: str,
+        template_collection: str,
+    ) -> dict:
+        return convert_message_to_fhir(
+            message=message,
+            filename=filename,
+            input_data_type=input_data_type,
+            root_template=root_template,
+            template_collection=template_collection,
+            access_token=self.cred_manager.get_access_token().token,
+            fhir_url=self.fhir_url,
+            client=self.client,
+        )
+
+
+def conversion_cache_key(
+    message: str, input_data_type: str, root_template: str, template_collection: str
+) -> str:
+    """
+    Build a key identifying the result of converting a message.  The key is built
+    from the raw message, so the message is only cleaned once, by the converter on
+    a cache miss; resent messages are identical, so share a key regardless.
+    """
+    content = "\0".join([input_data_type, root_template, template_collection, message])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class CachingFhirConverter(FhirConverter):
+    """
+    Wraps another converter with a cache of converted bundles, so that messages
+    that are sent again (resends, or overlapping batches) are not converted again.
+    Only successful conversions are cached.  Bundles are cached as JSON, and each
+    call returns a new copy that the caller is free to modify.
+    """
+
+    def __init__(self, converter: FhirConverter, cache=None):
+        """Caching converter constructor
+
+        :param converter: The converter used on a cache miss
+        :param cache: The cache of converted bundles, such as an LRUCache,
+        or a TieredCache of an LRUCache and a persistent cache.  Defaults to an
+        LRUCache.
+        """
+        self.converter = converter
+        self.cache = cache if cache is not None else LRUCache()
+
+    def convert(
+        self,
+        message: str,
+        filename: str,
+        input_data_type: str,
+        root_template: str,
+        template_collection: str,
+    ) -> dict:
+        key = conversion_cache_key(
+            message, input_data_type, root_template, template_collection
+        )
+        cached = self.cache.get(key)
+        if cached is not None:
+            logging.debug(f"Using cached conversion for {filename}")
+            return json.loads(cached)
+
+        response = self.converter.convert(
+            message, filename, input_data_type, root_template, template_collection
+        )
+        if response and response.get("resourceType") == "Bundle":
+            self.cache.set(key, json.dumps(response))
+        return response
@@ -0,0 +1,216 @@
+from typing import Any, Callable, List, Optional, Union
+
+from smartystreets_python_sdk import us_street
+
+from phdi_building_blocks.geo import (
+    GeocodeCache,
+    Geocoder,
+    _one_line_address,
+    _standardize_patient_addresses,
+    geocode_records,
+    normalize_address,
+)
+from phdi_building_blocks.linkage import _add_patient_identifier, _linking_address
+from phdi_building_blocks.standardize import (
+    _standardize_patient_name,
+    _standardize_patient_phone,
+    country_extractor,
+    standardize_name,
+    standardize_phone,
+)
+from phdi_building_blocks.utils import BundleIndex
+
+
+class PatientContext:
+    """
+    A Patient resource being enriched, along with the values derived from it that
+    are shared between transforms.  Derived values are computed the first time a
+    transform asks for them, and reused by later transforms until a transform that
+    changes the fields they are derived from invalidates them.
+    """
+
+    def __init__(self, bundle: dict, entry: dict, index: BundleIndex = None):
+        """
+        :param bundle: The FHIR bundle the patient belongs to
+        :param entry: The bundle entry holding the Patient resource
+        :param index: An index of the bundle, shared by all of its patients, which
+        is built if not given
+        """
+        self.bundle = bundle
+        self.index = index if index is not None else BundleIndex(bundle)
+        self.entry = entry
+        self.patient = entry["resource"]
+        self._derived = {}
+
+    def derived(self, name: str, compute: Callable[[], Any]) -> Any:
+        """Get a derived value by name, computing it if it isn't already known"""
+        if name not in self._derived:
+            self._derived[name] = compute()
+        return self._derived[name]
+
+    def invalidate(self, *names: str) -> None:
+        """Forget derived values, so that they are computed again when next used"""
+        for name in names:
+            self._derived.pop(name, None)
+
+    def resolve(self, reference: str) -> Optional[dict]:
+        """Get the bundle entry a reference resolves to, or None if it isn't in the
+        bundle"""
+        return self.index.resolve(reference)
+
+    @property
+    def countries(self) -> List[str]:
+        """The alpha-2 codes of the countries of the patient's addresses"""
+        return self.derived("countries", lambda: country_extractor(self.entry))
+
+    @property
+    def one_line_addresses(self) -> List[str]:
+        """The one-line form of each of the patient's addresses, as used for
+        geocoding and for linking identifiers"""
+        return self.derived(
+            "one_line_addresses",
+            lambda: [_one_line_address(a) for a in self.patient.get("address", [])],
+        )
+
+
+# A transform updates a patient in place.  A transform may also have a prepare
+# attribute, which is called with the contexts of every patient in the bundle
+# before the transform is applied to any of them, for work done once per bundle.
+PatientTransform = Callable[[PatientContext], None]
+
+
+def enrich_patients(bundle: dict, transforms: List[PatientTransform]) -> dict:
+    """
+    Apply a list of transforms to every Patient resource in a FHIR bundle, in a
+    single pass over the bundle's entries.  Each patient is passed through all of
+    the transforms, in order, before moving on to the next, and the transforms
+    share the values they derive from it through its PatientContext, along with an
+    index of the bundle for finding other resources and resolving references.
+
+    A transform with a prepare step, such as geocode_addresses, splits the pass:
+    every patient is passed through the transforms before it, then the prepare
+    step is given all of the patients at once, and the pass resumes with it.
+
+    >>> bundle = {"entry": [{"resource": {"resourceType": "Patient",
+    ...     "name": [{"family": "doe"}]}}]}
+    >>> entry = enrich_patients(bundle, [standardize_names()])["entry"][0]
+    >>> entry["resource"]["name"]
+    [{'family': 'DOE'}]
+
+    :param bundle: The FHIR bundle to enrich, which is updated in place
+    :param transforms: The transforms to apply to each patient, such as those made
+    by standardize_names, standardize_phones, geocode_addresses and add_identifier
+    :return: The bundle
+    """
+    index = BundleIndex(bundle)
+    contexts = [
+        PatientContext(bundle, entry, index) for entry in index.by_type("Patient")
+    ]
+
+    stages = []
+    for transform in transforms:
+        if not stages or hasattr(transform, "prepare"):
+            stages.append([])
+        stages[-1].append(transform)
+
+    for stage in stages:
+        if hasattr(stage[0], "prepare"):
+            stage[0].prepare(contexts)
+        for context in contexts:
+            for transform in stage:
+                transform(context)
+    return bundle
+
+
+def standardize_names(standardize: Callable = standardize_name) -> PatientTransform:
+    """A transform that standardizes patient names, as standardize_patient_name
+    does"""
+
+    def transform(context: PatientContext) -> None:
+        _standardize_patient_name(context.patient, standardize)
+
+    return transform
+
+
+def standardize_phones(standardize: Callable = standardize_phone) -> PatientTransform:
+    """A transform that standardizes patient phone numbers, as
+    standardize_patient_phone does"""
+
+    def transform(context: PatientContext) -> None:
+        countries = context.countries
+        _standardize_patient_phone(
+            context.patient, lambda raw: standardize(raw, countries)
+        )
+
+    return transform
+
+
+def geocode_addresses(
+    client: Union[us_street.Client, Geocoder], cache: GeocodeCache = None
+) -> PatientTransform:
+    """A transform that geocodes patient addresses, as geocode_patient_addresses
+    does: its prepare step looks up each distinct address of every patient in the
+    bundle once, sending all of the uncached addresses to the geocoder together"""
+
+    def geocode_contexts(contexts: List[PatientContext]) -> List[list]:
+        results = {}
+        misses = {}
+        for context in contexts:
+            for one_line in context.one_line_addresses:
+                key = normalize_address(one_line)
+                if key in results or key in misses:
+                    continue
+                found, record = cache.get(key) if cache is not None else (False, None)
+                if found:
+                    results[key] = record
+                else:
+                    misses[key] = one_line
+
+        if misses:
+            records = geocode_records(client, list(misses.values()))
+            for key, record in zip(misses, records):
+                results[key] = record
+                if cache is not None:
+                    cache.set(key, record)
+
+        return [
+            [results[normalize_address(one_line)] for one_line in one_lines]
+            for one_lines in (context.one_line_addresses for context in contexts)
+        ]
+
+    def prepare(contexts: List[PatientContext]) -> None:
+        for context, geocoded in zip(contexts, geocode_contexts(contexts)):
+            context.invalidate("geocoded_addresses")
+            context.derived("geocoded_addresses", lambda: geocoded)
+
+    def transform(context: PatientContext) -> None:
+        # Without the prepare step, as when applied to a single patient, the
+        # patient's addresses are geocoded on their own
+        geocoded = context.derived(
+            "geocoded_addresses", lambda: geocode_contexts([context])[0]
+        )
+        one_lines = context.one_line_addresses
+        _standardize_patient_addresses(context.patient, geocoded, one_lines)
+        context.invalidate("geocoded_addresses")
+        if any(geocoded):
+            # Geocoded addresses replace the originals
+            context.invalidate("one_line_addresses")
+
+    transform.prepare = prepare
+    return transform
+
+
+def add_identifier(salt_str: str) -> PatientTransform:
+    """A transform that adds a linking identifier to patients, as
+    add_patient_identifier does"""
+
+    def transform(context: PatientContext) -> None:
+        address_line = ""
+        address = _linking_address(context.patient)
+        if address is not None:
+            # The linking address line has the same form as the geocoder's
+            index = context.patient["address"].index(address)
+            address_line = context.one_line_addresses[index]
+        _add_patient_identifier(context.patient, salt_str, address_line)
+
+    return transform
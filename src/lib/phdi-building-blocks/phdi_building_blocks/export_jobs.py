@@ -0,0 +1,311 @@
+import logging
+import re
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from typing import List, Mapping, Optional
+
+import requests
+import urllib3
+from pydantic import BaseModel
+
+from phdi_building_blocks import fhir
+from phdi_building_blocks.export_state import ExportWatermarks
+
+_PROGRESS_REGEX = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+
+# The number of seconds finished jobs are kept for before they are pruned
+JOB_RETENTION = 7 * 24 * 60 * 60
+
+
+class ExportJob(BaseModel):
+    """
+    A durable record of a FHIR export that has been kicked off, holding everything
+    needed to resume polling it from a later invocation.
+    """
+
+    id: str
+    poll_url: str
+    export_scope: str = ""
+    since: str = ""
+    resource_type: str = ""
+    container: str = ""
+    incremental: bool = False
+    # One of "in-progress", "complete" or "failed"
+    status: str = "in-progress"
+    started: float
+    next_poll: float
+    finished: Optional[float] = None
+    attempts: int = 0
+    progress: Optional[str] = None
+    response: Optional[dict] = None
+    error: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status != "in-progress"
+
+
+class ExportJobs:
+    """
+    Export job records, kept in a LocalStateStore or BlobStateStore.  Finished jobs
+    are pruned once they are older than the retention period, so the records
+    don't grow without bound.
+    """
+
+    def __init__(self, store, retention: float = JOB_RETENTION):
+        """
+        :param store: A LocalStateStore or BlobStateStore the jobs are kept in
+        :param retention: The number of seconds finished jobs are kept for
+        """
+        self.store = store
+        self.retention = retention
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        """Get a job by id, or None if there is no such job"""
+        record = self.store.load().get(job_id)
+        return ExportJob(**record) if record is not None else None
+
+    def pending(self) -> List[ExportJob]:
+        """Get the jobs that are still in progress"""
+        jobs = [ExportJob(**record) for record in self.store.load().values()]
+        return [job for job in jobs if not job.done]
+
+    def save(self, job: ExportJob) -> None:
+        """Save a job, updating the records in place so that jobs saved at the
+        same time by other invocations aren't lost"""
+
+        def change(state: dict) -> None:
+            saved = state.get(job.id)
+            # A job another invocation has finished isn't reverted to in-progress
+            if saved is None or job.done or not ExportJob(**saved).done:
+                state[job.id] = job.dict()
+            cutoff = time.time() - self.retention
+            for job_id, record in list(state.items()):
+                if record.get("finished") is not None and record["finished"] < cutoff:
+                    del state[job_id]
+
+        self.store.update(change)
+
+
+def poll_delay(
+    headers: Mapping[str, str],
+    attempts: int,
+    elapsed: float,
+    min_delay: float = 5,
+    max_delay: float = 300,
+) -> float:
+    """
+    Get the number of seconds to wait before polling an in-progress export again.
+    The server's Retry-After header is honored if it is set.  Otherwise, if the
+    X-Progress header gives a percentage complete, the wait is half the estimated
+    time remaining, and failing that it backs off exponentially from min_delay.
+    The wait is kept between min_delay and max_delay.
+
+    >>> poll_delay({"Retry-After": "120"}, attempts=0, elapsed=0)
+    120.0
+    >>> poll_delay({"X-Progress": "Exporting: 25% complete"}, attempts=3, elapsed=60)
+    90.0
+    >>> poll_delay({}, attempts=2, elapsed=60)
+    20.0
+
+    :param headers: The headers of the last status response
+    :param attempts: The number of times the export has been polled
+    :param elapsed: The number of seconds since the export was kicked off
+    :param min_delay: The shortest wait, in seconds
+    :param max_delay: The longest wait, in seconds
+    """
+    delay = _retry_after(headers.get("Retry-After"))
+    if delay is None:
+        progress = _PROGRESS_REGEX.search(headers.get("X-Progress") or "")
+        percent = float(progress.group(1)) if progress else 0
+        if 0 < percent < 100:
+            delay = elapsed * (100 - percent) / percent / 2
+        else:
+            delay = min_delay * 2**attempts
+    return float(min(max(delay, min_delay), max_delay))
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header, which is either a number of seconds or a date"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+def kickoff_export_job(
+    access_token: str,
+    fhir_url: str,
+    jobs: ExportJobs,
+    export_scope: str = "",
+    since: str = "",
+    resource_type: str = "",
+    container: str = "",
+    watermarks: ExportWatermarks = None,
+    min_delay: float = 5,
+    client: fhir.FhirClient = None,
+) -> ExportJob:
+    """
+    Kick off a FHIR export and record it as a job, without waiting for it to
+    complete.  The job is polled by later calls to poll_export_job.
+
+    :param access_token: Access token string used to connect to FHIR server
+    :param fhir_url: FHIR Server base URL
+    :param jobs: Where the job is recorded
+    :param export_scope: Either `Patient` or `Group/[id]`, or empty for a system
+    level export
+    :param since: Export only resources changed since this FHIR instant
+    :param resource_type: A comma-delimited list of resource types to include
+    :param container: The name of the container used to store exported files
+    :param watermarks: If given, the export is incremental: it starts from the
+    watermark unless since is given, and the watermark is advanced once the job
+    completes
+    :param min_delay: The number of seconds to wait before first polling the job
+    :param client: The client used to make requests
+    :return: The job
+    """
+    if watermarks is not None:
+        since = since or watermarks.get(export_scope, resource_type) or ""
+    poll_url = fhir.kickoff_export(
+        access_token=access_token,
+        fhir_url=fhir_url,
+        export_scope=export_scope,
+        since=since,
+        resource_type=resource_type,
+        container=container,
+        client=client,
+    )
+    now = time.time()
+    job = ExportJob(
+        id=str(uuid.uuid4()),
+        poll_url=poll_url,
+        export_scope=export_scope,
+        since=since,
+        resource_type=resource_type,
+        container=container,
+        incremental=watermarks is not None,
+        started=now,
+        next_poll=now + min_delay,
+    )
+    jobs.save(job)
+    logging.info(f"Started export job {job.id}, polling {poll_url}")
+    return job
+
+
+def poll_export_job(
+    job: ExportJob,
+    access_token: str,
+    jobs: ExportJobs,
+    watermarks: ExportWatermarks = None,
+    min_delay: float = 5,
+    max_delay: float = 300,
+    force: bool = False,
+    client: fhir.FhirClient = None,
+) -> ExportJob:
+    """
+    Check the status of an export job once, if it is due to be polled, and record
+    the result.  When the job completes its export response is recorded, and for
+    incremental jobs the watermark is advanced to its transactionTime.  While it is
+    in progress, the next poll is scheduled according to poll_delay, as it is after
+    a server error or connection failure; the job only fails if the server rejects
+    the status request with a 4xx status.
+
+    :param job: The job to poll
+    :param access_token: Access token string used to connect to FHIR server
+    :param jobs: Where the job is recorded
+    :param watermarks: The watermarks advanced when an incremental job completes
+    :param min_delay: The shortest wait between polls, in seconds
+    :param max_delay: The longest wait between polls, in seconds
+    :param force: Whether to poll the job even if it isn't due yet
+    :param client: The client used to make requests
+    :return: The updated job
+    """
+    now = time.time()
+    if job.done or (now < job.next_poll and not force):
+        return job
+
+    job.attempts += 1
+    try:
+        response = fhir.check_export_status(job.poll_url, access_token, client)
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as error:
+        # urllib3 errors, such as running out of retries, carry no response
+        error_response = getattr(error, "response", None)
+        status_code = error_response.status_code if error_response is not None else 0
+        if 400 <= status_code < 500:
+            # The server rejected the export, so polling again won't help
+            job.status = "failed"
+            job.finished = now
+            job.error = f"Export status check failed with status {status_code}"
+            logging.error(f"Export job {job.id}: {job.error}")
+        else:
+            # Server errors and connection failures may be transient
+            headers = error_response.headers if error_response is not None else {}
+            delay = poll_delay(
+                headers, job.attempts, now - job.started, min_delay, max_delay
+            )
+            job.next_poll = now + delay
+            job.error = (
+                f"Export status check failed with status {status_code}"
+                if status_code
+                else f"Export status check failed: {error}"
+            )
+            logging.warning(
+                f"Export job {job.id}: {job.error}, polling again in {delay:.0f}s"
+            )
+        jobs.save(job)
+        return job
+
+    job.error = None
+    if response.status_code == 200:
+        job.status = "complete"
+        job.finished = now
+        job.response = response.json()
+        if job.incremental and watermarks is not None:
+            transaction_time = job.response.get("transactionTime")
+            if transaction_time:
+                watermarks.advance(
+                    job.export_scope, job.resource_type, transaction_time
+                )
+        logging.info(f"Export job {job.id} completed")
+    else:
+        job.progress = response.headers.get("X-Progress")
+        delay = poll_delay(
+            response.headers, job.attempts, now - job.started, min_delay, max_delay
+        )
+        job.next_poll = now + delay
+        logging.info(
+            f"Export job {job.id} in progress ({job.progress or 'no progress given'}), "
+            + f"polling again in {delay:.0f}s"
+        )
+    jobs.save(job)
+    return job
+
+
+def poll_export_jobs(access_token: str, jobs: ExportJobs, **kwargs) -> List[ExportJob]:
+    """
+    Poll every pending export job that is due, as poll_export_job does, so that a
+    timer can resume the jobs kicked off by earlier invocations.
+
+    :param access_token: Access token string used to connect to FHIR server
+    :param jobs: Where the jobs are recorded
+    :param kwargs: Other arguments to poll_export_job
+    :return: The jobs that were polled and finished on this pass
+    """
+    finished = []
+    for job in jobs.pending():
+        try:
+            job = poll_export_job(job, access_token, jobs, **kwargs)
+        except Exception:
+            # One job's failure shouldn't stop the others from being polled
+            logging.exception(f"Error polling export job {job.id}")
+            continue
+        if job.done:
+            finished.append(job)
+    return finished
@@ -0,0 +1,250 @@
+import contextlib
+import json
+import logging
+import os
+import pathlib
+from datetime import datetime
+from typing import Callable, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobClient
+
+from phdi_building_blocks import fhir
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# The number of times a conditional write of state is retried when another
+# writer changed the state first
+STATE_UPDATE_ATTEMPTS = 10
+
+
+class LocalStateStore:
+    """Persists export state as a JSON file on the local filesystem"""
+
+    def __init__(self, path: str):
+        self.path = pathlib.Path(path)
+
+    def load(self) -> dict:
+        """Load the saved state, or an empty state if none has been saved"""
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text())
+
+    def save(self, state: dict) -> None:
+        """Save the state, replacing the file atomically so that a failed write
+        doesn't lose the previous state"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        partial = self.path.with_name(self.path.name + ".tmp")
+        partial.write_text(json.dumps(state, indent=2, sort_keys=True))
+        os.replace(partial, self.path)
+
+    def update(self, change: Callable[[dict], None]) -> dict:
+        """
+        Change the saved state in place, holding a lock on it so that concurrent
+        updates from other processes aren't lost.
+
+        :param change: Called with the current state, which it changes in place
+        :return: The updated state
+        """
+        with self._lock():
+            state = self.load()
+            change(state)
+            self.save(state)
+            return state
+
+    @contextlib.contextmanager
+    def _lock(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(self.path.name + ".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+
+class BlobStateStore:
+    """Persists export state as a JSON blob, so that it is shared by every instance
+    of a function app"""
+
+    def __init__(self, client: BlobClient):
+        self.client = client
+
+    def load(self) -> dict:
+        """Load the saved state, or an empty state if none has been saved"""
+        try:
+            return json.loads(self.client.download_blob().readall())
+        except ResourceNotFoundError:
+            return {}
+
+    def save(self, state: dict) -> None:
+        """Save the state, replacing any previously saved state"""
+        self.client.upload_blob(_encode(state), overwrite=True)
+
+    def update(self, change: Callable[[dict], None]) -> dict:
+        """
+        Change the saved state in place.  The blob is only written if it hasn't
+        changed since it was read, as checked by its etag, and otherwise the change
+        is applied again to the newer state, so that concurrent updates from other
+        function instances aren't lost.
+
+        :param change: Called with the current state, which it changes in place
+        :return: The updated state
+        """
+        for attempt in range(STATE_UPDATE_ATTEMPTS):
+            try:
+                downloader = self.client.download_blob()
+                state = json.loads(downloader.readall())
+                etag = downloader.properties.etag
+            except ResourceNotFoundError:
+                state, etag = {}, None
+            change(state)
+            try:
+                if etag is None:
+                    # Fails if another writer created the blob first
+                    self.client.upload_blob(_encode(state), overwrite=False)
+                else:
+                    self.client.upload_blob(
+                        _encode(state),
+                        overwrite=True,
+                        etag=etag,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                return state
+            except (ResourceExistsError, ResourceModifiedError):
+                if attempt == STATE_UPDATE_ATTEMPTS - 1:
+                    raise
+                logging.info("Export state changed while updating it, retrying")
+
+
+def _encode(state: dict) -> bytes:
+    return json.dumps(state, indent=2, sort_keys=True).encode("utf-8")
+
+
+def get_state_store(location: str, credential=None):
+    """
+    Get the store for export state at a location, which is either the URL of a blob
+    or a local file path.
+
+    :param location: A blob URL (https://...) or a local file path
+    :param credential: The credential used to access a blob, defaults to a
+    DefaultAzureCredential
+    """
+    if location.startswith("https://"):
+        credential = credential if credential is not None else DefaultAzureCredential()
+        return BlobStateStore(BlobClient.from_blob_url(location, credential=credential))
+    return LocalStateStore(location)
+
+
+class ExportWatermarks:
+    """
+    The transactionTime of the last successful export for each combination of
+    export scope and resource types, which is used as the _since parameter of the
+    next export so that it only includes resources changed since.
+
+    >>> ExportWatermarks.key("", "Patient,Observation")
+    'system|Observation,Patient'
+    >>> ExportWatermarks.key("Group/1", "")
+    'Group/1|*'
+    """
+
+    def __init__(self, store):
+        """
+        :param store: A LocalStateStore or BlobStateStore the watermarks are kept in
+        """
+        self.store = store
+
+    @staticmethod
+    def key(export_scope: str, resource_type: str) -> str:
+        """The key of the watermark for an export scope (empty for a system-level
+        export) and a comma-delimited list of resource types (empty for all)"""
+        types = ",".join(sorted(t.strip() for t in resource_type.split(",") if t))
+        return f"{export_scope or 'system'}|{types or '*'}"
+
+    def get(self, export_scope: str, resource_type: str) -> Optional[str]:
+        """Get the transactionTime of the last successful export, or None if there
+        hasn't been one"""
+        return self.store.load().get(self.key(export_scope, resource_type))
+
+    def advance(
+        self, export_scope: str, resource_type: str, transaction_time: str
+    ) -> bool:
+        """
+        Record the transactionTime of a successful export.  Watermarks only move
+        forward, so an export that finishes after a later one has been recorded
+        doesn't cause changes to be exported again.
+
+        :return: Whether the watermark was advanced
+        """
+        key = self.key(export_scope, resource_type)
+        advanced = False
+
+        def change(state: dict) -> None:
+            nonlocal advanced
+            current = state.get(key)
+            advanced = current is None or _instant(transaction_time) > _instant(current)
+            if advanced:
+                state[key] = transaction_time
+
+        self.store.update(change)
+        return advanced
+
+
+def _instant(value: str) -> datetime:
+    # FHIR instants may use Z for UTC, which fromisoformat doesn't accept before
+    # Python 3.11
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def incremental_export(
+    access_token: str,
+    fhir_url: str,
+    watermarks: ExportWatermarks,
+    export_scope: str = "",
+    resource_type: str = "",
+    since: str = "",
+    **kwargs,
+) -> Optional[dict]:
+    """
+    Run an export of the resources created or modified since the last successful
+    export with the same scope and resource types, as export_from_fhir_server
+    does, and advance the watermark to the new export's transactionTime once it
+    completes.  If the export fails the watermark is left where it was, so the
+    next run covers the same changes again.
+
+    :param access_token: Access token string used to connect to FHIR server
+    :param fhir_url: FHIR Server base URL
+    :param watermarks: The watermarks of previous exports
+    :param export_scope: Either `Patient` or `Group/[id]`, or empty for a system
+    level export
+    :param resource_type: A comma-delimited list of resource types to include
+    :param since: If given, overrides the watermark as the start of the export
+    :param kwargs: Other arguments to export_from_fhir_server, such as the
+    container and polling settings
+    :return: The export response, or None if the export wasn't started
+    """
+    since = since or watermarks.get(export_scope, resource_type) or ""
+    logging.info(
+        f"Exporting {watermarks.key(export_scope, resource_type)} "
+        + (f"changed since {since}" if since else "in full")
+    )
+    export_response = fhir.export_from_fhir_server(
+        access_token=access_token,
+        fhir_url=fhir_url,
+        export_scope=export_scope,
+        since=since,
+        resource_type=resource_type,
+        **kwargs,
+    )
+    if export_response and export_response.get("transactionTime"):
+        watermarks.advance(
+            export_scope, resource_type, export_response["transactionTime"]
+        )
+    return export_response
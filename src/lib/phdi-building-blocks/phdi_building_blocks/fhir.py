@@ -3,15 +3,31 @@ import json
 import logging
 import polling
 import requests
+import tempfile
+import threading
+import time
 
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from requests.adapters import HTTPAdapter
-from typing import Union, Iterator, Tuple, TextIO
+from pydantic import BaseModel
+from typing import Dict, Iterable, List, Optional, Union, Iterator, Tuple, TextIO
+from urllib.parse import quote
 from urllib3 import Retry
 
 from azure.core.credentials import AccessToken
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import download_blob_from_url
+from azure.storage.blob import BlobClient, download_blob_from_url
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+
+# The size of each ranged request made when streaming an export file
+EXPORT_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 def generate_filename(blob_name: str, message_index: int) -> str:
@@ -24,10 +40,12 @@ def generate_filename(blob_name: str, message_index: int) -> str:
 class AzureFhirserverCredentialManager:
     """Manager for handling Azure credentials for access to the FHIR server"""
 
-    def __init__(self, fhir_url):
-        """Credential manager constructor"""
+    def __init__(self, fhir_url, credential=None):
+        """Credential manager constructor.  An existing Azure credential may be
+        provided so it can be shared with other Azure clients."""
         self.access_token = None
         self.fhir_url = fhir_url
+        self.credential = credential
 
     def get_fhir_url(self):
         """Get FHIR URL"""
@@ -50,7 +68,9 @@ class AzureFhirserverCredentialManager:
 
     def _get_azure_credentials(self):
         """Get default Azure Credentials from login context and related
-        Azure configuration."""
+        Azure configuration, unless a credential was provided."""
+        if self.credential is not None:
+            return self.credential
         return DefaultAzureCredential()
 
     def _need_new_token(self, token_reuse_tolerance: float = 10.0) -> bool:
@@ -68,29 +88,133 @@ class AzureFhirserverCredentialManager:
             return True
 
 
-def get_fhirserver_cred_manager(fhir_url: str):
+def get_fhirserver_cred_manager(fhir_url: str, credential=None):
     """Get an instance of the Azure FHIR Server credential manager."""
-    return AzureFhirserverCredentialManager(fhir_url)
+    return AzureFhirserverCredentialManager(fhir_url, credential)
+
+
+class FhirClient:
+    """HTTP client for calls to the FHIR server.  Requests share a pooled
+    keep-alive session, so connections (and their TLS handshakes) are reused, and
+    are retried with exponential backoff on throttling and server errors."""
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 60,
+    ):
+        """FHIR client constructor
+
+        :param pool_size: The maximum number of connections to keep open to each host
+        :param retries: The maximum number of times to retry a request that was
+        throttled (429) or failed with a 5xx status or a connection error
+        :param backoff_factor: Base number of seconds for the exponential backoff
+        between retries.  A Retry-After header on a 429 or 503 response is honored
+        in place of the backoff.
+        :param timeout: The default number of seconds to wait for the server to
+        respond to a request
+        """
+        retry_strategy = Retry(
+            total=retries,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["HEAD", "GET", "PUT", "POST", "OPTIONS"],
+            backoff_factor=backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry_strategy,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = timeout
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request to the FHIR server, applying the default timeout unless
+        one is given"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Send a GET request to the FHIR server"""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Send a POST request to the FHIR server"""
+        return self.request("POST", url, **kwargs)
 
 
-def upload_bundle_to_fhir_server(bundle: dict, access_token: str, fhir_url: str):
+_default_fhir_client = None
+_default_fhir_client_lock = threading.Lock()
+
+
+def get_fhir_client() -> FhirClient:
+    """Get the FHIR client shared by calls that aren't given their own client"""
+    global _default_fhir_client
+    with _default_fhir_client_lock:
+        if _default_fhir_client is None:
+            _default_fhir_client = FhirClient()
+        return _default_fhir_client
+
+
+class FhirUploadResult(BaseModel):
+    """
+    The outcome of uploading a bundle (or resource) to the FHIR server
+    """
+
+    # HTTP status of the upload request, or None if no response was received
+    status_code: Optional[int]
+    # The `response` of each entry in a batch-response Bundle, in request order
+    entry_responses: List[dict] = []
+    # The request entries the FHIR server did not accept
+    failed_entries: List[dict] = []
+    # Seconds spent on the request, including any retries
+    latency: float = 0.0
+    # The number of times the request was retried
+    retries: int = 0
+
+    @property
+    def succeeded(self) -> bool:
+        """Whether the request and every entry in it were accepted"""
+        return (
+            self.status_code is not None
+            and 200 <= self.status_code < 300
+            and not self.failed_entries
+        )
+
+
+def upload_bundle_to_fhir_server(
+    bundle: dict, access_token: str, fhir_url: str, client: FhirClient = None
+) -> FhirUploadResult:
     """Import a FHIR resource to the FHIR server.
     The submissions may be Bundles or individual FHIR resources.
 
     :param dict bundle: FHIR bundle (type "batch") to post
     :param str access_token: FHIR Server access token.
-    :param str method: HTTP method to use (currently PUT or POST supported)
+    :param str fhir_url: FHIR Server base URL
+    :param FhirClient client: The client used to make the request, defaults to the
+    shared client from get_fhir_client
+    :return: The status, per-entry outcomes, latency and retry count of the upload
     """
-    retry_strategy = Retry(
-        total=3,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["HEAD", "PUT", "POST", "OPTIONS"],
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount("https://", adapter)
+    client = client or get_fhir_client()
+    return _post_bundle(bundle, access_token, fhir_url, client)
+
+
+def _post_bundle(
+    bundle: dict, access_token: str, fhir_url: str, client: FhirClient
+) -> FhirUploadResult:
+    """POST a bundle to the FHIR server, and summarize the response.  Entries are
+    failed if the request as a whole failed, or if their entry in the batch-response
+    Bundle doesn't have a 2xx status."""
+    entries = bundle.get("entry", [])
+    start = time.perf_counter()
     try:
-        requests.post(
+        response = client.post(
             fhir_url,
             headers={
                 "Authorization": f"Bearer {access_token}",
@@ -101,7 +225,186 @@ def upload_bundle_to_fhir_server(bundle: dict, access_token: str, fhir_url: str)
         )
     except Exception:
         logging.exception("Request to post Bundle failed for json: " + str(bundle))
-        return
+        return FhirUploadResult(
+            status_code=None,
+            failed_entries=entries,
+            latency=time.perf_counter() - start,
+        )
+
+    result = FhirUploadResult(
+        status_code=response.status_code,
+        latency=time.perf_counter() - start,
+        retries=_count_retries(response),
+    )
+    if response.status_code == 200 and bundle.get("resourceType") == "Bundle":
+        result.entry_responses = [
+            response_entry.get("response", {})
+            for response_entry in response.json().get("entry", [])
+        ]
+    elif not 200 <= response.status_code < 300:
+        logging.error(
+            f"HTTP {response.status_code} code encountered posting Bundle of "
+            + f"{len(entries)} entries"
+        )
+    result.failed_entries = _find_failed_entries(
+        entries, result.status_code, result.entry_responses
+    )
+
+    return result
+
+
+def _find_failed_entries(
+    entries: List[dict], status_code: Optional[int], entry_responses: List[dict]
+) -> List[dict]:
+    """Find the entries that were not accepted: all of them if the request failed,
+    otherwise those without a 2xx status in the batch-response Bundle.  Responses
+    are matched to entries by position, so if the batch-response doesn't have one
+    response per entry, none of them can be trusted and every entry has failed."""
+    if status_code is None or not 200 <= status_code < 300:
+        return entries
+    if status_code != 200:
+        return []
+    if len(entry_responses) != len(entries):
+        logging.error(
+            f"Batch-response has {len(entry_responses)} responses for "
+            + f"{len(entries)} entries"
+        )
+        return entries
+    return [
+        entry
+        for entry, entry_response in zip(entries, entry_responses)
+        if not entry_response.get("status", "").startswith("2")
+    ]
+
+
+def _count_retries(response: requests.Response) -> int:
+    """Count the retries urllib3 made before returning the response"""
+    try:
+        return len(response.raw.retries.history)
+    except (AttributeError, TypeError):
+        return 0
+
+
+class FhirBundleAggregator:
+    """Merges the entries of many bundles into batch Bundles, so a group of
+    converted messages is uploaded to the FHIR server in a single POST instead of
+    one request per message.  Batches are capped by entry count and serialized
+    size, and the entries of one bundle are always sent in the same batch.  Bundles
+    may be added from multiple threads."""
+
+    def __init__(
+        self,
+        cred_manager: AzureFhirserverCredentialManager,
+        fhir_url: str,
+        client: FhirClient = None,
+        max_entries: int = 500,
+        max_bytes: int = 4 * 1024 * 1024,
+    ):
+        """Bundle aggregator constructor
+
+        :param cred_manager: Credential manager used to get a FHIR server access
+        token for each upload
+        :param fhir_url: FHIR Server base URL
+        :param client: The client used to make requests, defaults to the shared
+        client from get_fhir_client
+        :param max_entries: The maximum number of entries in one batch Bundle
+        :param max_bytes: The maximum serialized size of the entries in one batch
+        Bundle.  A single bundle larger than the caps is sent in a batch of its own.
+        """
+        self.cred_manager = cred_manager
+        self.fhir_url = fhir_url
+        self.client = client or get_fhir_client()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._groups = []
+        self._count = 0
+        self._size = 0
+
+    def add(self, filename: str, bundle: dict) -> Dict[str, FhirUploadResult]:
+        """Add the entries of a bundle to the pending batch, uploading any batches
+        that fill up as a result.
+
+        :param filename: The name of the message the bundle was converted from
+        :param bundle: A FHIR bundle whose entries each contain a `request`
+        :return: The upload results of any uploaded batches, by source filename
+        """
+        entries = bundle.get("entry", [])
+        if not entries:
+            return {}
+        size = sum(len(json.dumps(entry)) for entry in entries)
+
+        batches = []
+        with self._lock:
+            if self._groups and (
+                self._count + len(entries) > self.max_entries
+                or self._size + size > self.max_bytes
+            ):
+                batches.append(self._take_batch())
+
+            self._groups.append((filename, entries))
+            self._count += len(entries)
+            self._size += size
+
+            if self._count >= self.max_entries or self._size >= self.max_bytes:
+                batches.append(self._take_batch())
+
+        # Upload outside of the lock, so other threads can keep adding bundles
+        return self._upload_batches(batches)
+
+    def flush(self) -> Dict[str, FhirUploadResult]:
+        """Upload any pending entries.
+
+        :return: The upload results of the uploaded batch, by source filename
+        """
+        with self._lock:
+            batches = [self._take_batch()] if self._groups else []
+        return self._upload_batches(batches)
+
+    def _take_batch(self) -> List[Tuple[str, List[dict]]]:
+        """Remove and return the pending groups of entries, by source filename."""
+        batch = self._groups
+        self._groups = []
+        self._count = 0
+        self._size = 0
+        return batch
+
+    def _upload_batches(
+        self, batches: List[List[Tuple[str, List[dict]]]]
+    ) -> Dict[str, FhirUploadResult]:
+        """POST each batch, and split its result back out by the filenames the
+        entries came from.  The entries of a batch-response Bundle are in the same
+        order as the entries of the request."""
+        results = {}
+        for groups in batches:
+            bundle = {
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": [entry for _, entries in groups for entry in entries],
+            }
+            access_token = self.cred_manager.get_access_token().token
+            batch_result = _post_bundle(
+                bundle, access_token, self.fhir_url, self.client
+            )
+
+            offset = 0
+            for filename, entries in groups:
+                entry_responses = batch_result.entry_responses[
+                    offset : offset + len(entries)  # noqa: E203
+                ]
+                offset += len(entries)
+                results[filename] = FhirUploadResult(
+                    status_code=batch_result.status_code,
+                    entry_responses=entry_responses,
+                    failed_entries=_find_failed_entries(
+                        entries, batch_result.status_code, entry_responses
+                    ),
+                    latency=batch_result.latency,
+                    retries=batch_result.retries,
+                )
+
+        return results
 
 
 def export_from_fhir_server(
@@ -113,6 +416,7 @@ def export_from_fhir_server(
     container: str = "",
     poll_step: float = 30,
     poll_timeout: float = 300,
+    client: FhirClient = None,
 ) -> dict:
     """Initiate a FHIR $export operation, and poll until it completes.
     If the export operation is in progress at the end of poll_timeout,
@@ -129,25 +433,13 @@ def export_from_fhir_server(
     for export files to be generated.
     :param poll_timeout: the maximum number of seconds to wait for export files to
     be generated.
+    :param client: The client used to make requests, defaults to the shared client
+    from get_fhir_client
     """
-    logging.debug("Initiating export from FHIR server.")
-    export_url = _compose_export_url(
-        fhir_url=fhir_url,
-        export_scope=export_scope,
-        since=since,
-        resource_type=resource_type,
-        container=container,
-    )
-    logging.debug(f"Composed export URL: {export_url}")
-    response = requests.get(
-        export_url,
-        headers={
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/fhir+json",
-            "Prefer": "respond-async",
-        },
+    client = client or get_fhir_client()
+    response = _request_export(
+        access_token, fhir_url, export_scope, since, resource_type, container, client
     )
-    logging.info(f"Export request completed with status {response.status_code}")
 
     if response.status_code == 202:
 
@@ -156,6 +448,7 @@ def export_from_fhir_server(
             access_token=access_token,
             poll_step=poll_step,
             poll_timeout=poll_timeout,
+            client=client,
         )
 
         if poll_response.status_code == 200:
@@ -166,6 +459,91 @@ def export_from_fhir_server(
             raise requests.HTTPError(response=poll_response)
 
 
+def kickoff_export(
+    access_token: str,
+    fhir_url: str,
+    export_scope: str = "",
+    since: str = "",
+    resource_type: str = "",
+    container: str = "",
+    client: FhirClient = None,
+) -> str:
+    """Initiate a FHIR $export operation without waiting for it to complete, so
+    that its status can be checked later with check_export_status.  The parameters
+    are as for export_from_fhir_server.
+
+    :raises requests.HTTPError: If the export is not accepted by the server
+    :return: The URL to poll for the status of the export
+    """
+    client = client or get_fhir_client()
+    response = _request_export(
+        access_token, fhir_url, export_scope, since, resource_type, container, client
+    )
+    if response.status_code != 202:
+        raise requests.HTTPError(response=response)
+    return response.headers.get("Content-Location")
+
+
+def check_export_status(
+    poll_url: str, access_token: str, client: FhirClient = None
+) -> requests.Response:
+    """Check the status of an export once, without waiting for it to complete.
+
+    :param poll_url: URL to poll for export information, as returned by
+    kickoff_export
+    :param access_token: Bearer token used for authentication
+    :param client: The client used to make requests, defaults to the shared client
+    from get_fhir_client
+    :raises requests.HTTPError: If the export failed, or an unexpected status code
+    is returned
+    :return: The status response: 202 while the export is in progress, with the
+    Retry-After and X-Progress headers if the server sets them, or 200 with the
+    export response once it is complete
+    """
+    client = client or get_fhir_client()
+    response = client.get(
+        poll_url,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "application/fhir+ndjson",
+        },
+    )
+    if response.status_code not in (200, 202):
+        raise requests.HTTPError(response=response)
+    return response
+
+
+def _request_export(
+    access_token: str,
+    fhir_url: str,
+    export_scope: str,
+    since: str,
+    resource_type: str,
+    container: str,
+    client: FhirClient,
+) -> requests.Response:
+    """Send an export kick-off request"""
+    logging.debug("Initiating export from FHIR server.")
+    export_url = _compose_export_url(
+        fhir_url=fhir_url,
+        export_scope=export_scope,
+        since=since,
+        resource_type=resource_type,
+        container=container,
+    )
+    logging.debug(f"Composed export URL: {export_url}")
+    response = client.get(
+        export_url,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "application/fhir+json",
+            "Prefer": "respond-async",
+        },
+    )
+    logging.info(f"Export request completed with status {response.status_code}")
+    return response
+
+
 def _compose_export_url(
     fhir_url: str,
     export_scope: str = "",
@@ -187,7 +565,8 @@ def _compose_export_url(
     # is appended to the URL
     separator = "?"
     if since:
-        export_url += f"{separator}_since={since}"
+        # Instants may have a +hh:mm offset, and an unencoded + reads as a space
+        export_url += f"{separator}_since={quote(since, safe=':')}"
         separator = "&"
 
     if resource_type:
@@ -202,7 +581,7 @@ def _compose_export_url(
 
 
 def __export_from_fhir_server_poll_call(
-    poll_url: str, access_token: str
+    poll_url: str, access_token: str, client: FhirClient
 ) -> Union[requests.Response, None]:
     """Poll to see if the export files are ready.  If export is still in progress,
     and we should return null so polling continues.  If the response is 200, then
@@ -210,7 +589,7 @@ def __export_from_fhir_server_poll_call(
     either indicates an error or unexpected condition.  In this case raise an error.
     """
     logging.debug(f"Polling endpoint {poll_url}")
-    response = requests.get(
+    response = client.get(
         poll_url,
         headers={
             "Authorization": f"Bearer {access_token}",
@@ -228,7 +607,11 @@ def __export_from_fhir_server_poll_call(
 
 
 def export_from_fhir_server_poll(
-    poll_url: str, access_token: str, poll_step: float = 30, poll_timeout: float = 300
+    poll_url: str,
+    access_token: str,
+    poll_step: float = 30,
+    poll_timeout: float = 300,
+    client: FhirClient = None,
 ) -> requests.Response:
     """Poll for export file avialability after an export has been initiated.
 
@@ -238,14 +621,17 @@ def export_from_fhir_server_poll(
     for export files to be generated. defaults to 30
     :param poll_timeout: the maximum number of seconds to wait for export files to
     be generated. defaults to 300
+    :param client: The client used to make requests, defaults to the shared client
+    from get_fhir_client
     :raises polling.TimeoutException: If the FHIR server continually returns a 202
     status indicating in progress until the timeout is reached.
     :raises requests.HTTPError: If an unexpected status code is returned.
     :return: The export response obtained from the FHIR server (200 status code)
     """
+    client = client or get_fhir_client()
     response = polling.poll(
         target=__export_from_fhir_server_poll_call,
-        args=[poll_url, access_token],
+        args=[poll_url, access_token, client],
         step=poll_step,
         timeout=poll_timeout,
     )
@@ -263,23 +649,155 @@ def export_from_fhir_server_poll(
 
 def download_from_export_response(
     export_response: dict,
-) -> Iterator[Tuple[str, TextIO]]:
+    stream: bool = False,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+    credential=None,
+) -> Iterator[Tuple[str, Union[TextIO, Iterator[dict]]]]:
     """Accepts the export response content as specified here:
     https://hl7.org/fhir/uv/bulkdata/export/index.html#response---complete-status
 
     Loops through the "output" array and yields the resource_type (e.g. Patient)
     along with TextIO wrapping ndjson content.
 
+    In streaming mode, each file is instead yielded as an iterator of the parsed
+    resources in it, which downloads the file in ranged requests of chunk_size
+    bytes as it is read.  Only the current chunk and line are held in memory, so
+    memory use is bounded regardless of the size of the export.  Resources are
+    parsed with orjson if it is installed.
+
     :param export_response: export response JSON
+    :param stream: Whether to stream each file's resources rather than download it
+    :param chunk_size: The number of bytes to download at a time when streaming
+    :param credential: The credential used to read the files when streaming,
+    defaults to a DefaultAzureCredential shared by all of the files
     :yield: tuple containing resource type (e.g. Patient) AND THE TextIO of the
-    downloaded ndjson content for that resource type
+    downloaded ndjson content for that resource type, or an iterator of its
+    resources when streaming
     """
     # TODO: Handle error array that could be contained in the response content.
 
+    if stream and credential is None:
+        credential = DefaultAzureCredential()
+
     for export_entry in export_response.get("output", []):
         resource_type = export_entry.get("type")
         blob_url = export_entry.get("url")
-        yield (resource_type, _download_export_blob(blob_url=blob_url))
+        if stream:
+            chunks = _stream_export_blob(blob_url, credential, chunk_size)
+            yield (resource_type, iter_ndjson(chunks))
+        else:
+            yield (resource_type, _download_export_blob(blob_url=blob_url))
+
+
+def read_export_files(
+    export_response: dict,
+    max_workers: int = 4,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+    credential=None,
+) -> Iterator[Tuple[str, Iterator[dict]]]:
+    """
+    Download the files in an export response concurrently, yielding the resource
+    type of each file (e.g. Patient) and an iterator of the resources in it as soon
+    as the file has downloaded, in the order the downloads finish.  Consumers can
+    start on the files that are ready while the rest are still downloading.
+
+    Up to max_workers files are downloaded at once, in ranged requests of
+    chunk_size bytes, with a single credential shared by every download.  Each
+    file is spooled to a temporary file rather than held in memory once it is
+    larger than chunk_size.  If the caller stops iterating early, or a download
+    fails, downloads that haven't started are cancelled and every other file is
+    discarded, including those already yielded but not yet read and those still
+    downloading, once they finish.
+
+    :param export_response: export response JSON
+    :param max_workers: The most files to download at once
+    :param chunk_size: The number of bytes to download at a time
+    :param credential: The credential used to read the files, defaults to a
+    DefaultAzureCredential
+    :yield: tuple containing the resource type and an iterator of its resources
+    """
+    credential = credential or DefaultAzureCredential()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    downloads = {}
+    finished = False
+    try:
+        for entry in export_response.get("output", []):
+            download = executor.submit(
+                _spool_export_blob, entry.get("url"), credential, chunk_size
+            )
+            downloads[download] = entry.get("type")
+        for download in as_completed(downloads):
+            spooled = download.result()
+            yield (downloads[download], iter_ndjson(_read_spooled(spooled, chunk_size)))
+        finished = True
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # On a normal finish the caller owns the files it was given; otherwise,
+        # nothing more will be read, so every file is closed as soon as it's ready
+        if not finished:
+            for download in downloads:
+                download.add_done_callback(_close_spooled)
+
+
+def iter_ndjson(chunks: Iterable[bytes]) -> Iterator[dict]:
+    """
+    Parse newline-delimited JSON from a sequence of byte chunks, which may split
+    lines anywhere, yielding each object as soon as its line is complete.  Blank
+    lines are skipped.
+
+    >>> list(iter_ndjson([b'{"id": 1}\\n{"i', b'd": 2}\\n\\n', b'{"id": 3}']))
+    [{'id': 1}, {'id': 2}, {'id': 3}]
+
+    :param chunks: The NDJSON content, in chunks of bytes
+    :yield: Each parsed JSON object
+    """
+    partial = b""
+    for chunk in chunks:
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield _json_loads(line)
+    if partial.strip():
+        yield _json_loads(partial)
+
+
+def _stream_export_blob(
+    blob_url: str, credential, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Download an export file blob in ranged requests of chunk_size bytes, yielding
+    each chunk as it arrives"""
+    blob_client = BlobClient.from_blob_url(
+        blob_url,
+        credential=credential,
+        max_single_get_size=chunk_size,
+        max_chunk_get_size=chunk_size,
+    )
+    yield from blob_client.download_blob().chunks()
+
+
+def _spool_export_blob(
+    blob_url: str, credential, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> tempfile.SpooledTemporaryFile:
+    """Download an export file blob to a temporary file, which is kept in memory
+    only while it is smaller than chunk_size"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+    for chunk in _stream_export_blob(blob_url, credential, chunk_size):
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def _read_spooled(spooled: tempfile.SpooledTemporaryFile, chunk_size: int):
+    """Read a spooled file in chunks, closing it once it has been read"""
+    with spooled:
+        yield from iter(lambda: spooled.read(chunk_size), b"")
+
+
+def _close_spooled(download: Future) -> None:
+    """Close the spooled file of a finished download, if it succeeded"""
+    if not download.cancelled() and download.exception() is None:
+        download.result().close()
 
 
 def _download_export_blob(blob_url: str, encoding: str = "utf-8") -> TextIO:
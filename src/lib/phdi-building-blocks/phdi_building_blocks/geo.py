@@ -1,9 +1,14 @@
-from typing import List
+import json
+import re
+import threading
+import time
+from typing import List, NamedTuple, Optional, Union
 from pydantic import BaseModel
 
+from phdi_building_blocks.cache import CacheStats, LRUCache
 from phdi_building_blocks.utils import find_patient_resources
 
-from smartystreets_python_sdk import StaticCredentials, ClientBuilder
+from smartystreets_python_sdk import Batch, StaticCredentials, ClientBuilder
 from smartystreets_python_sdk import us_street
 from smartystreets_python_sdk.us_street.lookup import Lookup
 
@@ -24,21 +29,117 @@ class GeocodeResult(BaseModel):
     precision: str
 
 
-def geocode(client: us_street.Client, address: str) -> GeocodeResult:
+class GeocodeRecord(NamedTuple):
     """
-    Given an API client and an address, attempt to call the smartystreets API
+    A lightweight, unvalidated equivalent of GeocodeResult, with the same fields.
+    Geocoding many addresses (geocode_records, geocode_patient_addresses and the
+    geocode cache) passes results around as records, to avoid the cost of building
+    and validating a pydantic model per address.
     """
 
+    address: List[str]
+    city: str
+    state: str
+    zipcode: str
+    county_fips: str
+    county_name: str
+    lat: float
+    lng: float
+    precision: str
+
+    def to_model(self) -> GeocodeResult:
+        """Convert the record to a GeocodeResult"""
+        return GeocodeResult(**self._asdict())
+
+
+class Geocoder:
+    """
+    Interface for geocoders that can be used in place of a SmartyStreets client by
+    geocode, geocode_batch, geocode_records and the functions built on them, such
+    as geocode_patient_address.  Implementations provide geocode_records.
+    """
+
+    def geocode_records(self, addresses: List[str]) -> List[Optional[GeocodeRecord]]:
+        """Geocode a list of one-line addresses, returning the record for each
+        address in the same order, or None if it could not be geocoded"""
+        raise NotImplementedError
+
+    def geocode(self, address: str) -> Optional[GeocodeResult]:
+        """Geocode a one-line address, returning None if it could not be
+        geocoded"""
+        return _to_model(self.geocode_records([address])[0])
+
+    def geocode_batch(self, addresses: List[str]) -> List[Optional[GeocodeResult]]:
+        """Geocode a list of one-line addresses, returning the result for each
+        address in the same order"""
+        return [_to_model(record) for record in self.geocode_records(addresses)]
+
+
+def geocode(client: Union[us_street.Client, Geocoder], address: str) -> GeocodeResult:
+    """
+    Given an API client and an address, attempt to call the smartystreets API.
+    If the client is a Geocoder, it is used to geocode the address instead.
+    """
+    if isinstance(client, Geocoder):
+        return client.geocode(address)
+
     lookup = Lookup(street=address)
     client.send_lookup(lookup)
+    return _to_model(_geocode_record(lookup))
+
+
+def geocode_batch(
+    client: Union[us_street.Client, Geocoder], addresses: List[str]
+) -> List[Optional[GeocodeResult]]:
+    """
+    Given an API client and a list of addresses, geocode the addresses with as few
+    calls to the smartystreets API as possible, sending them in batches of up to
+    100 lookups.
+
+    :param client: A SmartyStreets client, or a Geocoder
+    :param addresses: The one-line addresses to geocode
+    :return: The geocoded result for each address, in the same order as the
+    addresses, with None for addresses that could not be geocoded
+    """
+    return [_to_model(record) for record in geocode_records(client, addresses)]
+
+
+def geocode_records(
+    client: Union[us_street.Client, Geocoder], addresses: List[str]
+) -> List[Optional[GeocodeRecord]]:
+    """
+    Geocode a list of addresses as geocode_batch does, returning a GeocodeRecord
+    rather than a GeocodeResult for each address.
+
+    :param client: A SmartyStreets client, or a Geocoder
+    :param addresses: The one-line addresses to geocode
+    :return: The geocoded record for each address, in the same order as the
+    addresses, with None for addresses that could not be geocoded
+    """
+    if isinstance(client, Geocoder):
+        return client.geocode_records(addresses)
 
+    lookups = [Lookup(street=address) for address in addresses]
+    batch = Batch()
+    for lookup in lookups:
+        batch.add(lookup)
+        if batch.is_full():
+            client.send_batch(batch)
+            batch = Batch()
+    if len(batch):
+        client.send_batch(batch)
+    return [_geocode_record(lookup) for lookup in lookups]
+
+
+def _geocode_record(lookup: Lookup) -> Optional[GeocodeRecord]:
+    """Build a GeocodeRecord from the first candidate of a completed lookup"""
     if lookup.result and lookup.result[0].metadata.latitude:
         res = lookup.result[0]
         addr = [res.delivery_line_1]
         if res.delivery_line_2:
             addr.append(res.delivery_line_2)
 
-        return GeocodeResult(
+        return GeocodeRecord(
             address=addr,
             city=res.components.city_name,
             state=res.components.state_abbreviation,
@@ -51,6 +152,110 @@ def geocode(client: us_street.Client, address: str) -> GeocodeResult:
         )
 
 
+def _to_model(record: Optional[GeocodeRecord]) -> Optional[GeocodeResult]:
+    return record.to_model() if record is not None else None
+
+
+_ADDRESS_PUNCTUATION_REGEX = re.compile(r"[.,;#]")
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalize a one-line address for use as a cache key, so that addresses that
+    only differ in case, punctuation or spacing share a key
+
+    >>> normalize_address(" 123 Fake St.,  Faketon, ny 10001 ")
+    '123 FAKE ST FAKETON NY 10001'
+    """
+    return " ".join(_ADDRESS_PUNCTUATION_REGEX.sub(" ", address).upper().split())
+
+
+class GeocodeCache:
+    """
+    A cache of geocoding results, keyed on the normalized one-line address.
+    Addresses that could not be geocoded are cached too, for a shorter time, so
+    that they are retried sooner than successful results are refreshed.
+
+    Results are stored as JSON strings, so any cache from
+    phdi_building_blocks.cache can be used, such as a TieredCache of an LRUCache
+    in front of a SqliteCache or BlobCache to persist results.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        ttl: float = 30 * 24 * 60 * 60,
+        negative_ttl: float = 24 * 60 * 60,
+    ):
+        """Geocode cache constructor
+
+        :param cache: The cache results are stored in, defaults to an LRUCache
+        :param ttl: The number of seconds to cache geocoded addresses for
+        :param negative_ttl: The number of seconds to cache addresses that could
+        not be geocoded for
+        """
+        self.cache = cache if cache is not None else LRUCache(max_size=10000)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = CacheStats()
+        self.negative_hits = 0
+        self._lock = threading.Lock()
+
+    def get(self, address: str) -> tuple:
+        """
+        Look up the result of geocoding an address.
+
+        :param address: A one-line address
+        :return: A tuple of whether the address was found in the cache, and the
+        cached GeocodeRecord, which is None if the address could not be geocoded
+        """
+        value = self.cache.get(normalize_address(address))
+        entry = json.loads(value) if value is not None else None
+
+        # Negative entries carry their own expiry, as tiered caches may copy them
+        # into a faster tier with that tier's default ttl
+        if entry is not None and "miss_until" in entry:
+            if entry["miss_until"] <= time.time():
+                entry = None
+            else:
+                with self._lock:
+                    self.negative_hits += 1
+                self.stats.record(True)
+                return True, None
+
+        self.stats.record(entry is not None)
+        return (True, GeocodeRecord(**entry)) if entry is not None else (False, None)
+
+    def set(
+        self, address: str, result: Union[GeocodeRecord, GeocodeResult, None]
+    ) -> None:
+        """Cache the result of geocoding an address, or None if it could not be
+        geocoded"""
+        if result is None:
+            self.cache.set(
+                normalize_address(address),
+                json.dumps({"miss_until": time.time() + self.negative_ttl}),
+                ttl=self.negative_ttl,
+            )
+        else:
+            fields = (
+                result._asdict() if isinstance(result, GeocodeRecord) else result.dict()
+            )
+            self.cache.set(normalize_address(address), json.dumps(fields), ttl=self.ttl)
+
+    def geocode(
+        self, client: Union[us_street.Client, Geocoder], address: str
+    ) -> GeocodeResult:
+        """Geocode an address using the cached result if there is one, and
+        otherwise with the client, caching the result"""
+        found, record = self.get(address)
+        if found:
+            return _to_model(record)
+        result = geocode(client, address)
+        self.set(address, result)
+        return result
+
+
 def get_smartystreets_client(auth_id: str, auth_token: str) -> us_street.Client:
     """
     Build a smartystreets api client from an auth id and token
@@ -65,55 +270,166 @@ def get_smartystreets_client(auth_id: str, auth_token: str) -> us_street.Client:
     )
 
 
-def geocode_patient_address(bundle: dict, client: us_street.Client) -> dict:
-    """Given a FHIR bundle and a SmartyStreets client, geocode all patient addresses
-    in all patient resources in the bundle."""
+def geocode_patient_address(
+    bundle: dict,
+    client: Union[us_street.Client, Geocoder],
+    cache: GeocodeCache = None,
+) -> dict:
+    """Given a FHIR bundle and a SmartyStreets client (or any Geocoder), geocode all
+    patient addresses in all patient resources in the bundle.  If a cache is given,
+    addresses found in it are not sent to the geocoder again."""
 
     for resource in find_patient_resources(bundle):
         patient = resource.get("resource")
-        if "extension" not in patient:
-            patient["extension"] = []
-
-        raw_addresses = []
-        std_addresses = []
+        geocoded = []
         for address in patient.get("address", []):
-            # Generate a one-line address to pass to the geocoder
-            one_line = " ".join(address.get("line", []))
-            one_line += f" {address.get('city')}, {address.get('state')}"
-            if "postalCode" in address and address["postalCode"]:
-                one_line += f" {address['postalCode']}"
-            raw_addresses.append(one_line)
-
-            geocoded = geocode(client, one_line)
-            std_one_line = ""
-            if geocoded:
-                address["line"] = geocoded.address
-                address["city"] = geocoded.city
-                address["state"] = geocoded.state
-                address["postalCode"] = geocoded.zipcode
-                std_one_line = f"{geocoded.address} {geocoded.city}, {geocoded.state} {geocoded.zipcode}"  # noqa
-                std_addresses.append(std_one_line)
-
-                if "extension" not in address:
-                    address["extension"] = []
-
-                address["extension"].append(
-                    {
-                        "url": "http://hl7.org/fhir/StructureDefinition/geolocation",
-                        "extension": [
-                            {"url": "latitude", "valueDecimal": geocoded.lat},
-                            {"url": "longitude", "valueDecimal": geocoded.lng},
-                        ],
-                    }
-                )
-        any_dffs = (len(raw_addresses) != len(std_addresses)) or any(
-            [raw_addresses[i] != std_addresses[i] for i in range(len(raw_addresses))]
-        )
-        patient["extension"].append(
-            {
-                "url": "http://usds.gov/fhir/phdi/StructureDefinition/address-was-standardized",  # noqa
-                "valueBoolean": any_dffs,
-            }
-        )
+            one_line = _one_line_address(address)
+            if cache is not None:
+                geocoded.append(cache.geocode(client, one_line))
+            else:
+                geocoded.append(geocode(client, one_line))
+        _standardize_patient_addresses(patient, geocoded)
 
     return bundle
+
+
+def geocode_patient_addresses(
+    bundles: List[dict],
+    client: Union[us_street.Client, Geocoder],
+    cache: GeocodeCache = None,
+) -> List[dict]:
+    """
+    Given a list of FHIR bundles and a SmartyStreets client, geocode all patient
+    addresses in all patient resources in all of the bundles, as
+    geocode_patient_address does for a single bundle.  Each distinct address is
+    looked up once, and the lookups are sent to SmartyStreets in batches, so
+    geocoding costs one call per 100 distinct addresses rather than one call per
+    address.
+
+    :param bundles: The FHIR bundles to geocode
+    :param client: A SmartyStreets client, or a Geocoder
+    :param cache: If given, addresses found in the cache are not sent to
+    SmartyStreets, and the results of the lookups that are sent are cached
+    :return: The geocoded bundles
+    """
+    addresses = PatientAddresses(bundles, cache)
+    addresses.update(geocode_records(client, list(addresses.misses.values())))
+    return bundles
+
+
+class PatientAddresses:
+    """
+    The distinct addresses of every patient in a list of bundles, keyed on the
+    normalized one-line address, for geocoding them all at once.  Addresses found
+    in the cache are resolved straight away, and the rest are listed in misses for
+    the caller to geocode and pass to update.
+    """
+
+    def __init__(self, bundles: List[dict], cache: GeocodeCache = None):
+        """
+        :param bundles: The FHIR bundles whose patient addresses are geocoded
+        :param cache: If given, the cache addresses are looked up in, and the
+        results of geocoding the misses are added to
+        """
+        self.cache = cache
+        self.patients = [
+            resource.get("resource")
+            for bundle in bundles
+            for resource in find_patient_resources(bundle)
+        ]
+        self.results = {}
+        self.misses = {}
+
+        for patient in self.patients:
+            for address in patient.get("address", []):
+                one_line = _one_line_address(address)
+                key = normalize_address(one_line)
+                if key in self.results or key in self.misses:
+                    continue
+                found, result = cache.get(key) if cache is not None else (False, None)
+                if found:
+                    self.results[key] = result
+                else:
+                    self.misses[key] = one_line
+
+    def update(self, geocoded: List[Optional[GeocodeRecord]]) -> None:
+        """
+        Standardize every patient address, given the results of geocoding the
+        misses.
+
+        :param geocoded: The geocoded record for each one-line address in misses,
+        in the same order, with None for addresses that could not be geocoded
+        """
+        for key, result in zip(self.misses, geocoded):
+            self.results[key] = result
+            if self.cache is not None:
+                self.cache.set(key, result)
+
+        for patient in self.patients:
+            _standardize_patient_addresses(
+                patient,
+                [
+                    self.results.get(normalize_address(_one_line_address(address)))
+                    for address in patient.get("address", [])
+                ],
+            )
+
+
+def _one_line_address(address: dict) -> str:
+    """Generate a one-line address from a FHIR address, to pass to the geocoder"""
+    one_line = " ".join(address.get("line", []))
+    one_line += f" {address.get('city')}, {address.get('state')}"
+    if "postalCode" in address and address["postalCode"]:
+        one_line += f" {address['postalCode']}"
+    return one_line
+
+
+def _standardize_patient_addresses(
+    patient: dict,
+    geocoded: List[Union[GeocodeRecord, GeocodeResult, None]],
+    one_lines: List[str] = None,
+) -> None:
+    """Replace each of a patient's addresses with its geocoded result, if there is
+    one, and record whether any address was changed.  The one-line form of each
+    address is computed unless it is given."""
+    if "extension" not in patient:
+        patient["extension"] = []
+
+    addresses = patient.get("address", [])
+    if one_lines is None:
+        one_lines = [_one_line_address(address) for address in addresses]
+
+    raw_addresses = []
+    std_addresses = []
+    for address, one_line, result in zip(addresses, one_lines, geocoded):
+        raw_addresses.append(one_line)
+
+        if result:
+            address["line"] = list(result.address)
+            address["city"] = result.city
+            address["state"] = result.state
+            address["postalCode"] = result.zipcode
+            std_one_line = f"{result.address} {result.city}, {result.state} {result.zipcode}"  # noqa
+            std_addresses.append(std_one_line)
+
+            if "extension" not in address:
+                address["extension"] = []
+
+            address["extension"].append(
+                {
+                    "url": "http://hl7.org/fhir/StructureDefinition/geolocation",
+                    "extension": [
+                        {"url": "latitude", "valueDecimal": result.lat},
+                        {"url": "longitude", "valueDecimal": result.lng},
+                    ],
+                }
+            )
+    any_dffs = (len(raw_addresses) != len(std_addresses)) or any(
+        [raw_addresses[i] != std_addresses[i] for i in range(len(raw_addresses))]
+    )
+    patient["extension"].append(
+        {
+            "url": "http://usds.gov/fhir/phdi/StructureDefinition/address-was-standardized",  # noqa
+            "valueBoolean": any_dffs,
+        }
+    )
@@ -1,4 +1,14 @@
+import collections
 import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from phdi_building_blocks.utils import batched
+
+# The number of patients whose link strings are hashed together by a worker
+LINKAGE_BATCH_SIZE = 5000
 
 
 def add_patient_identifier(bundle: dict, salt_str: str) -> dict:
@@ -17,45 +27,137 @@ def add_patient_identifier(bundle: dict, salt_str: str) -> dict:
     for resource in bundle["entry"]:
         if resource["resource"]["resourceType"] == "Patient":
             patient = resource["resource"]
+            _add_patient_identifier(patient, salt_str, _linking_address_line(patient))
 
-            # Combine given and family name
-            recent_name = next(
-                (name for name in patient["name"] if name.get("use") == "official"),
-                patient["name"][0],
-            )
 
-            name_parts = recent_name.get("given", []) + [recent_name.get("family")]
-            name_str = "-".join([n for n in name_parts if n])
-
-            # Compile one-line address string
-            address_line = ""
-            if "address" in patient:
-                address = next(
-                    (addr for addr in patient["address"] if addr.get("use") == "home"),
-                    patient["address"][0],
-                )
-                address_line = " ".join(address.get("line", []))
-                address_line += f" {address.get('city')}, {address.get('state')}"
-                if "postalCode" in address and address["postalCode"]:
-                    address_line += f" {address['postalCode']}"
-
-            # Generate and store unique hash code
-            link_str = name_str + "-" + patient["birthDate"] + "-" + address_line
-            hashcode = generate_hash_str(link_str, salt_str)
-
-            if "identifier" not in patient:
-                patient["identifier"] = []
-
-            patient["identifier"].append(
-                {
-                    "value": hashcode,
-                    # Note: this system value corresponds to the FHIR specification
-                    # for a globally used / generated ID or UUID--the standard here
-                    # is to make the use "temporary" even if it's not
-                    "system": "urn:ietf:rfc:3986",
-                    "use": "temp",
-                }
+def link_patients(
+    patients: Iterable[dict],
+    salt_str: str,
+    update: bool = False,
+    batch_size: int = LINKAGE_BATCH_SIZE,
+    max_workers: int = None,
+) -> Iterator[Union[Tuple[str, Optional[str]], dict]]:
+    """
+    Generate linking identifiers for a stream of Patient resources, such as those
+    read from an NDJSON export, as add_patient_identifier does for a bundle.  The
+    link strings are built in batches of batch_size patients, and each batch is
+    hashed in a pool of worker processes, so that re-linking a full export (after
+    a salt rotation, say) scales across cores.  Only a few batches per worker are
+    in flight at once, so memory use is bounded however long the stream is.
+
+    Patients missing the name or birth date their link string is built from are
+    logged and passed through without an identifier, so that one malformed record
+    doesn't abort the stream.
+
+    :param patients: The Patient resources
+    :param salt_str: The salt the link strings are hashed with
+    :param update: Whether to yield each patient with the identifier added to it,
+    rather than a (patient id, hash) pair
+    :param batch_size: The number of patients hashed together by a worker
+    :param max_workers: The number of worker processes, defaults to the number of
+    CPUs
+    :yield: A (patient id, hash) pair, or the updated patient, for each patient in
+    the order they were given.  The hash is None for patients that couldn't be
+    linked, and they are yielded unchanged when updating.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers) as executor:
+        in_flight = collections.deque()
+        for batch in batched(patients, batch_size):
+            link_strs = [_bulk_link_string(patient) for patient in batch]
+            hashes = executor.submit(
+                generate_hash_strs, [s for s in link_strs if s is not None], salt_str
             )
+            in_flight.append((batch, link_strs, hashes))
+            if len(in_flight) > 2 * max_workers:
+                yield from _linked(*in_flight.popleft(), update)
+        while in_flight:
+            yield from _linked(*in_flight.popleft(), update)
+
+
+def _bulk_link_string(patient: dict) -> Optional[str]:
+    """Build a patient's link string, or log and return None if the patient is
+    missing the fields it is built from"""
+    try:
+        return _link_string(patient, _linking_address_line(patient))
+    except (KeyError, IndexError, TypeError) as error:
+        logging.warning(
+            f"Patient {patient.get('id')} can't be linked, missing {error!r}"
+        )
+        return None
+
+
+def _linked(
+    batch: List[dict], link_strs: List[Optional[str]], hashes, update: bool
+) -> Iterator[Union[Tuple[str, Optional[str]], dict]]:
+    hashcodes = iter(hashes.result())
+    for patient, link_str in zip(batch, link_strs):
+        hashcode = next(hashcodes) if link_str is not None else None
+        if update:
+            if hashcode is not None:
+                _append_identifier(patient, hashcode)
+            yield patient
+        else:
+            yield (patient.get("id"), hashcode)
+
+
+def _linking_address_line(patient: dict) -> str:
+    """Get the one-line form of a patient's linking address that
+    add_patient_identifier generates their identifier from"""
+    address = _linking_address(patient)
+    if address is None:
+        return ""
+    address_line = " ".join(address.get("line", []))
+    address_line += f" {address.get('city')}, {address.get('state')}"
+    if address.get("postalCode"):
+        address_line += f" {address['postalCode']}"
+    return address_line
+
+
+def _linking_address(patient: dict) -> Optional[dict]:
+    """Get the address a patient's identifier is generated from: their home
+    address, or else their first address, or None if they have no address"""
+    if "address" not in patient:
+        return None
+    return next(
+        (addr for addr in patient["address"] if addr.get("use") == "home"),
+        patient["address"][0],
+    )
+
+
+def _add_patient_identifier(patient: dict, salt_str: str, address_line: str) -> None:
+    """Generate a patient's identifier from their name, birth date and one-line
+    linking address, and add it to their identifiers"""
+    hashcode = generate_hash_str(_link_string(patient, address_line), salt_str)
+    _append_identifier(patient, hashcode)
+
+
+def _link_string(patient: dict, address_line: str) -> str:
+    """Build the string a patient's identifier is the hash of"""
+    # Combine given and family name
+    recent_name = next(
+        (name for name in patient["name"] if name.get("use") == "official"),
+        patient["name"][0],
+    )
+    name_parts = recent_name.get("given", []) + [recent_name.get("family")]
+    name_str = "-".join([n for n in name_parts if n])
+    return "-".join([name_str, patient["birthDate"], address_line])
+
+
+def _append_identifier(patient: dict, hashcode: str) -> None:
+    if "identifier" not in patient:
+        patient["identifier"] = []
+
+    patient["identifier"].append(
+        {
+            "value": hashcode,
+            # Note: this system value corresponds to the FHIR specification
+            # for a globally used / generated ID or UUID--the standard here
+            # is to make the use "temporary" even if it's not
+            "system": "urn:ietf:rfc:3986",
+            "use": "temp",
+        }
+    )
 
 
 def generate_hash_str(linking_identifier: str, salt_str: str) -> str:
@@ -64,7 +166,17 @@ def generate_hash_str(linking_identifier: str, salt_str: str) -> str:
     a hash for this string to serve as a "unique" identifier for the
     patient.
     """
-    hash_obj = hashlib.sha256()
-    to_encode = (linking_identifier + salt_str).encode("utf-8")
-    hash_obj.update(to_encode)
-    return hash_obj.hexdigest()
+    return hashlib.sha256((linking_identifier + salt_str).encode("utf-8")).hexdigest()
+
+
+def generate_hash_strs(linking_identifiers: List[str], salt_str: str) -> List[str]:
+    """
+    Generate the hash of each of a list of linking identifier strings, as
+    generate_hash_str does.
+    """
+    salt = salt_str.encode("utf-8")
+    sha256 = hashlib.sha256
+    return [
+        sha256(linking_identifier.encode("utf-8") + salt).hexdigest()
+        for linking_identifier in linking_identifiers
+    ]
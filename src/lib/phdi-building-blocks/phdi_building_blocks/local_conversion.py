@@ -0,0 +1,529 @@
+import logging
+import re
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from phdi_building_blocks.conversion import FhirConverter, clean_message
+
+# Message types that the local converter knows how to convert.  Anything else is
+# passed to the fallback converter.
+SUPPORTED_MESSAGE_TYPES = ("ORU_R01", "VXU_V04")
+
+# Maps HL7 v2 coding system identifiers to FHIR code system URIs
+CODE_SYSTEMS = {
+    "LN": "http://loinc.org",
+    "SCT": "http://snomed.info/sct",
+    "SNM": "http://snomed.info/sct",
+    "CVX": "http://hl7.org/fhir/sid/cvx",
+    "MVX": "http://hl7.org/fhir/sid/mvx",
+    "CPT": "http://www.ama-assn.org/go/cpt",
+    "UCUM": "http://unitsofmeasure.org",
+    "I9CDX": "http://hl7.org/fhir/sid/icd-9-cm",
+    "I10": "http://hl7.org/fhir/sid/icd-10-cm",
+    "HL70001": "http://terminology.hl7.org/CodeSystem/v2-0001",
+    "HL70162": "http://terminology.hl7.org/CodeSystem/v2-0162",
+    "HL70163": "http://terminology.hl7.org/CodeSystem/v2-0163",
+}
+
+# PID-8 administrative sex to FHIR gender
+GENDERS = {"M": "male", "F": "female", "O": "other", "U": "unknown"}
+
+# OBX-11 / OBR-25 result status to FHIR Observation and DiagnosticReport status
+RESULT_STATUSES = {
+    "F": "final",
+    "C": "corrected",
+    "P": "preliminary",
+    "I": "registered",
+    "R": "preliminary",
+    "X": "cancelled",
+    "D": "entered-in-error",
+    "W": "entered-in-error",
+}
+
+# Namespace for the deterministic resource ids generated by the local converter
+_RESOURCE_NAMESPACE = uuid.UUID("5e0bd4a6-8d43-4c4e-9d55-b2c3b9a0f0c7")
+
+_DATETIME_REGEX = re.compile(
+    r"^(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\.\d+)?([+-]\d{4})?$"
+)
+
+
+class Hl7Segment:
+    """
+    A single segment of an HL7 v2 message, split into fields.  Field numbers match
+    the HL7 specification, so for MSH segments field 1 is the field separator and
+    field 2 the encoding characters.
+    """
+
+    def __init__(self, line: str, separators: Dict[str, str]):
+        self.separators = separators
+        fields = line.split(separators["field"])
+        self.name = fields[0]
+        if self.name == "MSH":
+            fields.insert(1, separators["field"])
+        self.fields = fields
+
+    def field(self, number: int) -> str:
+        """Get the raw content of a field, or an empty string if it is missing"""
+        return self.fields[number] if number < len(self.fields) else ""
+
+    def repetitions(self, number: int) -> List[List[str]]:
+        """Get every non-empty repetition of a field, split into unescaped
+        components"""
+        return [
+            [self.unescape(c) for c in rep.split(self.separators["component"])]
+            for rep in self.field(number).split(self.separators["repetition"])
+            if rep.strip(self.separators["component"])
+        ]
+
+    def components(self, number: int) -> List[str]:
+        """Get the unescaped components of the first repetition of a field"""
+        reps = self.repetitions(number)
+        return reps[0] if reps else []
+
+    def value(self, number: int, component: int = 1) -> str:
+        """Get a single unescaped component of a field, numbered from 1"""
+        components = self.components(number)
+        return components[component - 1] if component <= len(components) else ""
+
+    def unescape(self, value: str) -> str:
+        """Replace HL7 escape sequences for the delimiters with the delimiters"""
+        escape = self.separators["escape"]
+        if not escape or escape not in value:
+            return value
+        for code, key in (
+            ("F", "field"),
+            ("S", "component"),
+            ("R", "repetition"),
+            ("T", "subcomponent"),
+        ):
+            value = value.replace(f"{escape}{code}{escape}", self.separators[key])
+        return value.replace(f"{escape}E{escape}", escape)
+
+
+def parse_hl7_segments(message: str) -> List[Hl7Segment]:
+    """
+    Split an HL7 v2 message into segments, using the delimiters declared in its
+    MSH segment.  Segments may be terminated with \r, \n or both.
+    """
+    lines = [line for line in re.split("[\r\n]+", message) if line.strip()]
+    if not lines or not lines[0].startswith("MSH"):
+        raise ValueError("Message does not start with an MSH segment")
+
+    header = lines[0]
+    encoding = header[4:8]
+    separators = {
+        "field": header[3],
+        "component": encoding[0:1] or "^",
+        "repetition": encoding[1:2] or "~",
+        "escape": encoding[2:3],
+        "subcomponent": encoding[3:4] or "&",
+    }
+    return [Hl7Segment(line, separators) for line in lines]
+
+
+def hl7_to_fhir_datetime(hl7_datetime: str) -> Optional[str]:
+    """
+    Convert an HL7 v2 datetime (YYYY[MM[DD[HH[MM[SS[.S]]]]]][+/-ZZZZ]) to a FHIR
+    date or dateTime, keeping the precision of the original value.  FHIR requires
+    a time zone on any dateTime with a time, so a time without an offset is
+    dropped, leaving the date.
+
+    >>> hl7_to_fhir_datetime("20180808")
+    '2018-08-08'
+    >>> hl7_to_fhir_datetime("202005141100-0500")
+    '2020-05-14T11:00:00-05:00'
+    >>> hl7_to_fhir_datetime("202005141100")
+    '2020-05-14'
+    """
+    parts = _parse_hl7_datetime(hl7_datetime)
+    if parts is None:
+        return None
+    date, time, offset = parts
+    return f"{date}T{time}{offset}" if time and offset else date
+
+
+def hl7_to_fhir_instant(hl7_datetime: str) -> Optional[str]:
+    """
+    Convert an HL7 v2 datetime to a FHIR instant, which always has a time and a
+    time zone.  Times without an offset are taken to be in UTC, and datetimes
+    without a time can't be converted.
+
+    >>> hl7_to_fhir_instant("202005141100")
+    '2020-05-14T11:00:00+00:00'
+    >>> hl7_to_fhir_instant("20200514") is None
+    True
+    """
+    parts = _parse_hl7_datetime(hl7_datetime)
+    if parts is None or not parts[1]:
+        return None
+    date, time, offset = parts
+    return f"{date}T{time}{offset or '+00:00'}"
+
+
+def _parse_hl7_datetime(hl7_datetime: str) -> Optional[Tuple[str, str, str]]:
+    """Split an HL7 v2 datetime into a FHIR date, and a time and offset, which are
+    empty if the datetime doesn't have them"""
+    match = _DATETIME_REGEX.match(hl7_datetime.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    date = year
+    if month:
+        date += f"-{month}"
+    if day:
+        date += f"-{day}"
+    time = ""
+    if hour:
+        time = f"{hour}:{minute or '00'}:{second or '00'}{fraction or ''}"
+    return date, time, f"{offset[:3]}:{offset[3:]}" if offset else ""
+
+
+def hl7_to_fhir_date(hl7_datetime: str) -> Optional[str]:
+    """Convert an HL7 v2 datetime to a FHIR date, dropping any time"""
+    parts = _parse_hl7_datetime(hl7_datetime)
+    return parts[0] if parts else None
+
+
+def codeable_concept(components: List[str]) -> Optional[dict]:
+    """
+    Convert the components of a CE or CWE field (identifier, text, coding system,
+    and the same again for an alternate code) to a FHIR CodeableConcept
+    """
+    components = components + [""] * (6 - len(components))
+    codings = []
+    for code, display, system in (components[0:3], components[3:6]):
+        if not code:
+            continue
+        coding = {"code": code}
+        if display:
+            coding["display"] = display
+        if system:
+            coding["system"] = CODE_SYSTEMS.get(system, system)
+        codings.append(coding)
+
+    if not codings and not components[1]:
+        return None
+    concept = {}
+    if codings:
+        concept["coding"] = codings
+    if components[1] or components[4]:
+        concept["text"] = components[1] or components[4]
+    return concept
+
+
+class LocalHl7v2Converter(FhirConverter):
+    """
+    Converts common HL7 v2 messages to FHIR in process, without a round trip to
+    the FHIR server's $convert-data endpoint.  ORU_R01 messages are converted to a
+    Patient with a DiagnosticReport per OBR and an Observation per OBX, and VXU_V04
+    messages to a Patient with an Immunization per RXA.
+
+    The converted bundle is a batch whose entries are PUT to deterministic ids, so
+    converting the same message twice updates rather than duplicates resources.
+    Messages of any other type, or that fail to convert, are passed to the fallback
+    converter if one is given.
+    """
+
+    def __init__(self, fallback: FhirConverter = None):
+        """Local converter constructor
+
+        :param fallback: The converter used for messages this converter does not
+        support, typically a RemoteFhirConverter
+        """
+        self.fallback = fallback
+
+    def convert(
+        self,
+        message: str,
+        filename: str,
+        input_data_type: str,
+        root_template: str,
+        template_collection: str,
+    ) -> dict:
+        if input_data_type == "Hl7v2" and root_template in SUPPORTED_MESSAGE_TYPES:
+            try:
+                return self.convert_hl7v2(clean_message(message))
+            except Exception:
+                logging.exception(f"Local conversion failed for {filename}")
+
+        if self.fallback is not None:
+            return self.fallback.convert(
+                message, filename, input_data_type, root_template, template_collection
+            )
+        return {
+            "http_status_code": None,
+            "response_content": f"Local conversion of {input_data_type} "
+            + f"{root_template} message {filename} is not supported",
+        }
+
+    def convert_hl7v2(self, message: str) -> dict:
+        """Convert a cleaned ORU_R01 or VXU_V04 message to a FHIR batch bundle"""
+        segments = parse_hl7_segments(message)
+        msh = segments[0]
+        message_type = "_".join(msh.components(9)[:2])
+        if message_type not in SUPPORTED_MESSAGE_TYPES:
+            raise ValueError(f"Unsupported message type {message_type}")
+
+        control_id = msh.field(10)
+        builder = _BundleBuilder(control_id)
+        patient = None
+        report = None
+
+        for segment in segments[1:]:
+            if segment.name == "PID":
+                patient = builder.add(_patient(segment))
+            elif segment.name == "OBR":
+                report = builder.add(_diagnostic_report(segment, patient))
+            elif segment.name == "OBX" and message_type == "ORU_R01":
+                observation = builder.add(_observation(segment, patient))
+                if report is not None:
+                    report.setdefault("result", []).append(
+                        {"reference": f"Observation/{observation['id']}"}
+                    )
+            elif segment.name == "RXA":
+                builder.add(_immunization(segment, patient))
+            elif segment.name == "RXR" and builder.last("Immunization"):
+                _add_route(builder.last("Immunization"), segment)
+
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "identifier": {"value": control_id},
+            "entry": builder.entries,
+        }
+        timestamp = hl7_to_fhir_instant(msh.field(7))
+        if timestamp:
+            bundle["timestamp"] = timestamp
+        return bundle
+
+
+class _BundleBuilder:
+    """Assigns deterministic ids to converted resources and collects them into
+    batch bundle entries"""
+
+    def __init__(self, control_id: str):
+        self.control_id = control_id
+        self.entries = []
+
+    def add(self, resource: dict) -> dict:
+        key = f"{self.control_id}|{resource['resourceType']}|{len(self.entries)}"
+        if resource["resourceType"] == "Patient" and resource.get("identifier"):
+            # Key patients on their identifiers so that messages about the same
+            # patient update a single resource
+            key = "|".join(
+                f"{i.get('system', '')}|{i.get('value')}"
+                for i in resource["identifier"]
+            )
+        resource["id"] = str(uuid.uuid5(_RESOURCE_NAMESPACE, key))
+        self.entries.append(
+            {
+                "fullUrl": f"urn:uuid:{resource['id']}",
+                "resource": resource,
+                "request": {
+                    "method": "PUT",
+                    "url": f"{resource['resourceType']}/{resource['id']}",
+                },
+            }
+        )
+        return resource
+
+    def last(self, resource_type: str) -> Optional[dict]:
+        for entry in reversed(self.entries):
+            if entry["resource"]["resourceType"] == resource_type:
+                return entry["resource"]
+        return None
+
+
+def _subject(patient: Optional[dict], field: str = "subject") -> dict:
+    """Reference a patient from a resource's subject, or from the field a resource
+    type uses instead, such as an Immunization's patient"""
+    return {field: {"reference": f"Patient/{patient['id']}"}} if patient else {}
+
+
+def _patient(pid: Hl7Segment) -> dict:
+    patient = {"resourceType": "Patient"}
+
+    identifiers = []
+    for cx in pid.repetitions(3):
+        if not cx[0]:
+            continue
+        identifier = {"value": cx[0]}
+        if len(cx) > 3 and cx[3]:
+            identifier["system"] = cx[3]
+        if len(cx) > 4 and cx[4]:
+            identifier["type"] = {"coding": [{"code": cx[4]}]}
+        identifiers.append(identifier)
+    if identifiers:
+        patient["identifier"] = identifiers
+
+    names = []
+    for xpn in pid.repetitions(5):
+        xpn = xpn + [""] * (7 - len(xpn))
+        name = {}
+        if xpn[0]:
+            name["family"] = xpn[0]
+        given = [part for part in (xpn[1], xpn[2]) if part]
+        if given:
+            name["given"] = given
+        if xpn[4]:
+            name["prefix"] = [xpn[4]]
+        if xpn[3]:
+            name["suffix"] = [xpn[3]]
+        if xpn[6] in ("L", ""):
+            name["use"] = "official"
+        if name:
+            names.append(name)
+    if names:
+        patient["name"] = names
+
+    birth_date = hl7_to_fhir_date(pid.field(7))
+    if birth_date:
+        patient["birthDate"] = birth_date
+    if pid.value(8) in GENDERS:
+        patient["gender"] = GENDERS[pid.value(8)]
+
+    addresses = []
+    for xad in pid.repetitions(11):
+        xad = xad + [""] * (7 - len(xad))
+        address = {}
+        lines = [line for line in xad[0:2] if line]
+        if lines:
+            address["line"] = lines
+        for key, value in (
+            ("city", xad[2]),
+            ("state", xad[3]),
+            ("postalCode", xad[4]),
+            ("country", xad[5]),
+        ):
+            if value:
+                address[key] = value
+        if xad[6] == "H":
+            address["use"] = "home"
+        if address:
+            addresses.append(address)
+    if addresses:
+        patient["address"] = addresses
+
+    telecoms = []
+    for number, use in ((13, "home"), (14, "work")):
+        for xtn in pid.repetitions(number):
+            xtn = xtn + [""] * (12 - len(xtn))
+            if xtn[3] or xtn[2] == "Internet":
+                telecoms.append({"system": "email", "value": xtn[3], "use": use})
+                continue
+            phone = xtn[0] or "".join(xtn[5:7])
+            if phone:
+                system = "fax" if xtn[2] == "FX" else "phone"
+                telecom = {"system": system, "value": phone, "use": use}
+                if xtn[2] == "CP":
+                    telecom["use"] = "mobile"
+                telecoms.append(telecom)
+    if telecoms:
+        patient["telecom"] = telecoms
+
+    return patient
+
+
+def _diagnostic_report(obr: Hl7Segment, patient: Optional[dict]) -> dict:
+    report = {
+        "resourceType": "DiagnosticReport",
+        "status": RESULT_STATUSES.get(obr.value(25), "unknown"),
+        "code": codeable_concept(obr.components(4)) or {"text": "unknown"},
+        **_subject(patient),
+    }
+    if obr.value(3):
+        report["identifier"] = [{"value": obr.value(3)}]
+    effective = hl7_to_fhir_datetime(obr.field(7))
+    if effective:
+        report["effectiveDateTime"] = effective
+    issued = hl7_to_fhir_instant(obr.field(22))
+    if issued:
+        report["issued"] = issued
+    return report
+
+
+def _observation(obx: Hl7Segment, patient: Optional[dict]) -> dict:
+    observation = {
+        "resourceType": "Observation",
+        "status": RESULT_STATUSES.get(obx.value(11), "unknown"),
+        "code": codeable_concept(obx.components(3)) or {"text": "unknown"},
+        **_subject(patient),
+    }
+
+    value_type = obx.value(2)
+    value = obx.components(5)
+    if value_type == "NM" and value and value[0]:
+        quantity = {"value": float(value[0])}
+        units = obx.components(6)
+        if units and units[0]:
+            quantity["unit"] = units[1] if len(units) > 1 and units[1] else units[0]
+            quantity["code"] = units[0]
+            quantity["system"] = "http://unitsofmeasure.org"
+        observation["valueQuantity"] = quantity
+    elif value_type in ("CE", "CWE") and value:
+        concept = codeable_concept(value)
+        if concept:
+            observation["valueCodeableConcept"] = concept
+    elif value_type in ("DT", "TS", "DTM") and value:
+        value_datetime = hl7_to_fhir_datetime(value[0])
+        if value_datetime:
+            observation["valueDateTime"] = value_datetime
+    elif value_type == "SN" and value:
+        observation["valueString"] = "".join(value)
+    elif value and value[0]:
+        observation["valueString"] = obx.unescape(obx.field(5))
+
+    if obx.value(8):
+        observation["interpretation"] = [{"coding": [{"code": obx.value(8)}]}]
+    effective = hl7_to_fhir_datetime(obx.field(14))
+    if effective:
+        observation["effectiveDateTime"] = effective
+    return observation
+
+
+def _immunization(rxa: Hl7Segment, patient: Optional[dict]) -> dict:
+    if rxa.value(20) in ("RE", "NA"):
+        status = "not-done"
+    elif rxa.value(21) == "D":
+        status = "entered-in-error"
+    else:
+        status = "completed"
+
+    immunization = {
+        "resourceType": "Immunization",
+        "status": status,
+        "vaccineCode": codeable_concept(rxa.components(5)) or {"text": "unknown"},
+        **_subject(patient, "patient"),
+    }
+    occurrence = hl7_to_fhir_datetime(rxa.field(3))
+    if occurrence:
+        immunization["occurrenceDateTime"] = occurrence
+
+    amount = rxa.value(6)
+    if amount and amount != "999":
+        dose = {"value": float(amount)}
+        if rxa.value(7):
+            dose["unit"] = rxa.value(7)
+        immunization["doseQuantity"] = dose
+
+    if rxa.value(15):
+        immunization["lotNumber"] = rxa.value(15)
+    expiration = hl7_to_fhir_date(rxa.field(16))
+    if expiration:
+        immunization["expirationDate"] = expiration
+    manufacturer = rxa.components(17)
+    if manufacturer and (manufacturer[0] or len(manufacturer) > 1):
+        immunization["manufacturer"] = {
+            "display": manufacturer[1] if len(manufacturer) > 1 else manufacturer[0]
+        }
+    return immunization
+
+
+def _add_route(immunization: dict, rxr: Hl7Segment) -> None:
+    route = codeable_concept(rxr.components(1))
+    if route:
+        immunization["route"] = route
+    site = codeable_concept(rxr.components(2))
+    if site:
+        immunization["site"] = site
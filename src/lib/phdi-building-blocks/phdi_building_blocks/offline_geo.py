@@ -0,0 +1,154 @@
+import csv
+import re
+from typing import Dict, Iterable, List, Optional
+
+from phdi_building_blocks.geo import GeocodeRecord, Geocoder, normalize_address
+
+# Common USPS street suffix and directional abbreviations, so that addresses
+# written with and without them match
+STREET_ABBREVIATIONS = {
+    "AVENUE": "AVE",
+    "BOULEVARD": "BLVD",
+    "CIRCLE": "CIR",
+    "COURT": "CT",
+    "DRIVE": "DR",
+    "HIGHWAY": "HWY",
+    "LANE": "LN",
+    "PARKWAY": "PKWY",
+    "PLACE": "PL",
+    "ROAD": "RD",
+    "SQUARE": "SQ",
+    "STREET": "ST",
+    "TERRACE": "TER",
+    "TRAIL": "TRL",
+    "NORTH": "N",
+    "SOUTH": "S",
+    "EAST": "E",
+    "WEST": "W",
+    "NORTHEAST": "NE",
+    "NORTHWEST": "NW",
+    "SOUTHEAST": "SE",
+    "SOUTHWEST": "SW",
+}
+
+# Secondary unit designators, which are dropped when an address with a unit does
+# not match the reference data
+UNIT_DESIGNATORS = {"APT", "APARTMENT", "UNIT", "STE", "SUITE", "RM", "ROOM", "FL"}
+
+_ZIP_REGEX = re.compile(r"^(\d{5})(-?\d{4})?$")
+
+# The columns of a reference dataset, named after the GeocodeRecord fields
+REFERENCE_COLUMNS = (
+    "address",
+    "city",
+    "state",
+    "zipcode",
+    "county_fips",
+    "county_name",
+    "lat",
+    "lng",
+)
+
+
+def address_keys(address: str) -> List[str]:
+    """
+    Get the keys a one-line address is indexed and matched on, from the most to the
+    least specific: the full address with a 5 digit zip code, then without the zip
+    code, then both again without any secondary unit.
+
+    >>> address_keys("12 Oak Avenue, Springfield, IL 62701-1234")
+    ['12 OAK AVE SPRINGFIELD IL 62701', '12 OAK AVE SPRINGFIELD IL']
+    >>> address_keys("12 Oak Ave Apt 4, Springfield, IL")
+    ['12 OAK AVE APT 4 SPRINGFIELD IL', '12 OAK AVE SPRINGFIELD IL']
+    """
+    tokens = [
+        STREET_ABBREVIATIONS.get(token, token)
+        for token in normalize_address(address).split()
+    ]
+    zipcode = None
+    if tokens:
+        match = _ZIP_REGEX.match(tokens[-1])
+        if match:
+            zipcode = match.group(1)
+            tokens = tokens[:-1]
+
+    variants = [tokens]
+    without_unit = _drop_unit(tokens)
+    if without_unit != tokens:
+        variants.append(without_unit)
+
+    keys = []
+    for variant in variants:
+        if zipcode:
+            keys.append(" ".join(variant + [zipcode]))
+        keys.append(" ".join(variant))
+    return keys
+
+
+def _drop_unit(tokens: List[str]) -> List[str]:
+    for i, token in enumerate(tokens):
+        if token in UNIT_DESIGNATORS and i + 1 < len(tokens):
+            return tokens[:i] + tokens[i + 2 :]  # noqa: E203
+    return tokens
+
+
+class OfflineGeocoder(Geocoder):
+    """
+    Geocodes addresses against a locally loaded reference dataset of address
+    points, such as an extract of TIGER or state address point data, without any
+    network calls.  The reference addresses are held in an in-memory index keyed
+    on normalized addresses, so lookups run at local CPU speed, which suits bulk
+    reprocessing of historical records.
+
+    An address matches a reference address if they are the same once normalized
+    (case, punctuation, spacing, common street abbreviations and zip+4 codes),
+    falling back to matching without the zip code and without a secondary unit.
+    """
+
+    def __init__(self, records: Iterable[Dict[str, str]], precision: str = "Offline"):
+        """Offline geocoder constructor
+
+        :param records: The reference addresses, as dictionaries with the keys in
+        REFERENCE_COLUMNS.  The address is the delivery line, and a precision key
+        may be included to override the default precision.
+        :param precision: The precision reported for matches by default
+        """
+        self.precision = precision
+        self.index = {}
+        for record in records:
+            result = self._result(record)
+            one_line = f"{result.address[0]} {result.city}, {result.state}"
+            for key in address_keys(f"{one_line} {result.zipcode}"):
+                # Keep the first reference address for keys shared by many
+                self.index.setdefault(key, result)
+
+    @classmethod
+    def from_csv(cls, path: str, **kwargs) -> "OfflineGeocoder":
+        """Build an offline geocoder from a CSV file of reference addresses, with
+        a header row naming the columns in REFERENCE_COLUMNS"""
+        with open(path, newline="") as reference:
+            return cls(csv.DictReader(reference), **kwargs)
+
+    def geocode_records(self, addresses: List[str]) -> List[Optional[GeocodeRecord]]:
+        return [self._match(address) for address in addresses]
+
+    def _match(self, address: str) -> Optional[GeocodeRecord]:
+        for key in address_keys(address):
+            if key in self.index:
+                return self.index[key]
+        return None
+
+    def _result(self, record: Dict[str, str]) -> GeocodeRecord:
+        # Reference data is read as text, so the coordinates are converted here,
+        # as GeocodeResult would on validation
+        return GeocodeRecord(
+            address=[record["address"].upper()],
+            city=record["city"],
+            state=record["state"],
+            zipcode=record["zipcode"],
+            county_fips=record["county_fips"],
+            county_name=record["county_name"],
+            lat=float(record["lat"]),
+            lng=float(record["lng"]),
+            precision=record.get("precision") or self.precision,
+        )
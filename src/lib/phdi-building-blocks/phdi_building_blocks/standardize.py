@@ -1,9 +1,30 @@
+import functools
 import phonenumbers
 import pycountry
-from typing import Callable, Literal, List
+from typing import Callable, Dict, Literal, List, Optional, Tuple
 
+from phdi_building_blocks.cache import CacheStats
 from phdi_building_blocks.utils import find_patient_resources
 
+# The most distinct phone numbers (with their countries) and country values whose
+# standardized forms are kept in memory
+PHONE_CACHE_SIZE = 100000
+COUNTRY_CACHE_SIZE = 4096
+
+# Countries by the uppercase value of each field they can be looked up by, built
+# once so that standardizing a country doesn't search pycountry's database
+_COUNTRY_INDEX = {
+    field: {
+        getattr(country, field).upper(): country
+        for country in pycountry.countries
+        if hasattr(country, field)
+    }
+    for field in ("alpha_2", "alpha_3", "numeric", "name", "official_name")
+}
+
+# Deletes the only numeric characters in ASCII, for the common case of ASCII names
+_ASCII_DIGITS = str.maketrans("", "", "0123456789")
+
 
 def standardize_name(raw: str) -> str:
     """trim spaces and force uppercase
@@ -12,6 +33,9 @@ def standardize_name(raw: str) -> str:
     'JOHN DOE'
     """
 
+    if raw.isascii():
+        return raw.translate(_ASCII_DIGITS).upper().strip()
+
     raw = [x for x in raw if not x.isnumeric()]
     raw = "".join(raw)
     raw = raw.upper()
@@ -28,40 +52,74 @@ def standardize_patient_name(
     specifying a standardization process as long as it accepts and returns a string."""
 
     for resource in find_patient_resources(bundle):
-        patient = resource.get("resource")
-        if "extension" not in patient:
-            patient["extension"] = []
-
-        # Transform names
-        for name in patient.get("name", []):
-            if "family" in name:
-                std_family = standardize(name["family"])
-                raw_family = name["family"]
-                patient["extension"].append(
-                    {
-                        "url": "http://usds.gov/fhir/phdi/StructureDefinition/family-name-was-standardized",  # noqa
-                        "valueBoolean": raw_family != std_family,
-                    }
-                )
-                name["family"] = std_family
-
-            if "given" in name:
-                std_givens = [standardize(g) for g in name["given"]]
-                raw_givens = [g for g in name["given"]]
-                any_diffs = any(
-                    [raw_givens[i] != std_givens[i] for i in range(len(raw_givens))]
-                )
-                patient["extension"].append(
-                    {
-                        "url": "http://usds.gov/fhir/phdi/StructureDefinition/given-name-was-standardized",  # noqa
-                        "valueBoolean": any_diffs,
-                    }
-                )
-                name["given"] = std_givens
+        _standardize_patient_name(resource.get("resource"), standardize)
 
     return bundle
 
 
+def _standardize_patient_name(patient: dict, standardize: Callable) -> None:
+    """Standardize a patient's family and given names, and record whether they
+    changed"""
+    if "extension" not in patient:
+        patient["extension"] = []
+
+    # Transform names
+    for name in patient.get("name", []):
+        if "family" in name:
+            std_family = standardize(name["family"])
+            raw_family = name["family"]
+            patient["extension"].append(
+                {
+                    "url": "http://usds.gov/fhir/phdi/StructureDefinition/family-name-was-standardized",  # noqa
+                    "valueBoolean": raw_family != std_family,
+                }
+            )
+            name["family"] = std_family
+
+        if "given" in name:
+            std_givens = [standardize(g) for g in name["given"]]
+            raw_givens = [g for g in name["given"]]
+            any_diffs = any(
+                [raw_givens[i] != std_givens[i] for i in range(len(raw_givens))]
+            )
+            patient["extension"].append(
+                {
+                    "url": "http://usds.gov/fhir/phdi/StructureDefinition/given-name-was-standardized",  # noqa
+                    "valueBoolean": any_diffs,
+                }
+            )
+            name["given"] = std_givens
+
+
+def standardize_patient_names(
+    bundles: List[dict], standardize: Callable = standardize_name
+) -> List[dict]:
+    """
+    Standardize the patient names in many FHIR bundles at once, as
+    standardize_patient_name does for each bundle. The names in all of the bundles
+    are collected first, so that each distinct name is standardized only once, and
+    the results are then written back to every patient. Names recur heavily across
+    the bundles of a backfill, which makes this much cheaper than standardizing each
+    bundle on its own.
+
+    :param bundles: The FHIR bundles to standardize, which are updated in place
+    :param standardize: The function used to standardize each name
+    :return: The bundles
+    """
+    distinct = set()
+    for bundle in bundles:
+        for resource in find_patient_resources(bundle):
+            for name in resource.get("resource").get("name", []):
+                if "family" in name:
+                    distinct.add(name["family"])
+                distinct.update(name.get("given", []))
+
+    standardized = {raw: standardize(raw) for raw in distinct}
+    for bundle in bundles:
+        standardize_patient_name(bundle, standardized.__getitem__)
+    return bundles
+
+
 def country_extractor(
     resource: dict, code_type: Literal["alpha_2", "alpha_3", "numeric"] = "alpha_2"
 ) -> List[str]:
@@ -104,6 +162,9 @@ def standardize_phone(raw: str, countries: List = [None, "US"]) -> str:
     or a list of countries has not been provided we make a final attempt to parse the
     number assuming it is American.
 
+    Standardized numbers are cached by raw number and countries in a bounded
+    in-memory LRU cache, as phone numbers recur across a patient's messages.
+
     :param str raw: Raw phone number to be standardized.
     :param list countries: A list containing 2 letter ISO country codes for each country
     extracted from resource of the phone number to be standardized that might indicate
@@ -112,8 +173,13 @@ def standardize_phone(raw: str, countries: List = [None, "US"]) -> str:
     phone number was succesfully parsed and an emptry string otherwise.
     """
 
-    if countries != [None, "US"]:
-        countries = [None] + countries + ["US"]
+    return _parse_phone(raw, tuple(countries))
+
+
+@functools.lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _parse_phone(raw: str, countries: Tuple[Optional[str], ...]) -> str:
+    if countries != (None, "US"):
+        countries = (None,) + countries + ("US",)
 
     standardized = ""
     for country in countries:
@@ -136,6 +202,8 @@ def standardize_country(
 ) -> str:
     """
     Given a country return it in a standard form as specified by code_type.
+    Countries are looked up in an index of pycountry's countries built once on import,
+    and the lookups are cached in a bounded in-memory LRU cache.
 
     :param str raw: Country to be standardized.
     :param str code_type: A string equal to 'alpha_2', 'alpha_3', or 'numeric' to
@@ -143,18 +211,7 @@ def standardize_country(
     :return str standard: Country in standardized form, or None if unable to
     standardize.
     """
-    standard = None
-    raw = raw.strip().upper()
-    if len(raw) == 2:
-        standard = pycountry.countries.get(alpha_2=raw)
-    elif len(raw) == 3:
-        standard = pycountry.countries.get(alpha_3=raw)
-        if standard is None:
-            standard = pycountry.countries.get(numeric=raw)
-    elif len(raw) >= 4:
-        standard = pycountry.countries.get(name=raw)
-        if standard is None:
-            standard = pycountry.countries.get(official_name=raw)
+    standard = _lookup_country(raw.strip().upper())
 
     if standard is not None:
         if code_type == "alpha_2":
@@ -167,6 +224,37 @@ def standardize_country(
     return standard
 
 
+@functools.lru_cache(maxsize=COUNTRY_CACHE_SIZE)
+def _lookup_country(raw: str):
+    if len(raw) == 2:
+        fields = ["alpha_2"]
+    elif len(raw) == 3:
+        fields = ["alpha_3", "numeric"]
+    elif len(raw) >= 4:
+        fields = ["name", "official_name"]
+    else:
+        fields = []
+
+    for field in fields:
+        if raw in _COUNTRY_INDEX[field]:
+            return _COUNTRY_INDEX[field][raw]
+    return None
+
+
+def standardization_cache_stats() -> Dict[str, CacheStats]:
+    """
+    Get the hit and miss counts of the in-memory caches of standardized phone numbers
+    and countries, which are kept for the life of the process.
+
+    :return: The statistics of each cache, keyed by "phone" and "country"
+    """
+    stats = {}
+    for name, function in (("phone", _parse_phone), ("country", _lookup_country)):
+        info = function.cache_info()
+        stats[name] = CacheStats(hits=info.hits, misses=info.misses)
+    return stats
+
+
 def standardize_patient_phone(
     bundle: dict, standardize: Callable = standardize_phone
 ) -> dict:
@@ -176,26 +264,67 @@ def standardize_patient_phone(
     specifying a standardization process as long as it accepts and returns a string."""
 
     for resource in find_patient_resources(bundle):
-        patient = resource.get("resource")
-        if "extension" not in patient:
-            patient["extension"] = []
-        # Transform phone numbers
-        raw_phones = []
-        std_phones = []
         countries = country_extractor(resource)
-        for telecom in patient.get("telecom", []):
-            if telecom.get("system") == "phone" and "value" in telecom:
-                transformed_phone = standardize(telecom["value"], countries)
-                raw_phones.append(telecom["value"])
-                std_phones.append(transformed_phone)
-                telecom["value"] = transformed_phone
-        any_diffs = len(raw_phones) != len(std_phones) or any(
-            [raw_phones[i] != std_phones[i] for i in range(len(raw_phones))]
-        )
-        patient["extension"].append(
-            {
-                "url": "http://usds.gov/fhir/phdi/StructureDefinition/phone-was-standardized",  # noqa
-                "valueBoolean": any_diffs,
-            }
+        _standardize_patient_phone(
+            resource.get("resource"), lambda raw: standardize(raw, countries)
         )
     return bundle
+
+
+def standardize_patient_phones(
+    bundles: List[dict], standardize: Callable = standardize_phone
+) -> List[dict]:
+    """
+    Standardize the patient phone numbers in many FHIR bundles at once, as
+    standardize_patient_phone does for each bundle. Each distinct phone number is
+    parsed only once for the countries of the patients it belongs to, and the
+    results are then written back to every patient.
+
+    :param bundles: The FHIR bundles to standardize, which are updated in place
+    :param standardize: The function used to standardize each phone number
+    :return: The bundles
+    """
+    patients = [
+        (resource.get("resource"), tuple(country_extractor(resource)))
+        for bundle in bundles
+        for resource in find_patient_resources(bundle)
+    ]
+    distinct = {
+        (telecom["value"], countries)
+        for patient, countries in patients
+        for telecom in patient.get("telecom", [])
+        if telecom.get("system") == "phone" and "value" in telecom
+    }
+
+    standardized = {
+        (raw, countries): standardize(raw, list(countries))
+        for raw, countries in distinct
+    }
+    for patient, countries in patients:
+        _standardize_patient_phone(patient, lambda raw: standardized[(raw, countries)])
+    return bundles
+
+
+def _standardize_patient_phone(patient: dict, standardize: Callable) -> None:
+    """Standardize a patient's phone numbers with a function of the raw number, and
+    record whether any of them changed"""
+    if "extension" not in patient:
+        patient["extension"] = []
+    # Transform phone numbers
+    raw_phones = []
+    std_phones = []
+    for telecom in patient.get("telecom", []):
+        if telecom.get("system") == "phone" and "value" in telecom:
+            transformed_phone = standardize(telecom["value"])
+            raw_phones.append(telecom["value"])
+            std_phones.append(transformed_phone)
+            telecom["value"] = transformed_phone
+    any_diffs = len(raw_phones) != len(std_phones) or any(
+        [raw_phones[i] != std_phones[i] for i in range(len(raw_phones))]
+    )
+    patient["extension"].append(
+        {
+            "url": "http://usds.gov/fhir/phdi/StructureDefinition/phone-was-standardized",  # noqa
+            "valueBoolean": any_diffs,
+        }
+    )
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional
 
 
 def find_patient_resources(bundle: dict) -> List[dict]:
@@ -8,3 +8,118 @@ def find_patient_resources(bundle: dict) -> List[dict]:
         for r in bundle.get("entry")
         if r.get("resource").get("resourceType") == "Patient"
     ]
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    """
+    Split an iterable into lists of size items, the last of which may be shorter,
+    reading only one list's worth of items ahead.
+
+    >>> list(batched(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BundleIndex:
+    """
+    An index of the entries in a FHIR bundle, by resource type and by the
+    references that resolve to them: each entry's fullUrl, and ResourceType/id for
+    resources with an id.  The index is built in one pass over the entries the
+    first time it is used, so finding the entries of a type or resolving a
+    reference doesn't scan the bundle.
+
+    Entries added through add, or appended to the bundle's entry list by other
+    means, are indexed incrementally the next time the index is used.  Removing an
+    entry through remove, or replacing or shrinking the entry list, rebuilds the
+    index when it is next used; call invalidate after any other change, such as
+    inserting or replacing entries, or changing a resource's id.
+
+    >>> index = BundleIndex({"entry": [{"fullUrl": "urn:uuid:1",
+    ...     "resource": {"resourceType": "Patient", "id": "1"}}]})
+    >>> index.resolve("Patient/1") is index.resolve("urn:uuid:1")
+    True
+    >>> index.by_type("Observation")
+    []
+    """
+
+    def __init__(self, bundle: dict):
+        """
+        :param bundle: The FHIR bundle to index
+        """
+        self.bundle = bundle
+        self._entries = None
+        self._length = 0
+        self._by_type: Dict[str, List[dict]] = {}
+        self._by_reference: Dict[str, dict] = {}
+
+    def by_type(self, resource_type: str) -> List[dict]:
+        """Get the entries holding resources of a type, in bundle order"""
+        self._refresh()
+        return list(self._by_type.get(resource_type, []))
+
+    def resolve(self, reference: str) -> Optional[dict]:
+        """
+        Get the entry a reference resolves to, or None if it isn't in the bundle.
+
+        :param reference: A fullUrl, a relative ResourceType/id reference, or an
+        absolute URL ending in ResourceType/id
+        """
+        self._refresh()
+        entry = self._by_reference.get(reference)
+        if entry is None and reference.count("/") > 1:
+            # An absolute reference to a resource that has no fullUrl
+            entry = self._by_reference.get("/".join(reference.rsplit("/", 2)[-2:]))
+        return entry
+
+    def add(self, entry: dict) -> None:
+        """Append an entry to the bundle, and index it"""
+        self.bundle.setdefault("entry", []).append(entry)
+        self._refresh()
+
+    def remove(self, entry: dict) -> None:
+        """Remove an entry from the bundle, and from the index"""
+        entries = self.bundle.get("entry", [])
+        del entries[next(i for i, e in enumerate(entries) if e is entry)]
+        # A later entry may now be the one a removed reference resolves to
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Rebuild the index the next time it is used"""
+        self._entries = None
+
+    def _refresh(self) -> None:
+        entries = self.bundle.get("entry") or []
+        if entries is not self._entries or len(entries) < self._length:
+            self._entries = entries
+            self._length = 0
+            self._by_type = {}
+            self._by_reference = {}
+        # Index any entries appended since the index was last used
+        for entry in entries[self._length :]:  # noqa: E203
+            self._by_type.setdefault(_resource_type(entry), []).append(entry)
+            for key in _reference_keys(entry):
+                # As with duplicate references in a bundle, the first entry wins
+                self._by_reference.setdefault(key, entry)
+        self._length = len(entries)
+
+
+def _resource_type(entry: dict) -> Optional[str]:
+    return (entry.get("resource") or {}).get("resourceType")
+
+
+def _reference_keys(entry: dict) -> List[str]:
+    keys = []
+    if entry.get("fullUrl"):
+        keys.append(entry["fullUrl"])
+    resource = entry.get("resource") or {}
+    if resource.get("resourceType") and resource.get("id"):
+        keys.append(f"{resource['resourceType']}/{resource['id']}")
+    return keys
@@ -0,0 +1,30 @@
+from smartystreets_python_sdk.us_street.candidate import Candidate
+from smartystreets_python_sdk.us_street.components import Components
+from smartystreets_python_sdk.us_street.metadata import Metadata
+
+
+def make_candidate(street: str) -> Candidate:
+    """A SmartyStreets candidate for a street address in New York"""
+    candidate = Candidate({})
+    candidate.delivery_line_1 = street.split(",")[0].upper()
+    candidate.metadata = Metadata(
+        {
+            "latitude": 45.123,
+            "longitude": -70.234,
+            "county_fips": "36061",
+            "county_name": "New York",
+            "precision": "Zip9",
+        }
+    )
+    candidate.components = Components(
+        {"zipcode": "10001", "city_name": "New York", "state_abbreviation": "NY"}
+    )
+    return candidate
+
+
+def fill_in_batch(batch) -> None:
+    """A SmartyStreets client's send_batch, which finds a candidate for every
+    lookup except those on Nowhere St"""
+    for lookup in batch:
+        if "Nowhere" not in lookup.street:
+            lookup.result = [make_candidate(lookup.street)]
@@ -0,0 +1,135 @@
+import asyncio
+import copy
+import json
+import pathlib
+import threading
+import time
+from unittest import mock
+
+import pytest
+from smartystreets_python_sdk.exceptions import TooManyRequestsError
+
+from phdi_building_blocks.async_geo import AsyncGeocoder, TokenBucket
+from tests.conftest import make_candidate
+
+
+class SlowClient:
+    """A fake SmartyStreets client that records how many requests are in flight"""
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _send(self, lookups):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        for lookup in lookups:
+            lookup.result = [make_candidate(lookup.street)]
+        with self.lock:
+            self.in_flight -= 1
+
+    def send_lookup(self, lookup):
+        self._send([lookup])
+
+    def send_batch(self, batch):
+        self._send(list(batch))
+
+
+def test_async_geocoder_concurrency():
+    client = SlowClient()
+    geocoder = AsyncGeocoder(client, max_concurrency=3, rate=1000)
+
+    async def geocode_all():
+        return await asyncio.gather(
+            *[geocoder.geocode(f"{i} Fake St, New York, NY") for i in range(12)]
+        )
+
+    results = asyncio.run(geocode_all())
+
+    assert [result.address for result in results] == [
+        [f"{i} FAKE ST"] for i in range(12)
+    ]
+    assert client.max_in_flight == 3
+
+
+def test_async_geocoder_batch():
+    client = SlowClient()
+    geocoder = AsyncGeocoder(client, rate=1000)
+    addresses = [f"{i} Fake St, New York, NY" for i in range(250)]
+
+    results = asyncio.run(geocoder.geocode_batch(addresses))
+
+    assert client.requests == 3
+    assert [result.address[0] for result in results] == [
+        f"{i} FAKE ST" for i in range(250)
+    ]
+
+
+@mock.patch("phdi_building_blocks.async_geo.random.uniform", return_value=0)
+def test_async_geocoder_retries(patched_uniform):
+    client = mock.Mock()
+    client.send_lookup.side_effect = [TooManyRequestsError(), None]
+    geocoder = AsyncGeocoder(client, retries=1)
+
+    assert asyncio.run(geocoder.geocode("123 Nowhere St, Atlantis GA")) is None
+    assert client.send_lookup.call_count == 2
+
+    client.send_lookup.side_effect = TooManyRequestsError()
+    with pytest.raises(TooManyRequestsError):
+        asyncio.run(geocoder.geocode("123 Nowhere St, Atlantis GA"))
+    assert client.send_lookup.call_count == 4
+
+
+def test_async_geocoder_timeout():
+    geocoder = AsyncGeocoder(SlowClient(delay=0.2), retries=0, timeout=0.01)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(geocoder.geocode("123 Fake St, New York, NY"))
+
+
+@mock.patch("phdi_building_blocks.async_geo.random.uniform", return_value=0)
+def test_async_geocoder_timeout_holds_slot(patched_uniform):
+    client = SlowClient(delay=0.1)
+    geocoder = AsyncGeocoder(client, max_concurrency=1, retries=2, timeout=0.01)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(geocoder.geocode("123 Fake St, New York, NY"))
+
+    # Retries wait for the timed out request's thread to finish
+    assert client.requests == 3
+    assert client.max_in_flight == 1
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=5)
+
+    async def acquire_all():
+        start = time.monotonic()
+        for _ in range(15):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # The first 5 tokens are available at once, the other 10 take 0.1 seconds
+    assert 0.08 <= asyncio.run(acquire_all()) < 0.5
+
+
+def test_async_geocode_patient_addresses():
+    raw_bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    bundles = [copy.deepcopy(raw_bundle) for _ in range(3)]
+    client = SlowClient()
+    geocoder = AsyncGeocoder(client)
+
+    asyncio.run(geocoder.geocode_patient_addresses(bundles))
+
+    assert client.requests == 1
+    for bundle in bundles:
+        address = bundle["entry"][1]["resource"]["address"][0]
+        assert address["line"] == ["123 FAKE ST UNIT #F FAKETON"]
@@ -25,3 +25,26 @@ def test_store_data(mock_get_client):
         os.path.normpath("output/path/some-bundle-type/some-filename-1.fhir")
     )
     mock_blob.upload_blob.assert_called()
+
+
+@mock.patch("phdi_building_blocks.azure_blob.get_blob_client")
+def test_store_data_with_client(mock_get_client):
+    mock_blob = mock.Mock()
+
+    mock_client = mock.Mock()
+    mock_client.get_blob_client.return_value = mock_blob
+
+    store_data(
+        "some-url",
+        "output/path",
+        "some-filename-1.hl7",
+        "some-bundle-type",
+        message="MSH|some-message",
+        client=mock_client,
+    )
+
+    mock_get_client.assert_not_called()
+    mock_client.get_blob_client.assert_called_with(
+        os.path.normpath("output/path/some-bundle-type/some-filename-1.hl7")
+    )
+    mock_blob.upload_blob.assert_called_with(b"MSH|some-message", overwrite=True)
@@ -0,0 +1,59 @@
+import json
+
+from benchmarks.__main__ import compare, main
+from phdi_building_blocks.conversion import convert_batch_messages_to_list
+
+from benchmarks.synthetic import generate_hl7_batch, generate_patient_bundles
+
+
+def test_synthetic_corpora():
+    messages = convert_batch_messages_to_list(generate_hl7_batch(4))
+    assert len(messages) == 4
+    assert all(message.startswith("MSH|") for message in messages)
+
+    bundles = generate_patient_bundles(3, patients=2)
+    assert len(bundles) == 3
+    assert [entry["resource"]["resourceType"] for entry in bundles[0]["entry"]] == [
+        "Patient",
+        "Observation",
+        "Patient",
+        "Observation",
+    ]
+    assert bundles == generate_patient_bundles(3, patients=2)
+
+
+def test_benchmarks(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    args = ["--messages", "20", "--batches", "2", "--bundles", "20"]
+
+    assert main(args + ["--output", str(baseline)]) == 0
+    results = json.loads(baseline.read_text())["results"]
+    assert [result["name"] for result in results] == [
+        "convert_batch_messages_to_list",
+        "clean_message",
+        "standardize_patient_name",
+        "standardize_patient_phone",
+        "standardize_patient_names",
+        "standardize_patient_phones",
+        "add_patient_identifier",
+        "geocode_patient_address",
+        "enrich_patients",
+    ]
+    assert results[0]["messages"] == 20
+
+    assert main(args + ["--compare", str(baseline), "--tolerance", "100"]) == 0
+
+
+def test_compare():
+    baseline = [
+        {"name": "a", "messages_per_sec": 100, "p50_ms": 1.0, "peak_mb": 2.0},
+        {"name": "b", "messages_per_sec": 100, "p50_ms": 1.0, "peak_mb": 2.0},
+    ]
+    result = {"messages_per_sec": 100, "p50_ms": 1.0, "p99_ms": 5.0, "peak_mb": 2.0}
+
+    assert compare([{"name": "a", **result}], baseline, 0.1)
+    assert not compare([{"name": "a", **result, "messages_per_sec": 80}], baseline, 0.1)
+    assert not compare([{"name": "a", **result, "p50_ms": 1.5}], baseline, 0.1)
+    assert not compare([{"name": "b", **result, "peak_mb": 3.0}], baseline, 0.1)
+    # Benchmarks and metrics missing from the baseline are skipped
+    assert compare([{"name": "c", **result, "p99_ms": 50.0}], baseline, 0.1)
@@ -0,0 +1,131 @@
+import json
+from unittest import mock
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from phdi_building_blocks.cache import (
+    BlobCache,
+    LRUCache,
+    SqliteCache,
+    TieredCache,
+)
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    # b is now the least recently used entry, and is evicted
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+    assert cache.stats.hit_rate == 0.75
+
+
+@mock.patch("phdi_building_blocks.cache.time.time")
+def test_lru_cache_ttl(patched_time):
+    patched_time.return_value = 1000
+    cache = LRUCache(ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=100)
+
+    patched_time.return_value = 1010
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+@mock.patch("phdi_building_blocks.cache.time.time")
+def test_sqlite_cache(patched_time, tmp_path):
+    patched_time.return_value = 1000
+    path = str(tmp_path / "cache" / "cache.db")
+    cache = SqliteCache(path, ttl=10)
+    cache.set("a", "1")
+    cache.set("b", "2", ttl=100)
+
+    assert cache.get("a") == "1"
+    assert cache.get("missing") is None
+
+    # Values persist across connections
+    patched_time.return_value = 1010
+    cache = SqliteCache(path, ttl=10)
+    assert cache.get("a") is None
+    assert cache.get("b") == "2"
+    assert cache.stats.dict() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+@mock.patch("phdi_building_blocks.cache.time.time")
+def test_blob_cache(patched_time):
+    patched_time.return_value = 1000
+    client = mock.Mock()
+    cache = BlobCache(client, "some/prefix", ttl=10)
+
+    cache.set("a", "1")
+    name, data = client.upload_blob.call_args[0]
+    assert name == "some/prefix/a"
+    assert json.loads(data) == {"expires": 1010, "value": "1"}
+
+    client.download_blob.return_value.readall.return_value = data
+    assert cache.get("a") == "1"
+    client.download_blob.assert_called_with("some/prefix/a")
+
+    patched_time.return_value = 1010
+    assert cache.get("a") is None
+
+    client.download_blob.side_effect = ResourceNotFoundError()
+    assert cache.get("b") is None
+
+    # Other errors are treated as misses too
+    client.download_blob.side_effect = ValueError("unreadable")
+    assert cache.get("c") is None
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 3
+
+
+def test_tiered_cache():
+    memory = LRUCache()
+    persistent = LRUCache()
+    cache = TieredCache(memory, persistent)
+
+    cache.set("a", "1")
+    assert memory.get("a") == "1"
+    assert persistent.get("a") == "1"
+
+    # Values found in a later tier are copied into earlier tiers
+    persistent.set("b", "2")
+    assert cache.get("b") == "2"
+    assert memory.get("b") == "2"
+
+    assert cache.get("c") is None
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 1
+
+
+@mock.patch("phdi_building_blocks.cache.time.time")
+def test_tiered_cache_ttl(patched_time):
+    patched_time.return_value = 1000
+    memory = LRUCache(ttl=60)
+    persistent = LRUCache()
+    cache = TieredCache(memory, persistent)
+
+    # Values copied into earlier tiers expire when they do in the later tier...
+    persistent.set("a", "1", ttl=10)
+    patched_time.return_value = 1005
+    assert cache.get_entry("a") == ("1", 1010)
+    assert memory.get_entry("a") == ("1", 1010)
+
+    # ...or after the earlier tier's own ttl, if that is sooner
+    persistent.set("b", "2")
+    assert cache.get("b") == "2"
+    assert memory.get_entry("b") == ("2", 1065)
+
+    patched_time.return_value = 1010
+    assert cache.get("a") is None
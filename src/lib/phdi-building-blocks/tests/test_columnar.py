@@ -0,0 +1,140 @@
+import pytest
+
+from unittest import mock
+
+from phdi_building_blocks.columnar import (
+    Column,
+    DEFAULT_COLUMNS,
+    export_to_parquet,
+    flatten_resource,
+    write_parquet,
+)
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def _patient(id, family="DOE"):
+    return {
+        "resourceType": "Patient",
+        "id": id,
+        "name": [
+            {"use": "usual", "family": "nickname"},
+            {"use": "official", "family": family, "given": ["JOHN", "Q"]},
+        ],
+        "address": [
+            {
+                "use": "home",
+                "line": ["123 Main St"],
+                "postalCode": "12345",
+                "extension": [
+                    {
+                        "url": "http://hl7.org/fhir/StructureDefinition/geolocation",
+                        "extension": [
+                            {"url": "latitude", "valueDecimal": 34.5},
+                            {"url": "longitude", "valueDecimal": -118.2},
+                        ],
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def test_flatten_resource():
+    row = flatten_resource(_patient("some-id"), DEFAULT_COLUMNS["Patient"])
+    assert row["id"] == "some-id"
+    assert row["family_name"] == "DOE"
+    assert row["given_name"] == "JOHN"
+    assert row["address_line"] == "123 Main St"
+    assert row["latitude"] == 34.5
+    assert row["longitude"] == -118.2
+    assert row["phone"] is None
+
+    observation = {
+        "resourceType": "Observation",
+        "subject": {"reference": "Patient/some-id"},
+        "code": {"coding": [{"system": "http://loinc.org", "code": "1234-5"}]},
+        "valueQuantity": {"value": "7", "unit": "mg"},
+    }
+    row = flatten_resource(observation, DEFAULT_COLUMNS["Observation"])
+    assert row["patient"] == "Patient/some-id"
+    assert row["code"] == "1234-5"
+    assert row["value_quantity"] == 7.0
+
+
+def test_write_parquet(tmp_path):
+    path = tmp_path / "patients.parquet"
+    columns = [Column("id", "id"), Column("family", "name.family.first()")]
+    patients = (_patient(str(i), f"FAMILY{i}") for i in range(5))
+
+    assert write_parquet(patients, columns, path, batch_size=2) == 5
+
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.metadata.num_rows == 5
+    assert parquet_file.read().to_pylist()[1] == {"id": "1", "family": "nickname"}
+    assert not (tmp_path / "_patients.parquet.partial").exists()
+
+
+def test_write_parquet_interrupted(tmp_path):
+    def patients():
+        yield _patient("1")
+        raise RuntimeError("download failed")
+
+    partition = tmp_path / "resource_type=Patient"
+    with pytest.raises(RuntimeError):
+        write_parquet(patients(), DEFAULT_COLUMNS["Patient"], partition / "p.parquet")
+
+    # The partial file left behind doesn't break reads of the dataset
+    assert [path.name for path in partition.iterdir()] == ["_p.parquet.partial"]
+    write_parquet([_patient("2")], DEFAULT_COLUMNS["Patient"], partition / "q.parquet")
+    assert pq.read_table(tmp_path).column("id").to_pylist() == ["2"]
+
+
+@mock.patch("phdi_building_blocks.columnar.download_from_export_response")
+def test_export_to_parquet(mock_download, tmp_path):
+    downloaded = []
+
+    def resources(type, *ids):
+        downloaded.append(type)
+        for id in ids:
+            yield {"resourceType": type, "id": id}
+
+    def files(*args, **kwargs):
+        # Like the streamed files, each is only downloaded as it is read
+        yield ("Patient", resources("Patient", "1", "2"))
+        yield ("Condition", resources("Condition", "3"))
+        yield ("Observation", resources("Observation", "4"))
+
+    mock_download.side_effect = files
+    export_response = {
+        "output": [
+            {"type": type, "url": f"https://export/{type}-1.ndjson"}
+            for type in ["Patient", "Condition", "Observation"]
+        ]
+    }
+
+    written = export_to_parquet(export_response, tmp_path, credential="some-cred")
+
+    assert [(path.parent.name, path.name[:10]) for path in written] == [
+        ("resource_type=Patient", "part-00000"),
+        ("resource_type=Observation", "part-00002"),
+    ]
+    assert downloaded == ["Patient", "Observation"]
+    mock_download.assert_called_with(
+        export_response, stream=True, credential="some-cred"
+    )
+    table = pq.read_table(tmp_path / "resource_type=Patient")
+    assert table.column("id").to_pylist() == ["1", "2"]
+
+    # Files written by an earlier run are skipped without being downloaded
+    written[1].unlink()
+    downloaded.clear()
+    assert export_to_parquet(export_response, tmp_path) == [written[1]]
+    assert downloaded == ["Observation"]
+
+    # The files of a different export aren't mistaken for those already written
+    for entry in export_response["output"]:
+        entry["url"] = entry["url"].replace("-1", "-2")
+    downloaded.clear()
+    assert len(export_to_parquet(export_response, tmp_path)) == 2
+    assert downloaded == ["Patient", "Observation"]
@@ -1,16 +1,21 @@
 import hl7
+import io
 import pathlib
 import pytest
 
 from unittest import mock
 from phdi_building_blocks.conversion import (
+    CachingFhirConverter,
+    RemoteFhirConverter,
     clean_batch,
     clean_message,
     convert_batch_messages_to_list,
     convert_message_to_fhir,
     get_file_type_mappings,
     normalize_hl7_datetime,
+    conversion_cache_key,
     normalize_hl7_datetime_segment,
+    stream_batch_messages,
 )
 
 
@@ -48,6 +53,25 @@ def test_clean_message():
     )
 
 
+def test_clean_message_fields():
+    message = (
+        "MSH|^~\\&|WIR|WIR||WIRPH|202005140100001234||VXU^V04|1|P|2.4\r\n"
+        + "PID|||1||DOE^JANE||201808080000000000^Y|F\r\n"
+        + "RXA|0|1|2018080900000000~2018081000000000|20180809|08^HepB^CVX\r\n"
+        + "OBX|1|NM|2160-0^Creatinine^LN||1.2||||||F|||20180809000000001\r\n"
+    )
+
+    assert clean_message(message) == (
+        "MSH|^~\\&|WIR|WIR||WIRPH|20200514010000||VXU^V04|1|P|2.4\n"
+        + "PID|||1||DOE^JANE||20180808000000^Y|F\n"
+        + "RXA|0|1|20180809000000~20180810000000|20180809|08^HepB^CVX\n"
+        + "OBX|1|NM|2160-0^Creatinine^LN||1.2||||||F|||20180809000000\n"
+    )
+
+    # Messages that cannot be cleaned are passed through unchanged
+    assert clean_message("not a message") == "not a message"
+
+
 def test_normalize_hl7_datetime_segment():
     message_1 = (
         open(pathlib.Path(__file__).parent / "assets" / "FileSingleMessageLongDate.hl7")
@@ -136,7 +160,45 @@ def test_convert_batch_messages_to_list():
     assert list3[0].startswith("MSH|")
 
 
-@mock.patch("requests.post")
+def test_stream_batch_messages():
+    TEST_STRING1 = (
+        "\u000bMSH|blah|foo|test\r\nPID|some^text|blah\r\n"
+        + "OBX|foo||||bar^baz&foobar\u001c\r\n"
+        + "\u000bMSH|blah|foo|test\r\nPID|some^text|blah\r\n"
+        + "OBX|foo||||bar^baz&foobar  \u001c\r\n  \r\n"
+    )
+    TEST_STRING2 = (
+        "FHS|^~&|WIR11.3.2|WIR|||20200514||1219144.update|||\n"
+        + "BHS|^~&|WIR11.3.2|WIR|||20200514|||||\n"
+        + "MSH|^~&|WIR11.3.2^^|WIR^^||WIRPH^^|20200514||VXU^V04|2020051411020600\n"
+        + "PID|||3054790^^^^SR^~^^^^PI^||ZTEST^PEDIARIX^^^^^^|HEPB^DTAP^^^^^^\n"
+        + "BTS|5|\n"
+        + "FTS|1|\n"
+    )
+
+    for test_string in (TEST_STRING1, TEST_STRING2):
+        expected = convert_batch_messages_to_list(test_string)
+        # Small chunk sizes split CR-LF pairs, lines and messages across reads
+        for chunk_size in (1, 2, 7, 1024):
+            stream = io.BytesIO(test_string.encode("utf-8"))
+            assert list(stream_batch_messages(stream, chunk_size)) == expected
+
+    messages = list(stream_batch_messages(io.BytesIO(TEST_STRING1.encode("utf-8"))))
+    assert messages == [
+        "MSH|blah|foo|test\rPID|some^text|blah\rOBX|foo||||bar^baz&foobar\r",
+        "MSH|blah|foo|test\rPID|some^text|blah\rOBX|foo||||bar^baz&foobar\r",
+    ]
+
+
+def test_stream_batch_messages_multibyte_characters():
+    content = "MSH|blah|foo|test\nPID|some^text|Jos\u00e9\n".encode("utf-8")
+
+    assert list(stream_batch_messages(io.BytesIO(content), 1)) == [
+        "MSH|blah|foo|test\rPID|some^text|Jos\u00e9\r"
+    ]
+
+
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 def test_convert_message_to_fhir_success(mock_fhir_post):
     mock_fhir_post.return_value = mock.Mock(
         status_code=200,
@@ -174,7 +236,7 @@ def test_convert_message_to_fhir_success(mock_fhir_post):
     assert response == {"resourceType": "Bundle", "entry": [{"hello": "world"}]}
 
 
-@mock.patch("requests.post")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 def test_convert_message_to_fhir_failure(mock_fhir_post):
     mock_fhir_post.return_value = mock.Mock(
         status_code=400,
@@ -216,7 +278,7 @@ def test_convert_message_to_fhir_failure(mock_fhir_post):
     }
 
 
-@mock.patch("requests.post")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 @mock.patch("logging.error")
 def test_log_fhir_operationoutcome(mock_log, mock_fhir_post):
     mock_fhir_post.return_value = mock.Mock(
@@ -260,7 +322,7 @@ def test_log_fhir_operationoutcome(mock_log, mock_fhir_post):
     }
 
 
-@mock.patch("requests.post")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 @mock.patch("logging.error")
 def test_log_generic_error(mock_log, mock_fhir_post):
     mock_fhir_post.return_value = mock.Mock(status_code=400, text="some-error")
@@ -298,7 +360,7 @@ def test_log_generic_error(mock_log, mock_fhir_post):
     )
 
 
-@mock.patch("requests.post")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 @mock.patch("logging.error")
 def test_generic_error(mock_log, mock_fhir_post):
     mock_fhir_post.return_value = mock.Mock(status_code=400, text="some-error")
@@ -335,7 +397,7 @@ def test_generic_error(mock_log, mock_fhir_post):
     assert response == {"http_status_code": 400, "response_content": "some-error"}
 
 
-@mock.patch("requests.post")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 @mock.patch("logging.error")
 def test_error_with_special_chars(mock_log, mock_fhir_post):
     mock_fhir_post.return_value = mock.Mock(
@@ -377,6 +439,72 @@ def test_error_with_special_chars(mock_log, mock_fhir_post):
     }
 
 
+@mock.patch("phdi_building_blocks.conversion.convert_message_to_fhir")
+def test_remote_fhir_converter(patched_convert):
+    cred_manager = mock.Mock()
+    cred_manager.get_access_token.return_value = mock.Mock(token="some-token")
+    client = mock.Mock()
+    converter = RemoteFhirConverter(cred_manager, "some-fhir-url", client=client)
+
+    response = converter.convert(
+        "MSH|Hello World", "some-filename", "Hl7v2", "VXU_V04", "some-collection"
+    )
+
+    assert response == patched_convert.return_value
+    patched_convert.assert_called_with(
+        message="MSH|Hello World",
+        filename="some-filename",
+        input_data_type="Hl7v2",
+        root_template="VXU_V04",
+        template_collection="some-collection",
+        access_token="some-token",
+        fhir_url="some-fhir-url",
+        client=client,
+    )
+
+
+def test_conversion_cache_key():
+    key = conversion_cache_key(
+        "MSH|^~\\&|WIR|WIR||WIRPH|202005140100001234", "Hl7v2", "VXU_V04", "default"
+    )
+
+    # Resent messages share a key, and messages or templates that differ don't
+    assert key == conversion_cache_key(
+        "MSH|^~\\&|WIR|WIR||WIRPH|202005140100001234", "Hl7v2", "VXU_V04", "default"
+    )
+    assert key != conversion_cache_key(
+        "MSH|^~\\&|WIR|WIR||WIRPH|20200514010001", "Hl7v2", "VXU_V04", "default"
+    )
+    assert key != conversion_cache_key(
+        "MSH|^~\\&|WIR|WIR||WIRPH|202005140100001234", "Hl7v2", "ORU_R01", "default"
+    )
+
+
+def test_caching_fhir_converter():
+    converter = mock.Mock()
+    converter.convert.side_effect = [
+        {"http_status_code": 400, "response_content": "bad"},
+        {"resourceType": "Bundle", "entry": [{"hello": "world"}]},
+    ]
+    caching_converter = CachingFhirConverter(converter)
+    args = ("MSH|Hello World", "some-filename", "Hl7v2", "VXU_V04", "default")
+
+    # Failed conversions are not cached
+    assert caching_converter.convert(*args)["http_status_code"] == 400
+    bundle = caching_converter.convert(*args)
+    assert bundle == {"resourceType": "Bundle", "entry": [{"hello": "world"}]}
+
+    # Each hit returns a new copy of the bundle
+    bundle["entry"].clear()
+    assert caching_converter.convert(*args) == {
+        "resourceType": "Bundle",
+        "entry": [{"hello": "world"}],
+    }
+    assert converter.convert.call_count == 2
+    assert caching_converter.cache.stats.hits == 1
+    assert caching_converter.cache.stats.misses == 2
+
+
 def test_get_filetype_mappings_valid_files():
     TEST_STRING1 = "decrypted/ELR/some-file.hl7"
     TEST_STRING2 = "decrypted/VXU/some-file.hl7"
@@ -0,0 +1,96 @@
+import copy
+import json
+import pathlib
+from unittest import mock
+
+from phdi_building_blocks.enrichment import (
+    PatientContext,
+    add_identifier,
+    enrich_patients,
+    geocode_addresses,
+    standardize_names,
+    standardize_phones,
+)
+from phdi_building_blocks.geo import GeocodeCache, geocode_patient_addresses
+from phdi_building_blocks.linkage import add_patient_identifier
+from phdi_building_blocks.standardize import (
+    standardize_patient_name,
+    standardize_patient_phone,
+)
+from tests.conftest import fill_in_batch
+
+
+def test_enrich_patients():
+    raw_bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    client = mock.Mock()
+    client.send_batch.side_effect = fill_in_batch
+
+    # The transforms give the same results as the bundle-level functions
+    expected = copy.deepcopy(raw_bundle)
+    standardize_patient_name(expected)
+    standardize_patient_phone(expected)
+    geocode_patient_addresses([expected], client)
+    add_patient_identifier(expected, "salt")
+
+    cache = GeocodeCache()
+    enriched = enrich_patients(
+        copy.deepcopy(raw_bundle),
+        [
+            standardize_names(),
+            standardize_phones(),
+            geocode_addresses(client, cache),
+            add_identifier("salt"),
+        ],
+    )
+    assert enriched == expected
+    assert cache.stats.misses == 1
+
+
+def test_geocode_addresses_one_batch_per_bundle():
+    def patient(line):
+        address = {"line": [line], "city": "New York", "state": "NY"}
+        return {"resource": {"resourceType": "Patient", "address": [address]}}
+
+    bundle = {
+        "entry": [patient("1 Main St"), patient("2 Main St"), patient("1 main st")]
+    }
+    client = mock.Mock()
+    client.send_batch.side_effect = fill_in_batch
+    seen = []
+
+    enrich_patients(
+        bundle,
+        [
+            lambda context: seen.append(context.patient["address"][0]["line"][0]),
+            geocode_addresses(client),
+        ],
+    )
+
+    # Every patient's distinct addresses are sent in one batch, after the
+    # transforms before the geocoder have been applied to every patient
+    client.send_batch.assert_called_once()
+    assert len(client.send_batch.call_args.args[0]) == 2
+    assert seen == ["1 Main St", "2 Main St", "1 main st"]
+    lines = [entry["resource"]["address"][0]["line"] for entry in bundle["entry"]]
+    assert lines[0] == lines[2] == ["1 MAIN ST NEW YORK"]
+
+
+def test_patient_context():
+    entry = {
+        "resource": {
+            "resourceType": "Patient",
+            "address": [{"line": ["1 Main St"], "city": "Albany", "state": "NY"}],
+        }
+    }
+    context = PatientContext({"entry": [entry]}, entry)
+    compute = mock.Mock(return_value=["1 Main St Albany, NY"])
+
+    assert context.derived("one_line_addresses", compute) == ["1 Main St Albany, NY"]
+    assert context.one_line_addresses == ["1 Main St Albany, NY"]
+    compute.assert_called_once()
+
+    context.patient["address"][0]["postalCode"] = "12207"
+    context.invalidate("one_line_addresses")
+    assert context.one_line_addresses == ["1 Main St Albany, NY 12207"]
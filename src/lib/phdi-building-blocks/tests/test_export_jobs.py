@@ -0,0 +1,182 @@
+import pytest
+import requests
+
+from unittest import mock
+
+from phdi_building_blocks.export_jobs import (
+    ExportJob,
+    ExportJobs,
+    kickoff_export_job,
+    poll_export_job,
+    poll_export_jobs,
+    poll_delay,
+)
+from phdi_building_blocks.export_state import ExportWatermarks, LocalStateStore
+
+
+def _response(status_code: int, headers: dict = None, body: dict = None):
+    response = mock.Mock(status_code=status_code, headers=headers or {})
+    response.json.return_value = body
+    return response
+
+
+def test_poll_delay():
+    assert poll_delay({"Retry-After": "1"}, attempts=0, elapsed=0) == 5
+    assert poll_delay({"Retry-After": "3600"}, attempts=0, elapsed=0) == 300
+    assert poll_delay({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0, 0) == 5
+    assert poll_delay({"X-Progress": "In progress"}, attempts=1, elapsed=0) == 10
+    assert poll_delay({"X-Progress": "90%"}, attempts=1, elapsed=900) == 50
+
+
+@mock.patch("phdi_building_blocks.export_jobs.time.time")
+def test_export_job(mock_time, tmp_path):
+    client = mock.Mock()
+    client.get.side_effect = [
+        _response(202, {"Content-Location": "https://fhir/export-status"}),
+        _response(202, {"X-Progress": "50%"}),
+        _response(
+            200,
+            body={"transactionTime": "2022-03-01T00:00:00Z", "output": []},
+        ),
+    ]
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"))
+    watermarks = ExportWatermarks(LocalStateStore(tmp_path / "watermarks.json"))
+
+    mock_time.return_value = 1000
+    job = kickoff_export_job(
+        "some-token",
+        "https://fhir",
+        jobs,
+        "Patient",
+        watermarks=watermarks,
+        client=client,
+    )
+    assert jobs.get(job.id) == job
+    assert job.poll_url == "https://fhir/export-status"
+    assert job.incremental
+
+    # Jobs aren't polled before they are due
+    assert poll_export_jobs("some-token", jobs, client=client) == []
+    assert client.get.call_count == 1
+
+    # The next poll is scheduled from the export's progress
+    mock_time.return_value = 1100
+    poll_export_jobs("some-token", jobs, watermarks=watermarks, client=client)
+    job = jobs.get(job.id)
+    assert job.progress == "50%"
+    assert job.next_poll == 1100 + 50
+
+    # A later invocation resumes the job, and completes it
+    mock_time.return_value = 1200
+    finished = poll_export_jobs(
+        "some-token", jobs, watermarks=watermarks, client=client
+    )
+    assert [job.id for job in finished] == [job.id]
+    assert jobs.get(job.id).status == "complete"
+    assert jobs.get(job.id).response["transactionTime"] == "2022-03-01T00:00:00Z"
+    assert jobs.pending() == []
+    assert watermarks.get("Patient", "") == "2022-03-01T00:00:00Z"
+
+
+@mock.patch("phdi_building_blocks.export_jobs.time.time")
+def test_poll_export_job_failure(mock_time, tmp_path):
+    mock_time.return_value = 1000
+    client = mock.Mock()
+    client.get.side_effect = [
+        _response(202, {"Content-Location": "https://fhir/export-status"}),
+        _response(503, {"Retry-After": "60"}),
+        requests.ConnectionError("connection reset"),
+        _response(404),
+    ]
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"))
+    job = kickoff_export_job("some-token", "https://fhir", jobs, client=client)
+
+    # Server errors and connection failures are retried later
+    job = poll_export_job(job, "some-token", jobs, force=True, client=client)
+    assert job.status == "in-progress"
+    assert "503" in job.error
+    assert job.next_poll == 1000 + 60
+    job = poll_export_job(job, "some-token", jobs, force=True, client=client)
+    assert job.status == "in-progress"
+    assert "connection reset" in job.error
+    assert jobs.pending() == [job]
+
+    # A client error fails the job
+    job = poll_export_job(job, "some-token", jobs, force=True, client=client)
+    assert job.status == "failed"
+    assert "404" in job.error
+    assert jobs.pending() == []
+
+
+@mock.patch("phdi_building_blocks.export_jobs.poll_export_job")
+def test_poll_export_jobs_isolates_errors(mock_poll, tmp_path):
+    client = mock.Mock()
+    client.get.return_value = _response(
+        202, {"Content-Location": "https://fhir/export-status"}
+    )
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"))
+    first = kickoff_export_job("some-token", "https://fhir", jobs, client=client)
+    second = kickoff_export_job("some-token", "https://fhir", jobs, client=client)
+
+    def poll(job, *args, **kwargs):
+        if job.id == first.id:
+            raise RuntimeError("unexpected")
+        job.status = "complete"
+        return job
+
+    mock_poll.side_effect = poll
+    finished = poll_export_jobs("some-token", jobs)
+    assert [job.id for job in finished] == [second.id]
+    assert mock_poll.call_count == 2
+
+
+@mock.patch("phdi_building_blocks.export_jobs.time.time")
+def test_export_jobs_save(mock_time, tmp_path):
+    mock_time.return_value = 1000
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"), retention=100)
+    old = ExportJob(id="old", poll_url="u", started=0, next_poll=0)
+    old.status, old.finished = "complete", 950
+    jobs.save(old)
+    pending = ExportJob(id="pending", poll_url="u", started=0, next_poll=0)
+    jobs.save(pending)
+
+    # A stale copy of a job doesn't revert another invocation's completion
+    done = ExportJob(**pending.dict())
+    done.status, done.finished = "complete", 1000
+    jobs.save(done)
+    jobs.save(pending)
+    assert jobs.get("pending").status == "complete"
+
+    # Finished jobs are pruned once they are older than the retention period
+    mock_time.return_value = 1060
+    jobs.save(ExportJob(id="new", poll_url="u", started=0, next_poll=0))
+    assert jobs.get("old") is None
+    assert jobs.get("pending") is not None
+
+
+def test_kickoff_export_job_since_offset(tmp_path):
+    client = mock.Mock()
+    client.get.return_value = _response(
+        202, {"Content-Location": "https://fhir/export-status"}
+    )
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"))
+    watermarks = ExportWatermarks(LocalStateStore(tmp_path / "watermarks.json"))
+    watermarks.advance("", "", "2021-10-08T07:13:59.5813558+00:00")
+
+    kickoff_export_job(
+        "some-token", "https://fhir", jobs, watermarks=watermarks, client=client
+    )
+    assert (
+        client.get.call_args.args[0]
+        == "https://fhir/$export?_since=2021-10-08T07:13:59.5813558%2B00:00"
+    )
+
+
+def test_kickoff_export_job_rejected(tmp_path):
+    client = mock.Mock()
+    client.get.return_value = _response(400)
+    jobs = ExportJobs(LocalStateStore(tmp_path / "jobs.json"))
+
+    with pytest.raises(requests.HTTPError):
+        kickoff_export_job("some-token", "https://fhir", jobs, client=client)
+    assert jobs.pending() == []
@@ -0,0 +1,129 @@
+import pytest
+from unittest import mock
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+
+from phdi_building_blocks.export_state import (
+    BlobStateStore,
+    ExportWatermarks,
+    LocalStateStore,
+    get_state_store,
+    incremental_export,
+)
+
+
+def test_local_state_store(tmp_path):
+    store = LocalStateStore(tmp_path / "state" / "export.json")
+    assert store.load() == {}
+
+    store.save({"system|*": "2022-03-01T00:00:00Z"})
+    assert store.load() == {"system|*": "2022-03-01T00:00:00Z"}
+    assert [path.name for path in (tmp_path / "state").iterdir()] == ["export.json"]
+
+
+def test_blob_state_store():
+    client = mock.Mock()
+    client.download_blob.side_effect = ResourceNotFoundError()
+    store = BlobStateStore(client)
+    assert store.load() == {}
+
+    store.save({"system|*": "2022-03-01T00:00:00Z"})
+    saved = client.upload_blob.call_args.args[0]
+    client.download_blob.side_effect = None
+    client.download_blob.return_value.readall.return_value = saved
+    assert store.load() == {"system|*": "2022-03-01T00:00:00Z"}
+
+
+def test_blob_state_store_update():
+    client = mock.Mock()
+    client.download_blob.return_value.readall.side_effect = [
+        b'{"a": 1}',
+        b'{"a": 1, "b": 2}',
+    ]
+    client.download_blob.return_value.properties.etag = "some-etag"
+    # Another writer changes the blob between the first read and write
+    client.upload_blob.side_effect = [ResourceModifiedError(), None]
+    store = BlobStateStore(client)
+
+    assert store.update(lambda state: state.update(c=3)) == {"a": 1, "b": 2, "c": 3}
+    assert client.upload_blob.call_count == 2
+    assert client.upload_blob.call_args.kwargs["etag"] == "some-etag"
+    assert (
+        client.upload_blob.call_args.kwargs["match_condition"]
+        == MatchConditions.IfNotModified
+    )
+
+    # A blob that doesn't exist yet is only created if no one else created it
+    client.download_blob.side_effect = ResourceNotFoundError()
+    client.upload_blob.side_effect = None
+    store.update(lambda state: state.update(c=3))
+    assert client.upload_blob.call_args.kwargs == {"overwrite": False}
+
+
+def test_get_state_store(tmp_path):
+    assert isinstance(get_state_store(str(tmp_path / "state.json")), LocalStateStore)
+    store = get_state_store(
+        "https://account.blob.core.windows.net/exports/state.json", mock.Mock()
+    )
+    assert isinstance(store, BlobStateStore)
+
+
+def test_export_watermarks(tmp_path):
+    watermarks = ExportWatermarks(LocalStateStore(tmp_path / "state.json"))
+    assert watermarks.get("Patient", "Patient") is None
+
+    assert watermarks.advance("Patient", "Patient", "2022-03-01T00:00:00Z")
+    assert watermarks.get("Patient", "Patient") == "2022-03-01T00:00:00Z"
+    assert watermarks.get("", "Patient") is None
+
+    # Watermarks only move forward
+    assert not watermarks.advance("Patient", "Patient", "2022-02-01T00:00:00+00:00")
+    assert watermarks.advance("Patient", "Patient", "2022-03-02T00:00:00.000+00:00")
+    assert watermarks.get("Patient", "Patient") == "2022-03-02T00:00:00.000+00:00"
+
+
+@mock.patch("phdi_building_blocks.export_state.fhir.export_from_fhir_server")
+def test_incremental_export(mock_export, tmp_path):
+    watermarks = ExportWatermarks(LocalStateStore(tmp_path / "state.json"))
+    mock_export.return_value = {"transactionTime": "2022-03-01T00:00:00Z"}
+
+    incremental_export(
+        "some-token", "https://fhir", watermarks, "Patient", "Patient", poll_step=1
+    )
+    mock_export.assert_called_with(
+        access_token="some-token",
+        fhir_url="https://fhir",
+        export_scope="Patient",
+        since="",
+        resource_type="Patient",
+        poll_step=1,
+    )
+
+    # The next export starts from the last one's transactionTime
+    mock_export.return_value = {"transactionTime": "2022-03-02T00:00:00Z"}
+    incremental_export("some-token", "https://fhir", watermarks, "Patient", "Patient")
+    assert mock_export.call_args.kwargs["since"] == "2022-03-01T00:00:00Z"
+
+    # A failed export leaves the watermark where it was
+    mock_export.side_effect = RuntimeError("export failed")
+    with pytest.raises(RuntimeError):
+        incremental_export(
+            "some-token", "https://fhir", watermarks, "Patient", "Patient"
+        )
+    assert watermarks.get("Patient", "Patient") == "2022-03-02T00:00:00Z"
+
+
+@mock.patch("phdi_building_blocks.fhir.FhirClient.get")
+def test_incremental_export_since_offset(mock_get, tmp_path):
+    watermarks = ExportWatermarks(LocalStateStore(tmp_path / "state.json"))
+    watermarks.advance("", "", "2021-10-08T07:13:59.5813558+00:00")
+    mock_get.return_value = mock.Mock(status_code=400)
+
+    assert incremental_export("some-token", "https://fhir", watermarks) is None
+
+    # The transactionTime's offset reaches the server intact
+    assert (
+        mock_get.call_args.args[0]
+        == "https://fhir/$export?_since=2021-10-08T07:13:59.5813558%2B00:00"
+    )
@@ -1,7 +1,11 @@
 import io
+import json
 import pytest
 import polling
 import requests
+import tempfile
+import threading
+import time
 
 from datetime import datetime, timezone
 from unittest import mock
@@ -9,17 +13,51 @@ from unittest import mock
 from azure.identity import DefaultAzureCredential
 
 from phdi_building_blocks.fhir import (
+    FhirBundleAggregator,
+    FhirClient,
+    get_fhir_client,
     get_fhirserver_cred_manager,
     upload_bundle_to_fhir_server,
     export_from_fhir_server,
     _compose_export_url,
     download_from_export_response,
+    read_export_files,
 )
 
 
-@mock.patch("requests.post")
+def _patient_bundle(*ids):
+    return {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [
+            {
+                "resource": {"resourceType": "Patient", "id": id},
+                "request": {"method": "PUT", "url": f"Patient/{id}"},
+            }
+            for id in ids
+        ],
+    }
+
+
+def _batch_response(*statuses):
+    return mock.Mock(
+        status_code=200,
+        json=lambda: {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [{"response": {"status": status}} for status in statuses],
+        },
+    )
+
+
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
 def test_upload_bundle_to_fhir_server(mock_fhir_post):
-    upload_bundle_to_fhir_server(
+    mock_fhir_post.return_value = mock.Mock(
+        status_code=200,
+        json=lambda: {"entry": [{"response": {"status": "201 Created"}}]},
+    )
+
+    result = upload_bundle_to_fhir_server(
         {
             "resourceType": "Bundle",
             "id": "some-id",
@@ -45,6 +83,145 @@ def test_upload_bundle_to_fhir_server(mock_fhir_post):
         '{"resourceType": "Patient", "id": "pat-id"}, "request": '
         '{"method": "PUT", "url": "Patient/pat-id"}}]}',
     )
+    assert result.status_code == 200
+    assert result.entry_responses == [{"status": "201 Created"}]
+    assert result.failed_entries == []
+    assert result.retries == 0
+    assert result.succeeded
+
+
+@mock.patch("phdi_building_blocks.fhir.FhirClient.post")
+def test_upload_bundle_to_fhir_server_failures(mock_fhir_post):
+    bundle = _patient_bundle("pat-1", "pat-2")
+
+    mock_fhir_post.return_value = _batch_response("201 Created", "400 Bad Request")
+    result = upload_bundle_to_fhir_server(bundle, "some-token", "https://some-url")
+    assert result.failed_entries == [bundle["entry"][1]]
+    assert not result.succeeded
+
+    # Entries the batch-response doesn't answer haven't been accepted
+    mock_fhir_post.return_value = _batch_response("201 Created")
+    result = upload_bundle_to_fhir_server(bundle, "some-token", "https://some-url")
+    assert result.failed_entries == bundle["entry"]
+    assert not result.succeeded
+
+    mock_fhir_post.return_value = mock.Mock(status_code=429)
+    result = upload_bundle_to_fhir_server(bundle, "some-token", "https://some-url")
+    assert result.status_code == 429
+    assert result.failed_entries == bundle["entry"]
+
+    mock_fhir_post.side_effect = requests.ConnectionError()
+    result = upload_bundle_to_fhir_server(bundle, "some-token", "https://some-url")
+    assert result.status_code is None
+    assert result.failed_entries == bundle["entry"]
+
+
+@mock.patch("requests.Session.request")
+def test_fhir_client_request(mock_request):
+    client = FhirClient(pool_size=4, timeout=10)
+
+    client.get("https://some-fhir-url/Patient", headers={"Accept": "some-type"})
+    mock_request.assert_called_with(
+        "GET",
+        "https://some-fhir-url/Patient",
+        headers={"Accept": "some-type"},
+        timeout=10,
+    )
+
+    client.post("https://some-fhir-url", data="some-data", timeout=1)
+    mock_request.assert_called_with(
+        "POST", "https://some-fhir-url", data="some-data", timeout=1
+    )
+
+
+def test_fhir_client_session():
+    client = FhirClient(pool_size=4, retries=5, backoff_factor=2)
+    adapter = client.session.get_adapter("https://some-fhir-url")
+
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 5
+    assert adapter.max_retries.backoff_factor == 2
+    assert adapter.max_retries.respect_retry_after_header
+    assert 429 in adapter.max_retries.status_forcelist
+    assert "POST" in adapter.max_retries.allowed_methods
+
+    # Calls without their own client share a single session
+    assert get_fhir_client() is get_fhir_client()
+
+
+def test_fhir_bundle_aggregator():
+    cred_manager = mock.Mock()
+    cred_manager.get_access_token.return_value = mock.Mock(token="some-token")
+    client = mock.Mock()
+    client.post.side_effect = [
+        _batch_response("201 Created", "200 OK", "400 Bad Request"),
+        _batch_response("201 Created", "201 Created"),
+    ]
+
+    aggregator = FhirBundleAggregator(
+        cred_manager, "https://some-fhir-url", client=client, max_entries=4
+    )
+
+    assert aggregator.add("file-0", _patient_bundle("pat-1", "pat-2")) == {}
+    assert aggregator.add("file-1", _patient_bundle("pat-3")) == {}
+    client.post.assert_not_called()
+
+    # Bundles are never split, so this one starts a new batch, and the full
+    # batch is uploaded with its entry responses mapped to their source
+    results = aggregator.add("file-2", _patient_bundle("pat-4", "pat-5"))
+    client.post.assert_called_once_with(
+        "https://some-fhir-url",
+        headers={
+            "Authorization": "Bearer some-token",
+            "Accept": "application/fhir+json",
+            "Content-Type": "application/fhir+json",
+        },
+        data=json.dumps(
+            {
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": _patient_bundle("pat-1", "pat-2", "pat-3")["entry"],
+            }
+        ),
+    )
+    assert results.keys() == {"file-0", "file-1"}
+    assert results["file-0"].entry_responses == [
+        {"status": "201 Created"},
+        {"status": "200 OK"},
+    ]
+    assert results["file-0"].succeeded
+    assert results["file-1"].failed_entries == _patient_bundle("pat-3")["entry"]
+    assert not results["file-1"].succeeded
+
+    results = aggregator.flush()
+    assert results.keys() == {"file-2"}
+    assert results["file-2"].succeeded
+    assert aggregator.flush() == {}
+    assert client.post.call_count == 2
+
+
+def test_fhir_bundle_aggregator_max_bytes():
+    cred_manager = mock.Mock()
+    client = mock.Mock()
+    client.post.side_effect = [
+        _batch_response("201 Created"),
+        mock.Mock(status_code=429),
+    ]
+
+    entry_size = len(json.dumps(_patient_bundle("pat-1")["entry"][0]))
+    aggregator = FhirBundleAggregator(
+        cred_manager,
+        "https://some-fhir-url",
+        client=client,
+        max_bytes=entry_size + 1,
+    )
+
+    assert aggregator.add("file-0", _patient_bundle("pat-1")) == {}
+    assert aggregator.add("file-1", _patient_bundle("pat-2"))["file-0"].succeeded
+
+    results = aggregator.flush()
+    assert results["file-1"].status_code == 429
+    assert results["file-1"].failed_entries == _patient_bundle("pat-2")["entry"]
 
 
 @mock.patch.object(DefaultAzureCredential, "get_token")
@@ -87,7 +264,7 @@ def test_get_access_token_refresh(mock_get_token):
     assert token1.token == "my-token"
 
 
-@mock.patch("requests.get")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.get")
 def test_export_from_fhir_server(mock_get):
     access_token = "my-token"
     fhir_url = "https://fhir-url"
@@ -170,7 +347,7 @@ def test_export_from_fhir_server(mock_get):
     assert mock_get.call_count == 5
 
 
-@mock.patch("requests.get")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.get")
 def test_export_from_fhir_server_timeout(mock_get):
     access_token = "my-token"
     fhir_url = "https://fhir-url"
@@ -207,7 +384,7 @@ def test_export_from_fhir_server_timeout(mock_get):
     assert mock_get.call_count == 7
 
 
-@mock.patch("requests.get")
+@mock.patch("phdi_building_blocks.fhir.FhirClient.get")
 def test_export_from_fhir_server_error(mock_get):
     access_token = "my-token"
     fhir_url = "https://fhir-url"
@@ -269,6 +446,10 @@ def test_compose_export_url():
         == f"{fhir_url}/Patient/$export?_since=2022-01-01T00:00:00Z"
         + "&_type=Patient,Observation&_container=some-container"
     )
+    assert (
+        _compose_export_url(fhir_url, "", "2021-10-08T07:13:59.5813558+00:00")
+        == f"{fhir_url}/$export?_since=2021-10-08T07:13:59.5813558%2B00:00"
+    )
     assert (
         _compose_export_url(fhir_url, "Patient", None, "Patient,Observation")
         == f"{fhir_url}/Patient/$export?_type=Patient,Observation"
@@ -329,3 +510,137 @@ def test_download_from_export_response(mock_download_export_blob):
             mock.call(blob_url="https://export-download-url/_Observation"),
         ]
     )
+
+
+@mock.patch("phdi_building_blocks.fhir.BlobClient")
+def test_download_from_export_response_stream(mock_blob_client):
+    contents = {
+        "https://export-download-url/_Patient": [
+            b'{"resourceType": "Patient", "id": "some-id"}\n{"resourceType": "Pat',
+            b'ient", "id": "some-id2"}\n',
+        ],
+        "https://export-download-url/_Observation": [
+            b'{"resourceType": "Observation", "id": "some-id"}',
+        ],
+    }
+    mock_blob_client.from_blob_url.side_effect = lambda url, **kwargs: mock.Mock(
+        **{"download_blob.return_value.chunks.return_value": iter(contents[url])}
+    )
+    credential = mock.Mock()
+
+    export_response = {
+        "output": [
+            {"type": "Patient", "url": "https://export-download-url/_Patient"},
+            {"type": "Observation", "url": "https://export-download-url/_Observation"},
+        ]
+    }
+    results = [
+        (type, list(resources))
+        for type, resources in download_from_export_response(
+            export_response, stream=True, chunk_size=64, credential=credential
+        )
+    ]
+
+    assert results == [
+        (
+            "Patient",
+            [
+                {"resourceType": "Patient", "id": "some-id"},
+                {"resourceType": "Patient", "id": "some-id2"},
+            ],
+        ),
+        ("Observation", [{"resourceType": "Observation", "id": "some-id"}]),
+    ]
+    mock_blob_client.from_blob_url.assert_any_call(
+        "https://export-download-url/_Patient",
+        credential=credential,
+        max_single_get_size=64,
+        max_chunk_get_size=64,
+    )
+
+
+@mock.patch("phdi_building_blocks.fhir.BlobClient")
+def test_read_export_files(mock_blob_client):
+    observations_requested = threading.Event()
+    patients_read = threading.Event()
+
+    def observation_chunks():
+        # The Observation file is still downloading until the Patients are read
+        observations_requested.set()
+        assert patients_read.wait(timeout=5)
+        yield b'{"resourceType": "Observation", "id": "some-id"}\n'
+
+    contents = {
+        "https://export-download-url/_Patient": lambda: iter(
+            [b'{"resourceType": "Patient", "id": "some-id"}\n']
+        ),
+        "https://export-download-url/_Observation": observation_chunks,
+    }
+    mock_blob_client.from_blob_url.side_effect = lambda url, **kwargs: mock.Mock(
+        **{"download_blob.return_value.chunks.side_effect": contents[url]}
+    )
+    credential = mock.Mock()
+
+    export_response = {
+        "output": [
+            {"type": "Observation", "url": "https://export-download-url/_Observation"},
+            {"type": "Patient", "url": "https://export-download-url/_Patient"},
+        ]
+    }
+    files = read_export_files(export_response, max_workers=2, credential=credential)
+
+    type, resources = next(files)
+    assert type == "Patient"
+    assert list(resources) == [{"resourceType": "Patient", "id": "some-id"}]
+    assert observations_requested.is_set()
+    patients_read.set()
+
+    type, resources = next(files)
+    assert type == "Observation"
+    assert list(resources) == [{"resourceType": "Observation", "id": "some-id"}]
+    assert next(files, None) is None
+
+    # Every file is read with the same credential
+    for call in mock_blob_client.from_blob_url.call_args_list:
+        assert call.kwargs["credential"] is credential
+
+
+@mock.patch("phdi_building_blocks.fhir._spool_export_blob")
+def test_read_export_files_stopped_early(mock_spool_export_blob):
+    slow_started = threading.Event()
+    release = threading.Event()
+    spools = {}
+
+    def spool(url, credential, chunk_size):
+        spools[url] = tempfile.SpooledTemporaryFile()
+        spools[url].write(b'{"resourceType": "Patient", "id": "some-id"}\n')
+        spools[url].seek(0)
+        if url.endswith("_slow"):
+            slow_started.set()
+            assert release.wait(timeout=5)
+        return spools[url]
+
+    mock_spool_export_blob.side_effect = spool
+    export_response = {
+        "output": [
+            {"type": "Patient", "url": f"https://export-download-url/_{name}"}
+            for name in ["fast", "slow", "queued"]
+        ]
+    }
+
+    files = read_export_files(export_response, max_workers=1, credential=mock.Mock())
+    type, resources = next(files)
+    assert type == "Patient"
+    assert slow_started.wait(timeout=5)
+    files.close()
+    release.set()
+
+    # The file yielded but never read, and the one still downloading, are closed
+    # and the download that hadn't started is cancelled
+    for _ in range(50):
+        if len(spools) == 2 and spools["https://export-download-url/_slow"].closed:
+            break
+        time.sleep(0.1)
+    assert spools["https://export-download-url/_fast"].closed
+    assert spools["https://export-download-url/_slow"].closed
+    assert "https://export-download-url/_queued" not in spools
@@ -7,11 +7,18 @@ from smartystreets_python_sdk.us_street.candidate import Candidate
 from smartystreets_python_sdk.us_street.metadata import Metadata
 from smartystreets_python_sdk.us_street.components import Components
 
+from phdi_building_blocks.cache import LRUCache, TieredCache
 from phdi_building_blocks.geo import (
     geocode,
+    geocode_batch,
+    geocode_records,
     geocode_patient_address,
+    geocode_patient_addresses,
+    GeocodeCache,
+    GeocodeRecord,
     GeocodeResult,
 )
+from tests.conftest import fill_in_batch
 
 
 def test_geocode():
@@ -109,3 +116,137 @@ def test_geocode_patient_address(patched_geocoder):
     patched_geocoder.return_value = geocoded_response
 
     assert geocode_patient_address(raw_bundle, mock.Mock()) == standardized_bundle
+
+
+@mock.patch("phdi_building_blocks.geo.time.time")
+@mock.patch("phdi_building_blocks.geo.geocode")
+def test_geocode_cache(patched_geocoder, patched_time):
+    patched_time.return_value = 1000
+    geocoded_response = GeocodeResult(
+        address=["123 FAKE ST"],
+        city="New York",
+        state="NY",
+        lat=45.123,
+        lng=-70.234,
+        county_fips="36061",
+        county_name="New York",
+        zipcode="10001",
+        precision="Zip9",
+    )
+    patched_geocoder.side_effect = [geocoded_response, None, None]
+    client = mock.Mock()
+    cache = GeocodeCache(negative_ttl=60)
+
+    # Addresses that normalize to the same key are only geocoded once
+    assert cache.geocode(client, "123 Fake St, New York, NY 10001") == (
+        geocoded_response
+    )
+    assert cache.geocode(client, "123 FAKE ST. New York NY 10001 ") == (
+        geocoded_response
+    )
+    assert patched_geocoder.call_count == 1
+
+    # Addresses that could not be geocoded are cached until the negative ttl
+    assert cache.geocode(client, "123 Nowhere St, Atlantis GA") is None
+    assert cache.geocode(client, "123 Nowhere St, Atlantis GA") is None
+    assert patched_geocoder.call_count == 2
+    patched_time.return_value = 1060
+    assert cache.geocode(client, "123 Nowhere St, Atlantis GA") is None
+    assert patched_geocoder.call_count == 3
+
+    assert cache.stats.hits == 2
+    assert cache.stats.misses == 3
+    assert cache.negative_hits == 1
+
+
+@mock.patch("phdi_building_blocks.geo.geocode")
+def test_geocode_cache_tiers(patched_geocoder):
+    persistent = LRUCache()
+    cache = GeocodeCache(TieredCache(LRUCache(), persistent))
+    cache.set("1 Main St, Springfield, IL", None)
+
+    # Negative entries keep their expiry when copied between tiers
+    found, result = GeocodeCache(persistent).get("1 MAIN ST SPRINGFIELD IL")
+    assert found
+    assert result is None
+    patched_geocoder.assert_not_called()
+
+
+@mock.patch("phdi_building_blocks.geo.geocode")
+def test_geocode_patient_address_cache(patched_geocoder):
+    bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    cache = GeocodeCache()
+    patched_geocoder.return_value = None
+
+    geocode_patient_address(copy.deepcopy(bundle), mock.Mock(), cache)
+    geocode_patient_address(copy.deepcopy(bundle), mock.Mock(), cache)
+
+    patched_geocoder.assert_called_once()
+    assert cache.stats.hits == 1
+
+
+def test_geocode_batch():
+    client = mock.Mock()
+    client.send_batch.side_effect = fill_in_batch
+    addresses = [f"{i} Fake St, New York, NY" for i in range(150)]
+    addresses[1] = "123 Nowhere St, Atlantis GA"
+
+    results = geocode_batch(client, addresses)
+
+    # Lookups are sent in batches of up to 100
+    assert [len(c.args[0]) for c in client.send_batch.call_args_list] == [100, 50]
+    assert results[0].address == ["0 FAKE ST"]
+    assert results[1] is None
+    assert results[149].address == ["149 FAKE ST"]
+
+
+def test_geocode_records():
+    client = mock.Mock()
+    client.send_batch.side_effect = fill_in_batch
+
+    records = geocode_records(
+        client, ["1 Fake St, New York, NY", "123 Nowhere St, Atlantis GA"]
+    )
+
+    assert isinstance(records[0], GeocodeRecord)
+    assert records[0].address == ["1 FAKE ST"]
+    assert records[1] is None
+    assert (
+        records[0].to_model() == geocode_batch(client, ["1 Fake St, New York, NY"])[0]
+    )
+
+    # Records and results are cached the same way, and read back as records
+    cache = GeocodeCache()
+    cache.set("1 Fake St, New York, NY", records[0])
+    assert cache.get("1 fake st new york ny") == (True, records[0])
+
+
+def test_geocode_patient_addresses():
+    raw_bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    bundles = [copy.deepcopy(raw_bundle) for _ in range(3)]
+    client = mock.Mock()
+    client.send_batch.side_effect = fill_in_batch
+    cache = GeocodeCache()
+
+    geocode_patient_addresses(bundles, client, cache)
+
+    # The address shared by every bundle is looked up once
+    client.send_batch.assert_called_once()
+    assert len(client.send_batch.call_args.args[0]) == 1
+    for bundle in bundles:
+        patient = bundle["entry"][1]["resource"]
+        assert patient["address"][0]["line"] == ["123 FAKE ST UNIT #F FAKETON"]
+        assert patient["address"][0]["extension"][0]["extension"][0] == {
+            "url": "latitude",
+            "valueDecimal": 45.123,
+        }
+        assert patient["extension"][-1]["valueBoolean"]
+
+    # Addresses already in the cache are not looked up again
+    geocode_patient_addresses([copy.deepcopy(raw_bundle)], client, cache)
+    client.send_batch.assert_called_once()
+    assert cache.stats.hits == 1
@@ -1,4 +1,11 @@
-from phdi_building_blocks.linkage import generate_hash_str, add_patient_identifier
+import copy
+
+from phdi_building_blocks.linkage import (
+    add_patient_identifier,
+    generate_hash_str,
+    generate_hash_strs,
+    link_patients,
+)
 
 
 def test_generate_hash():
@@ -115,3 +122,59 @@ def test_add_patient_identifier():
         if resource["resource"]["resourceType"] == "Patient":
             assert len(resource["resource"]["identifier"]) == 2
             assert resource["resource"]["identifier"][-1] == expected_new_identifier
+
+
+def _patient(id, family):
+    return {
+        "resourceType": "Patient",
+        "id": id,
+        "name": [{"family": family, "given": ["JOHN"]}],
+        "birthDate": "1990-01-01",
+        "address": [
+            {"use": "work", "line": ["1 Office Pl"], "city": "A", "state": "B"},
+            {
+                "use": "home",
+                "line": ["123 Main St"],
+                "city": "Town",
+                "state": "ST",
+                "postalCode": "12345",
+            },
+        ],
+    }
+
+
+def test_generate_hash_strs():
+    link_strs = ["John-Shepard-2153/11/07", "Tali-Zora-Vas-Normandy-2160/05/14"]
+    assert generate_hash_strs(link_strs, "some-salt") == [
+        generate_hash_str(link_str, "some-salt") for link_str in link_strs
+    ]
+
+
+def test_link_patients():
+    patients = [_patient(str(i), f"DOE{i}") for i in range(7)]
+    bundle = {"entry": [{"resource": p} for p in copy.deepcopy(patients)]}
+    add_patient_identifier(bundle, "some-salt")
+    expected = [entry["resource"] for entry in bundle["entry"]]
+
+    pairs = list(
+        link_patients(iter(patients), "some-salt", batch_size=2, max_workers=2)
+    )
+    assert pairs == [(p["id"], p["identifier"][0]["value"]) for p in expected]
+
+    updated = link_patients(
+        patients, "some-salt", update=True, batch_size=3, max_workers=1
+    )
+    assert list(updated) == expected
+
+
+def test_link_patients_malformed():
+    patients = [_patient("1", "DOE"), {"resourceType": "Patient", "id": "2"}]
+    patients += [_patient("3", "ROE"), dict(_patient("4", "POE"), name=[])]
+
+    pairs = list(link_patients(patients, "some-salt", batch_size=3, max_workers=1))
+    assert [id for id, _ in pairs] == ["1", "2", "3", "4"]
+    assert [hashcode is None for _, hashcode in pairs] == [False, True, False, True]
+
+    updated = list(link_patients(patients, "some-salt", update=True, max_workers=1))
+    assert updated[1] == {"resourceType": "Patient", "id": "2"}
+    assert updated[2]["identifier"][0]["value"] == pairs[2][1]
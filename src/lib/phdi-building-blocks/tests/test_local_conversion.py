@@ -0,0 +1,200 @@
+import pathlib
+
+from unittest import mock
+from phdi_building_blocks.local_conversion import (
+    LocalHl7v2Converter,
+    codeable_concept,
+    hl7_to_fhir_datetime,
+    hl7_to_fhir_instant,
+    parse_hl7_segments,
+)
+
+ORU_MESSAGE = "\n".join(
+    [
+        "MSH|^~\\&|LAB|FACILITY|PH|STATE|20220301123000-0500||ORU^R01^ORU_R01|MSG001|P|2.5.1",  # noqa
+        "PID|1||12345^^^FACILITY^MR||DOE^JANE^Q^^^^L||19800102|F|||1 MAIN ST^APT 2^SPRINGFIELD^IL^62701^USA^H||^PRN^PH^^1^217^5551234|||||||||||||||||",  # noqa
+        "OBR|1|ORD1|FIL1|94500-6^SARS-CoV-2 RNA^LN|||20220228090000|||||||||||||||20220301100000|||F",  # noqa
+        "OBX|1|CWE|94500-6^SARS-CoV-2 RNA^LN||260373001^Detected^SCT||||||F|||20220228090000",  # noqa
+        "OBX|2|NM|2160-0^Creatinine^LN||1.2|mg/dL^milligram per deciliter^UCUM|||||F",
+        "OBX|3|ST|8251-1^Comment^LN||Sample \\T\\ retest||||||F",
+    ]
+)
+
+
+def test_parse_hl7_segments():
+    segments = parse_hl7_segments(ORU_MESSAGE)
+
+    assert [segment.name for segment in segments] == [
+        "MSH",
+        "PID",
+        "OBR",
+        "OBX",
+        "OBX",
+        "OBX",
+    ]
+    assert segments[0].field(10) == "MSG001"
+    assert segments[0].components(9) == ["ORU", "R01", "ORU_R01"]
+    assert segments[1].repetitions(5) == [["DOE", "JANE", "Q", "", "", "", "L"]]
+    assert segments[5].value(5) == "Sample & retest"
+
+
+def test_hl7_to_fhir_datetime():
+    assert hl7_to_fhir_datetime("2022") == "2022"
+    assert hl7_to_fhir_datetime("20220301") == "2022-03-01"
+    # A time needs a time zone, so a time without one is dropped
+    assert hl7_to_fhir_datetime("202203011230") == "2022-03-01"
+    assert hl7_to_fhir_datetime("20220301123000.12-0500") == (
+        "2022-03-01T12:30:00.12-05:00"
+    )
+    assert hl7_to_fhir_datetime("") is None
+    assert hl7_to_fhir_datetime("not a date") is None
+
+
+def test_hl7_to_fhir_instant():
+    assert hl7_to_fhir_instant("202203011230") == "2022-03-01T12:30:00+00:00"
+    assert hl7_to_fhir_instant("20220301123000.12-0500") == (
+        "2022-03-01T12:30:00.12-05:00"
+    )
+    assert hl7_to_fhir_instant("20220301") is None
+    assert hl7_to_fhir_instant("not a date") is None
+
+
+def test_codeable_concept():
+    assert codeable_concept(["08", "HepB pediatric", "CVX"]) == {
+        "coding": [
+            {
+                "code": "08",
+                "display": "HepB pediatric",
+                "system": "http://hl7.org/fhir/sid/cvx",
+            }
+        ],
+        "text": "HepB pediatric",
+    }
+    assert codeable_concept(["", "free text"]) == {"text": "free text"}
+    assert codeable_concept([""]) is None
+
+
+def test_convert_oru():
+    bundle = LocalHl7v2Converter().convert(
+        ORU_MESSAGE, "some-filename", "Hl7v2", "ORU_R01", "some-collection"
+    )
+
+    assert bundle["resourceType"] == "Bundle"
+    assert bundle["type"] == "batch"
+    assert bundle["timestamp"] == "2022-03-01T12:30:00-05:00"
+    resources = [entry["resource"] for entry in bundle["entry"]]
+    assert [resource["resourceType"] for resource in resources] == [
+        "Patient",
+        "DiagnosticReport",
+        "Observation",
+        "Observation",
+        "Observation",
+    ]
+    for entry in bundle["entry"]:
+        assert entry["request"] == {
+            "method": "PUT",
+            "url": f"{entry['resource']['resourceType']}/{entry['resource']['id']}",
+        }
+
+    patient, report, detected, creatinine, comment = resources
+    assert patient["name"] == [
+        {"family": "DOE", "given": ["JANE", "Q"], "use": "official"}
+    ]
+    assert patient["birthDate"] == "1980-01-02"
+    assert patient["gender"] == "female"
+    assert patient["address"] == [
+        {
+            "line": ["1 MAIN ST", "APT 2"],
+            "city": "SPRINGFIELD",
+            "state": "IL",
+            "postalCode": "62701",
+            "country": "USA",
+            "use": "home",
+        }
+    ]
+    assert patient["telecom"] == [
+        {"system": "phone", "value": "2175551234", "use": "home"}
+    ]
+
+    assert report["status"] == "final"
+    assert report["effectiveDateTime"] == "2022-02-28"
+    assert report["issued"] == "2022-03-01T10:00:00+00:00"
+    assert report["subject"] == {"reference": f"Patient/{patient['id']}"}
+    assert report["result"] == [
+        {"reference": f"Observation/{observation['id']}"}
+        for observation in (detected, creatinine, comment)
+    ]
+
+    assert detected["valueCodeableConcept"]["coding"][0] == {
+        "code": "260373001",
+        "display": "Detected",
+        "system": "http://snomed.info/sct",
+    }
+    assert detected["effectiveDateTime"] == "2022-02-28"
+    assert creatinine["valueQuantity"] == {
+        "value": 1.2,
+        "unit": "milligram per deciliter",
+        "code": "mg/dL",
+        "system": "http://unitsofmeasure.org",
+    }
+    assert comment["valueString"] == "Sample & retest"
+
+
+def test_convert_vxu():
+    message = open(
+        pathlib.Path(__file__).parent / "assets" / "FileSingleMessageLongDate.hl7"
+    ).read()
+    message += "\nRXR|C28161^Intramuscular^NCIT|LA^Left Arm^HL70163"
+
+    bundle = LocalHl7v2Converter().convert(
+        message, "some-filename", "Hl7v2", "VXU_V04", "some-collection"
+    )
+
+    patient, immunization = [entry["resource"] for entry in bundle["entry"]]
+    assert patient["identifier"] == [
+        {"value": "3054790", "type": {"coding": [{"code": "SR"}]}}
+    ]
+    assert immunization["patient"] == {"reference": f"Patient/{patient['id']}"}
+    assert "subject" not in immunization
+    assert immunization["status"] == "completed"
+    assert immunization["vaccineCode"]["coding"][0]["code"] == "08"
+    assert immunization["occurrenceDateTime"] == "2018-08-09"
+    assert immunization["doseQuantity"] == {"value": 1.0}
+    assert immunization["route"]["coding"][0]["code"] == "C28161"
+    assert immunization["site"]["coding"][0]["system"] == (
+        "http://terminology.hl7.org/CodeSystem/v2-0163"
+    )
+
+    # Converting the same message again yields the same resource ids
+    again = LocalHl7v2Converter().convert(
+        message, "some-filename", "Hl7v2", "VXU_V04", "some-collection"
+    )
+    assert [entry["fullUrl"] for entry in again["entry"]] == [
+        entry["fullUrl"] for entry in bundle["entry"]
+    ]
+
+
+def test_convert_falls_back():
+    fallback = mock.Mock()
+    converter = LocalHl7v2Converter(fallback=fallback)
+
+    # Unsupported message types are converted by the fallback
+    response = converter.convert(
+        "<ClinicalDocument/>", "some-filename", "Ccda", "CCD", "some-collection"
+    )
+    assert response == fallback.convert.return_value
+    fallback.convert.assert_called_with(
+        "<ClinicalDocument/>", "some-filename", "Ccda", "CCD", "some-collection"
+    )
+
+    # As are messages that cannot be converted locally
+    converter.convert("not hl7", "some-filename", "Hl7v2", "VXU_V04", "collection")
+    fallback.convert.assert_called_with(
+        "not hl7", "some-filename", "Hl7v2", "VXU_V04", "collection"
+    )
+
+    # Without a fallback, an error response is returned
+    response = LocalHl7v2Converter().convert(
+        "<ClinicalDocument/>", "some-filename", "Ccda", "CCD", "some-collection"
+    )
+    assert response["http_status_code"] is None
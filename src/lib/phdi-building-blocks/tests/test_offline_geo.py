@@ -0,0 +1,56 @@
+import copy
+import json
+import pathlib
+
+from phdi_building_blocks.geo import geocode, geocode_patient_address
+from phdi_building_blocks.offline_geo import OfflineGeocoder
+
+REFERENCE = [
+    "address,city,state,zipcode,county_fips,county_name,lat,lng",
+    "123 Fake St,Faketon,NY,10001,36061,New York,45.123,-70.234",
+    "12 Oak Ave,Springfield,IL,62701,17167,Sangamon,39.78,-89.65",
+]
+
+
+def _geocoder(tmp_path) -> OfflineGeocoder:
+    path = tmp_path / "reference.csv"
+    path.write_text("\n".join(REFERENCE))
+    return OfflineGeocoder.from_csv(str(path))
+
+
+def test_offline_geocoder(tmp_path):
+    geocoder = _geocoder(tmp_path)
+
+    result = geocoder.geocode("123 Fake Street, Faketon, NY 10001-0001")
+    assert result.dict() == {
+        "address": ["123 FAKE ST"],
+        "city": "Faketon",
+        "state": "NY",
+        "zipcode": "10001",
+        "county_fips": "36061",
+        "county_name": "New York",
+        "lat": 45.123,
+        "lng": -70.234,
+        "precision": "Offline",
+    }
+
+    # Addresses match without a zip code or secondary unit, or with a wrong zip code
+    assert geocoder.geocode("12 oak avenue apt 4, springfield, il").zipcode == "62701"
+    assert geocoder.geocode("12 Oak Ave, Springfield, IL 99999").zipcode == "62701"
+    assert geocoder.geocode("1 Nowhere St, Atlantis GA") is None
+
+    # Geocoders can be used in place of a SmartyStreets client
+    assert geocode(geocoder, "12 Oak Ave Springfield IL").city == "Springfield"
+    assert geocoder.geocode_batch(["12 Oak Ave Springfield IL", "Nowhere"])[1] is None
+
+
+def test_geocode_patient_address_offline(tmp_path):
+    raw_bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    bundle = geocode_patient_address(copy.deepcopy(raw_bundle), _geocoder(tmp_path))
+
+    patient = bundle["entry"][1]["resource"]
+    assert patient["address"][0]["line"] == ["123 FAKE ST"]
+    assert patient["address"][0]["postalCode"] == "10001"
+    assert patient["extension"][-1]["valueBoolean"]
@@ -1,7 +1,7 @@
 import json
 import pathlib
 import copy
-
+from unittest import mock
 
 from phdi_building_blocks.standardize import (
     standardize_name,
@@ -10,12 +10,16 @@ from phdi_building_blocks.standardize import (
     country_extractor,
     standardize_country,
     standardize_patient_phone,
+    standardize_patient_names,
+    standardize_patient_phones,
+    standardization_cache_stats,
 )
 
 
 def test_standardize_name():
     assert "JOHN DOE" == standardize_name(" JOHN DOE ")
     assert "JOHN DOE" == standardize_name(" John Doe3 ")
+    assert "JOSÉ" == standardize_name(" José٣ ")
 
 
 def test_standardize_patient_name():
@@ -75,6 +79,19 @@ def test_standardize_country():
     assert standardize_country("USA", "numeric") == "840"
 
 
+def test_standardization_cache_stats():
+    before = standardization_cache_stats()
+    for _ in range(3):
+        assert standardize_phone("(555) 010-4477", ["CA"]) == "+15550104477"
+        assert standardize_country(" canada ") == "CA"
+    after = standardization_cache_stats()
+
+    # Repeated values are standardized once, and then served from the caches
+    assert after["phone"].hits - before["phone"].hits >= 2
+    assert after["phone"].misses - before["phone"].misses <= 1
+    assert after["country"].hits - before["country"].hits >= 2
+
+
 def test_standardize_patient_phone():
     raw_bundle = json.load(
         open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
@@ -90,3 +107,31 @@ def test_standardize_patient_phone():
         }
     )
     assert standardize_patient_phone(raw_bundle) == standardized_bundle
+
+
+def test_standardize_patient_names():
+    raw_bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    bundles = [copy.deepcopy(raw_bundle) for _ in range(3)]
+    standardize = mock.Mock(side_effect=standardize_name)
+
+    standardize_patient_names(bundles, standardize)
+
+    # Each distinct name is standardized once, with the same results as standardizing
+    # each bundle on its own
+    assert standardize.call_count == 3
+    assert bundles == [standardize_patient_name(copy.deepcopy(raw_bundle))] * 3
+
+
+def test_standardize_patient_phones():
+    raw_bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    bundles = [copy.deepcopy(raw_bundle) for _ in range(3)]
+    standardize = mock.Mock(side_effect=standardize_phone)
+
+    standardize_patient_phones(bundles, standardize)
+
+    standardize.assert_called_once_with("123-456-7890", ["US"])
+    assert bundles == [standardize_patient_phone(copy.deepcopy(raw_bundle))] * 3
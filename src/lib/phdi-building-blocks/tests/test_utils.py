@@ -0,0 +1,56 @@
+import json
+import pathlib
+
+from phdi_building_blocks.utils import BundleIndex, find_patient_resources
+
+
+def _observation(id: str, patient: str) -> dict:
+    return {
+        "fullUrl": f"urn:uuid:{id}",
+        "resource": {
+            "resourceType": "Observation",
+            "id": id,
+            "subject": {"reference": f"Patient/{patient}"},
+        },
+    }
+
+
+def test_bundle_index():
+    bundle = json.load(
+        open(pathlib.Path(__file__).parent / "assets" / "patient_bundle.json")
+    )
+    index = BundleIndex(bundle)
+    patients = find_patient_resources(bundle)
+
+    assert index.by_type("Patient") == patients
+    patient_id = patients[0]["resource"]["id"]
+    assert index.resolve(f"Patient/{patient_id}") is patients[0]
+    assert index.resolve(f"https://fhir.example/Patient/{patient_id}") is patients[0]
+    assert index.resolve("Patient/missing") is None
+
+    # Entries added through the index, or appended to the bundle, are indexed
+    first = _observation("obs-1", patient_id)
+    index.add(first)
+    second = _observation("obs-2", patient_id)
+    bundle["entry"].append(second)
+    assert index.by_type("Observation") == [first, second]
+    assert index.resolve("urn:uuid:obs-2") is second
+    subject = index.resolve(second["resource"]["subject"]["reference"])
+    assert subject is patients[0]
+
+    # Removed entries no longer resolve
+    index.remove(first)
+    assert first not in bundle["entry"]
+    assert index.resolve("Observation/obs-1") is None
+    assert index.by_type("Observation") == [second]
+
+    # Changes the index can't detect are picked up once it is invalidated
+    second["resource"]["id"] = "obs-3"
+    index.invalidate()
+    assert index.resolve("Observation/obs-3") is second
+    assert index.resolve("Observation/obs-2") is None
+
+    # Replacing the entry list rebuilds the index
+    bundle["entry"] = [first]
+    assert index.by_type("Patient") == []
+    assert index.resolve("urn:uuid:obs-1") is first